@@ -0,0 +1,64 @@
+"""Benchmarks keyed-hash pseudonymization of whole columns (hash only the
+distinct values, then broadcast) against hashing every cell, on columns
+with high and low cardinality.
+
+Run from the project root:
+    python benchmark/bench_hashing.py
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append("src/")
+from utils import hash_column, hash_value
+
+HASH_KEY = b"benchmark-key"
+
+
+def per_cell_hash_column(series, hash_key):
+    # Hashes every cell with one Python call each
+    return series.apply(
+        lambda x: hash_value(x, hash_key) if pd.notnull(x) else x)
+
+
+def make_column(rows, distinct, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, distinct, rows)
+    return pd.Series([f"user_{n}@example.com" for n in values])
+
+
+def time_it(func, series, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(series, HASH_KEY)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(rows=1_000_000, cardinalities=None):
+    cardinalities = cardinalities or {"high": rows, "low": 1_000}
+    results = []
+    for label, distinct in cardinalities.items():
+        series = make_column(rows, distinct)
+        pd.testing.assert_series_equal(
+            hash_column(series, HASH_KEY),
+            per_cell_hash_column(series, HASH_KEY))
+        per_cell = time_it(per_cell_hash_column, series)
+        vectorised = time_it(hash_column, series)
+        results.append({
+            "cardinality": label,
+            "rows": rows,
+            "distinct_values": int(series.nunique()),
+            "per_cell_rows_per_s": int(rows / per_cell),
+            "vectorised_rows_per_s": int(rows / vectorised),
+            "speedup": round(per_cell / vectorised, 1),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    for result in run():
+        print(result)
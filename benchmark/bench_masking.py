@@ -0,0 +1,74 @@
+"""Benchmarks the vectorised masking engine against the per-row apply path.
+
+Run from the project root:
+    python benchmark/bench_masking.py
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append("src/")
+from utils import obfuscate_pii
+
+
+def apply_obfuscate_pii(df, pii_fields):
+    # Previous per-row implementation of obfuscate_pii, kept for comparison
+    for field in pii_fields:
+        df[field] = df[field].apply(lambda x: "***" if pd.notnull(x) else x)
+    return df
+
+
+def make_frame(rows, columns, null_ratio=0.1, seed=0):
+    # Builds a frame of string columns with a share of null values
+    rng = np.random.default_rng(seed)
+    data = {}
+    for i in range(columns):
+        values = pd.Series(
+            [f"value_{i}_{n}" for n in rng.integers(0, 10_000, rows)],
+            dtype=object)
+        values[rng.random(rows) < null_ratio] = None
+        data[f"col_{i}"] = values
+    return pd.DataFrame(data)
+
+
+def time_it(func, df, pii_fields, repeat=3):
+    # Returns the best wall time of `repeat` runs on fresh copies
+    best = float("inf")
+    for _ in range(repeat):
+        frame = df.copy()
+        start = time.perf_counter()
+        func(frame, pii_fields)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(shapes=None):
+    shapes = shapes or {
+        "tall": (1_000_000, 4),
+        "wide": (10_000, 200),
+    }
+    results = []
+    for shape, (rows, columns) in shapes.items():
+        df = make_frame(rows, columns)
+        pii_fields = list(df.columns[: max(columns // 2, 1)])
+        expected = apply_obfuscate_pii(df.copy(), pii_fields)
+        actual = obfuscate_pii(df.copy(), pii_fields)
+        pd.testing.assert_frame_equal(actual, expected)
+        apply_time = time_it(apply_obfuscate_pii, df, pii_fields)
+        vector_time = time_it(obfuscate_pii, df, pii_fields)
+        results.append({
+            "shape": shape,
+            "rows": rows,
+            "columns": columns,
+            "apply_seconds": round(apply_time, 4),
+            "vectorised_seconds": round(vector_time, 4),
+            "speedup": round(apply_time / vector_time, 1),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    for result in run():
+        print(result)
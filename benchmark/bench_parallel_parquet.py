@@ -0,0 +1,100 @@
+"""Measures how Parquet obfuscation scales with "parquet_workers": the
+row groups of a spilled file are obfuscated serially and spread across
+process pools of increasing size, with workers mapping the spill file.
+
+The parallel path needs /dev/shm, so on AWS Lambda every run is serial
+and the benchmark only reports the serial time there. Speedups depend on
+the cores available (os.cpu_count()).
+
+Run from the project root:
+    python benchmark/bench_parallel_parquet.py
+"""
+import mmap
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.append("src/")
+from parallel_parquet import (
+    obfuscate_parquet_row_groups_parallel,
+    SHARED_MEMORY_DIR,
+)
+from utils import obfuscate_parquet_row_groups
+
+PII_FIELDS = ["name", "email_address"]
+STRATEGIES = {"email_address": "hash"}
+HASH_KEY = "benchmark-key"
+
+
+def make_parquet(path, rows, row_group_size, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = rng.integers(0, rows, rows)
+    df = pd.DataFrame({
+        "name": [f"name_{n}" for n in ids],
+        "email_address": [f"user_{n}@example.com" for n in ids],
+        "age": rng.integers(18, 90, rows),
+        "score": rng.random(rows),
+    })
+    df.to_parquet(path, index=False, row_group_size=row_group_size)
+
+
+def time_it(func, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(rows=2_000_000, row_group_size=100_000, worker_counts=None):
+    worker_counts = worker_counts or sorted(
+        {2, 4, os.cpu_count() or 1} - {0, 1})
+    results = []
+    with tempfile.NamedTemporaryFile(suffix=".parquet") as spill_file:
+        make_parquet(spill_file.name, rows, row_group_size)
+        source = mmap.mmap(spill_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        def serial():
+            parquet_file = pq.ParquetFile(
+                pa.BufferReader(pa.py_buffer(source)))
+            obfuscate_parquet_row_groups(
+                parquet_file, PII_FIELDS, pa.MockOutputStream(), STRATEGIES,
+                HASH_KEY)
+
+        serial_seconds = time_it(serial)
+        results.append({
+            "workers": 1,
+            "rows": rows,
+            "rows_per_s": int(rows / serial_seconds),
+            "speedup": 1.0,
+        })
+        if not os.path.isdir(SHARED_MEMORY_DIR):
+            return results
+        for workers in worker_counts:
+            def parallel():
+                obfuscate_parquet_row_groups_parallel(
+                    source, PII_FIELDS, pa.MockOutputStream(), STRATEGIES,
+                    HASH_KEY, workers=workers,
+                    source_path=spill_file.name)
+
+            seconds = time_it(parallel)
+            results.append({
+                "workers": workers,
+                "rows": rows,
+                "rows_per_s": int(rows / seconds),
+                "speedup": round(serial_seconds / seconds, 2),
+            })
+    return results
+
+
+if __name__ == "__main__":
+    print({"cpu_count": os.cpu_count()})
+    for result in run():
+        print(result)
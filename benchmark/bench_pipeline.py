@@ -0,0 +1,249 @@
+"""Reproducible benchmark suite for the obfuscation pipeline.
+
+Generates synthetic CSV, JSON Lines and Parquet datasets (rows, columns,
+share of pii columns and of null values are configurable, and the data
+only depends on the seed), then times obfuscate_pii, the S3 readers, the
+S3 writers and the full lambda_handler (in memory and streaming) against
+moto S3. Every benchmark reports its best wall time, throughput in rows/s
+and MB/s (of the input file) and its peak memory traced by tracemalloc,
+measured in a separate run so tracing does not slow the timed runs.
+
+Results are written as JSON, so they can be kept per commit and compared:
+    python benchmark/bench_pipeline.py --output results.json
+    python benchmark/bench_pipeline.py --compare results.json
+
+Run from the project root, or with `make benchmark`.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import boto3
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from moto import mock_aws
+
+sys.path.append("src/")
+import utils
+from obfuscation_lambda import lambda_handler
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+BUCKET = "bench-bucket"
+FORMATS = ("csv", "json", "parquet")
+READERS = {
+    "csv": utils.read_csv_from_s3,
+    "json": utils.read_json_from_s3,
+    "parquet": utils.read_parquet_from_s3,
+}
+WRITERS = {
+    "csv": utils.write_csv_obfuscated_file_to_s3,
+    "json": utils.write_json_obfuscated_file_to_s3,
+    "parquet": utils.write_parquet_obfuscated_file_to_s3,
+}
+
+
+def make_dataset(rows, columns, pii_ratio=0.5, null_ratio=0.1, seed=0):
+    """Builds a frame of string pii columns and numeric other columns.
+    There are at least two pii columns, as the lambda handler requires.
+
+    Returns:
+    - the dataframe and the names of its pii columns
+    """
+    rng = np.random.default_rng(seed)
+    pii_columns = min(columns, max(2, round(columns * pii_ratio)))
+    data = {}
+    for i in range(columns):
+        if i < pii_columns:
+            values = pd.Series(
+                [f"user_{n}@example.com"
+                 for n in rng.integers(0, rows, rows)],
+                dtype=object)
+            values[rng.random(rows) < null_ratio] = None
+        else:
+            values = pd.Series(rng.integers(0, 1_000_000, rows))
+        data[f"pii_{i}" if i < pii_columns else f"col_{i}"] = values
+    df = pd.DataFrame(data)
+    return df, list(df.columns[:pii_columns])
+
+
+def encode_dataset(df, file_type):
+    # Serializes the dataset the way it would land in the ingestion bucket
+    if file_type == "csv":
+        return df.to_csv(index=False).encode("utf-8")
+    if file_type == "json":
+        return df.to_json(orient="records", lines=True).encode("utf-8")
+    return df.to_parquet(index=False)
+
+
+def measure(func, repeat):
+    """Returns the best wall time of `repeat` runs and the peak memory
+    traced by tracemalloc during one extra run"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def result(benchmark, file_type, rows, size, seconds, peak):
+    return {
+        "benchmark": benchmark,
+        "file_type": file_type,
+        "rows": rows,
+        "input_bytes": size,
+        "seconds": round(seconds, 6),
+        "rows_per_s": round(rows / seconds, 1),
+        "mb_per_s": round(size / 1e6 / seconds, 3),
+        "peak_traced_bytes": peak,
+    }
+
+
+def check(response):
+    # Benchmarks must not time failures
+    if isinstance(response, str) and response.startswith(("Error", "No")):
+        raise RuntimeError(response)
+    if isinstance(response, dict) and response["statusCode"] != 200:
+        raise RuntimeError(response["body"])
+    return response
+
+
+def run(rows=100_000, columns=10, pii_ratio=0.5, null_ratio=0.1,
+        formats=FORMATS, repeat=3, seed=0):
+    """Runs every benchmark on every format
+
+    Returns:
+    - list of result dictionaries, one per benchmark and format
+    """
+    df, pii_fields = make_dataset(rows, columns, pii_ratio, null_ratio, seed)
+    # obfuscate_pii works on the frame in place, so each run gets a copy
+    seconds, peak = measure(
+        lambda: utils.obfuscate_pii(df.copy(), pii_fields), repeat)
+    results = [result("obfuscate_pii", "dataframe", rows,
+                      int(df.memory_usage(deep=True).sum()), seconds, peak)]
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=BUCKET)
+        for file_type in formats:
+            key = f"bench.{file_type}"
+            body = encode_dataset(df, file_type)
+            s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+            frame = check(READERS[file_type](BUCKET, key, s3))
+            masked = utils.obfuscate_pii(frame, pii_fields)
+            event = {
+                "file_to_obfuscate": f"s3://{BUCKET}/{key}",
+                "pii_fields": pii_fields,
+            }
+            benchmarks = {
+                "reader": lambda: check(
+                    READERS[file_type](BUCKET, key, s3)),
+                "writer": lambda: check(
+                    WRITERS[file_type](BUCKET, key, masked, s3)),
+                "lambda_handler": lambda: check(
+                    lambda_handler(event, None, s3_client=s3)),
+                "lambda_handler_stream": lambda: check(
+                    lambda_handler(
+                        {**event, "stream": True}, None, s3_client=s3)),
+            }
+            for benchmark, func in benchmarks.items():
+                seconds, peak = measure(func, repeat)
+                results.append(result(
+                    benchmark, file_type, rows, len(body), seconds, peak))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, parameters):
+    """Wraps the results with what is needed to compare two runs"""
+    return {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "pyarrow": pa.__version__,
+        "parameters": parameters,
+        "results": results,
+    }
+
+
+def compare(results, baseline):
+    """Returns the change in throughput of each benchmark against a
+    previous report, as current / baseline rows per second"""
+    previous = {
+        (r["benchmark"], r["file_type"]): r["rows_per_s"]
+        for r in baseline["results"]
+    }
+    return [
+        {
+            "benchmark": r["benchmark"],
+            "file_type": r["file_type"],
+            "speedup": round(
+                r["rows_per_s"] / previous[(r["benchmark"], r["file_type"])],
+                2),
+        }
+        for r in results
+        if (r["benchmark"], r["file_type"]) in previous
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--pii-ratio", type=float, default=0.5)
+    parser.add_argument("--null-ratio", type=float, default=0.1)
+    parser.add_argument(
+        "--formats", nargs="+", choices=FORMATS, default=list(FORMATS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", help="file to write the JSON report to (default stdout)")
+    parser.add_argument(
+        "--compare", help="previous JSON report to compare throughput with")
+    args = parser.parse_args(argv)
+    parameters = {
+        "rows": args.rows,
+        "columns": args.columns,
+        "pii_ratio": args.pii_ratio,
+        "null_ratio": args.null_ratio,
+        "formats": args.formats,
+        "repeat": args.repeat,
+        "seed": args.seed,
+    }
+    results = run(
+        args.rows, args.columns, args.pii_ratio, args.null_ratio,
+        args.formats, args.repeat, args.seed)
+    document = report(results, parameters)
+    if args.compare:
+        with open(args.compare) as baseline:
+            document["comparison"] = compare(results, json.load(baseline))
+    output = json.dumps(document, indent=2)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            report_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Measures cold-start and per-invocation latency of lambda_handler with a
+new s3 client per invocation (previous behaviour) and with the shared
+client from get_s3_client.
+
+Run from the project root:
+    python benchmark/bench_s3_client.py
+"""
+import os
+import sys
+import time
+
+import boto3
+from moto import mock_aws
+
+sys.path.append("src/")
+import utils
+from obfuscation_lambda import lambda_handler
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+BUCKET = "bench-bucket"
+EVENT = {
+    "file_to_obfuscate": f"s3://{BUCKET}/bench.csv",
+    "pii_fields": ["name", "email_address"],
+}
+
+
+def invoke(new_client_per_invocation):
+    # Times one invocation, including client construction when asked to
+    start = time.perf_counter()
+    if new_client_per_invocation:
+        client = boto3.client("s3")
+    else:
+        client = utils.get_s3_client()
+    response = lambda_handler(EVENT, None, s3_client=client)
+    assert response["statusCode"] == 200
+    return time.perf_counter() - start
+
+
+def run(invocations=50):
+    results = []
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket=BUCKET)
+        boto3.client("s3").put_object(
+            Bucket=BUCKET,
+            Key="bench.csv",
+            Body="name,email_address,age\nAnas,anas@example.com,22\n")
+        for label, new_client in (("new_client", True), ("shared", False)):
+            utils._s3_clients.clear()
+            cold = invoke(new_client)
+            warm = [invoke(new_client) for _ in range(invocations)]
+            results.append({
+                "client": label,
+                "cold_ms": round(cold * 1000, 2),
+                "warm_mean_ms": round(sum(warm) / len(warm) * 1000, 2),
+                "invocations": invocations,
+            })
+    return results
+
+
+if __name__ == "__main__":
+    for result in run():
+        print(result)
@@ -0,0 +1,306 @@
+"""Asyncio variant of the streaming obfuscation path.
+
+boto3 is synchronous, so the S3 helpers from utils are offloaded to
+worker threads with asyncio.to_thread (aiobotocore is not a dependency of
+the Lambda package). Each file goes through a three stage pipeline, read
+-> obfuscate -> write, connected by bounded queues: the next chunk is
+downloaded and parsed while the current one is masked and serialized, and
+the previous one is uploaded. run_stream_obfuscate_file is the sync
+wrapper the Lambda handler calls.
+"""
+import asyncio
+from io import BytesIO
+import itertools
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils import (
+    download_s3_object,
+    put_obfuscated_bytes_to_s3,
+    read_csv_chunks_from_s3,
+    obfuscate_pii,
+    obfuscate_json_lines,
+    obfuscate_arrow_table,
+    parquet_output_plan,
+    is_json_lines,
+    build_obfuscated_file_key,
+    get_file_type,
+    get_compression,
+    output_compression,
+    compressing_writer,
+    json_records_writer,
+    iter_body_lines,
+    S3MultipartWriter,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_JSON_FORMAT,
+)
+
+# Chunks queued ahead of the stage that consumes them
+DEFAULT_PREFETCH = 2
+_DONE = object()
+
+
+async def download_s3_object_async(bucket_name, file_key, s3, **kwargs):
+    """Async variant of download_s3_object, run on a worker thread"""
+    return await asyncio.to_thread(
+        download_s3_object, bucket_name, file_key, s3, **kwargs)
+
+
+async def put_obfuscated_bytes_to_s3_async(bucket_name, file_key, body, s3,
+                                           compression=None,
+                                           fingerprint=None):
+    """Async variant of put_obfuscated_bytes_to_s3, run on a worker
+    thread"""
+    return await asyncio.to_thread(
+        put_obfuscated_bytes_to_s3, bucket_name, file_key, body, s3,
+        compression, fingerprint)
+
+
+async def iterate_async(iterator):
+    """Async iterator over a blocking iterator, e.g. chunks parsed off an
+    S3 body stream. Every next() runs on a worker thread."""
+    while True:
+        item = await asyncio.to_thread(next, iterator, _DONE)
+        if item is _DONE:
+            return
+        yield item
+
+
+async def run_pipeline(chunks, transform, write, prefetch=DEFAULT_PREFETCH):
+    """Reads, transforms and writes chunks in three overlapping stages.
+
+    Each stage runs its blocking calls on a worker thread and hands its
+    results to the next through a queue of at most `prefetch` chunks, so
+    memory stays bounded. Chunks are transformed and written one at a
+    time and in order, so transform may use a ValueCache and write may
+    append to a stream. If a stage fails the others are cancelled and the
+    error is raised.
+
+    Input Arguments:
+    - blocking iterator of chunks
+    - function of a chunk returning what is written
+    - function writing a transformed chunk
+    - number of chunks queued between stages
+
+    Returns:
+    - number of chunks written
+    """
+    parsed = asyncio.Queue(prefetch)
+    transformed = asyncio.Queue(prefetch)
+    written = 0
+
+    async def read():
+        async for chunk in iterate_async(chunks):
+            await parsed.put(chunk)
+        await parsed.put(_DONE)
+
+    async def process():
+        while (chunk := await parsed.get()) is not _DONE:
+            await transformed.put(await asyncio.to_thread(transform, chunk))
+        await transformed.put(_DONE)
+
+    async def drain():
+        nonlocal written
+        while (output := await transformed.get()) is not _DONE:
+            await asyncio.to_thread(write, output)
+            written += 1
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            group.create_task(read())
+            group.create_task(process())
+            group.create_task(drain())
+    except ExceptionGroup as errors:
+        raise errors.exceptions[0]
+    return written
+
+
+def _batched(iterator, size):
+    # Groups an iterator into lists of at most size items
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+async def obfuscate_csv_s3_object_async(
+        bucket_name, file_key, pii_fields, s3, chunk_size=DEFAULT_CHUNK_SIZE,
+        strategies=None, hash_key=None, cache=None, categorical=False,
+        prefetch=DEFAULT_PREFETCH, compression=None, fingerprint=None,
+        stats=None):
+    """Obfuscates a CSV file in an S3 bucket in chunks of chunk_size rows,
+    overlapping the download and parsing of the next chunk with the
+    masking of the current one, and streams the result back as CSV.
+
+    Input Arguments:
+    - Bucket name that contains the file to obfuscate
+    - File key to obfuscate - csv file
+    - pii fields to obfuscate
+    - Boto3 s3 client
+    - Number of rows per chunk
+    - Optional strategy per field, hash key, ValueCache and categorical
+    flag, as for obfuscate_pii
+    - Number of chunks queued between stages
+    - Output codec, as for output_compression
+    - Optional output fingerprint, as for build_obfuscated_file_key
+    - Optional dict that receives the number of rows written and the
+    size and sha256 of the written object
+
+    Returns:
+    - s3 key of the obfuscated written file, or an error message
+    """
+    chunks = await asyncio.to_thread(
+        read_csv_chunks_from_s3, bucket_name, file_key, s3, chunk_size)
+    if isinstance(chunks, str):
+        return chunks
+
+    # chunks are transformed one at a time, so the count needs no lock
+    rows = 0
+
+    def transform(numbered_chunk):
+        nonlocal rows
+        i, chunk = numbered_chunk
+        chunk = obfuscate_pii(
+            chunk, pii_fields, strategies, hash_key, cache, categorical)
+        rows += len(chunk)
+        buffer = BytesIO()
+        chunk.to_csv(buffer, index=False, header=(i == 0))
+        return buffer.getvalue()
+
+    try:
+        codec = output_compression(file_key, compression)
+        obfuscated_file_key = build_obfuscated_file_key(
+            file_key, compression, fingerprint)
+        output = S3MultipartWriter(bucket_name, obfuscated_file_key, s3)
+        with output, compressing_writer(output, codec) as sink:
+            await run_pipeline(
+                enumerate(chunks), transform, sink.write, prefetch)
+        if stats is not None:
+            stats.update(output.stats(), rows=rows)
+        return obfuscated_file_key
+    except Exception as e:
+        return (f"Error writing obfuscated file to S3: {e}")
+
+
+async def obfuscate_json_lines_s3_object_async(
+        bucket_name, file_key, pii_fields, s3, batch_size=DEFAULT_CHUNK_SIZE,
+        strategies=None, hash_key=None, cache=None,
+        prefetch=DEFAULT_PREFETCH, compression=None, fingerprint=None,
+        json_format=DEFAULT_JSON_FORMAT, stats=None):
+    """Obfuscates a JSON Lines file in an S3 bucket in batches of
+    batch_size records through run_pipeline, like
+    obfuscate_json_lines_s3_object
+
+    Returns:
+    - s3 key of the obfuscated written file, an error message, or
+    "Not JSON Lines" if the file is a JSON document
+    """
+    try:
+        obj = await asyncio.to_thread(
+            s3.get_object, Bucket=bucket_name, Key=file_key)
+    except Exception as e:
+        return (f"Error reading json from S3: {e}")
+    try:
+        lines = (line for line in iter_body_lines(
+            obj["Body"], get_compression(file_key)) if line.strip())
+        first_line = await asyncio.to_thread(next, lines, None)
+        if first_line is None or not is_json_lines(first_line):
+            obj["Body"].close()
+            return "Not JSON Lines"
+        batches = _batched(itertools.chain([first_line], lines), batch_size)
+        rows = 0
+
+        def transform(batch):
+            nonlocal rows
+            rows += len(batch)
+            return obfuscate_json_lines(
+                batch, pii_fields, strategies, hash_key, cache)
+
+        codec = output_compression(file_key, compression)
+        obfuscated_file_key = build_obfuscated_file_key(
+            file_key, compression, fingerprint)
+        output = S3MultipartWriter(bucket_name, obfuscated_file_key, s3)
+        with output, compressing_writer(output, codec) as compressed, \
+                json_records_writer(compressed, json_format) as sink:
+            await run_pipeline(batches, transform, sink.write, prefetch)
+        if stats is not None:
+            stats.update(output.stats(), rows=rows)
+        return obfuscated_file_key
+    except Exception as e:
+        return (f"Error writing obfuscated file to S3: {e}")
+
+
+async def obfuscate_parquet_s3_object_async(
+        bucket_name, file_key, pii_fields, s3, strategies=None,
+        hash_key=None, cache=None, categorical=False,
+        prefetch=DEFAULT_PREFETCH, fingerprint=None, stats=None):
+    """Obfuscates a parquet file in an S3 bucket row group by row group
+    through run_pipeline: the next row group is decoded while the current
+    one is obfuscated, like obfuscate_parquet_s3_object
+
+    Returns:
+    - s3 key of the obfuscated written file, or an error message
+    """
+    try:
+        source = await download_s3_object_async(
+            bucket_name, file_key, s3, spill_to_disk=True)
+    except Exception as e:
+        return (f"Error reading parquet from S3: {e}")
+    try:
+        parquet_file = pq.ParquetFile(pa.BufferReader(pa.py_buffer(source)))
+        masked_fields, output_schema = parquet_output_plan(
+            parquet_file, pii_fields, categorical)
+        row_groups = (parquet_file.read_row_group(i)
+                      for i in range(parquet_file.num_row_groups))
+        rows = 0
+
+        def transform(table):
+            nonlocal rows
+            rows += table.num_rows
+            table = obfuscate_arrow_table(
+                table, masked_fields, strategies, hash_key, cache,
+                categorical)
+            return table.cast(output_schema)
+
+        obfuscated_file_key = build_obfuscated_file_key(
+            file_key, fingerprint=fingerprint)
+        with S3MultipartWriter(bucket_name, obfuscated_file_key, s3) as sink:
+            with pq.ParquetWriter(sink, output_schema) as writer:
+                await run_pipeline(
+                    row_groups, transform, writer.write_table, prefetch)
+        if stats is not None:
+            stats.update(sink.stats(), rows=rows)
+        return obfuscated_file_key
+    except Exception as e:
+        return (f"Error obfuscating parquet file in S3: {e}")
+
+
+async def stream_obfuscate_file_async(
+        bucket_name, file_key, pii_fields, s3_client,
+        chunk_size=DEFAULT_CHUNK_SIZE, strategies=None, hash_key=None,
+        cache=None, categorical=False, compression=None, fingerprint=None,
+        prefetch=DEFAULT_PREFETCH, json_format=DEFAULT_JSON_FORMAT,
+        stats=None):
+    """Async variant of stream_obfuscate_file, with the same arguments
+    and results plus the number of chunks queued between stages"""
+    file_type = get_file_type(file_key)
+    if file_type == "csv":
+        return await obfuscate_csv_s3_object_async(
+            bucket_name, file_key, pii_fields, s3_client, chunk_size,
+            strategies, hash_key, cache, categorical, prefetch, compression,
+            fingerprint, stats)
+    if file_type == "parquet":
+        return await obfuscate_parquet_s3_object_async(
+            bucket_name, file_key, pii_fields, s3_client,
+            strategies, hash_key, cache, categorical, prefetch, fingerprint,
+            stats)
+    return await obfuscate_json_lines_s3_object_async(
+        bucket_name, file_key, pii_fields, s3_client, chunk_size,
+        strategies, hash_key, cache, prefetch, compression, fingerprint,
+        json_format, stats)
+
+
+def run_stream_obfuscate_file(*args, **kwargs):
+    """Sync wrapper of stream_obfuscate_file_async: runs it on a new event
+    loop and returns its result, so it can be called from the Lambda
+    handler and from batch worker threads"""
+    return asyncio.run(stream_obfuscate_file_async(*args, **kwargs))
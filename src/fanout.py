@@ -0,0 +1,352 @@
+"""Partitioned obfuscation of large CSV and JSON Lines objects.
+
+A coordinator splits the object into byte ranges that start and end on
+line boundaries, found with small ranged GETs around each nominal split
+point, and invokes one worker execution per range. Each worker masks its
+range straight off a ranged GET and writes it to a part object. The
+coordinator then stitches the parts into the output with a multipart
+upload, copying parts server-side with upload_part_copy; parts below the
+S3 minimum part size are merged in memory first. Workers are invoked
+through an invoker: LambdaInvoker of the worker function in AWS, or any
+function of the worker event, e.g. the worker handler when run locally.
+
+Ranges are split on raw newlines, so CSV values holding line breaks are
+not supported in partitioned mode.
+"""
+import csv
+import json
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pandas as pd
+
+from utils import (
+    obfuscate_pii,
+    obfuscate_json_lines,
+    is_json_lines,
+    compressing_writer,
+    S3MultipartWriter,
+    MIN_PART_SIZE,
+    DEFAULT_CHUNK_SIZE,
+)
+
+DEFAULT_PARTITION_SIZE = 64 * 1024 * 1024
+DEFAULT_FANOUT_WORKERS = 16
+# Bytes fetched at a time when looking for the next line break
+BOUNDARY_WINDOW = 64 * 1024
+# Longest CSV header or first JSON Lines record looked for
+MAX_FIRST_LINE = 1024 * 1024
+
+
+class LambdaInvoker:
+    """Invokes worker executions of a Lambda function synchronously and
+    returns their responses
+
+    Input Arguments:
+    - Function name or ARN, e.g. context.invoked_function_arn
+    - Optional boto3 lambda client
+    """
+
+    def __init__(self, function_name, lambda_client=None):
+        self.function_name = function_name
+        self.lambda_client = lambda_client or boto3.client("lambda")
+
+    def __call__(self, event):
+        response = self.lambda_client.invoke(
+            FunctionName=self.function_name,
+            InvocationType="RequestResponse",
+            Payload=json.dumps(event).encode("utf-8"))
+        payload = json.loads(response["Payload"].read())
+        if "FunctionError" in response:
+            return {
+                "statusCode": 500,
+                "body": payload.get("errorMessage", "Worker failed"),
+            }
+        return payload
+
+
+def _read_range(bucket_name, file_key, s3, start, end):
+    # Bytes [start, end) of an object
+    response = s3.get_object(
+        Bucket=bucket_name, Key=file_key, Range=f"bytes={start}-{end - 1}")
+    return response["Body"].read()
+
+
+def next_line_start(bucket_name, file_key, s3, offset, size):
+    """Returns the offset of the first line starting at or after offset,
+    or size if there is none, reading the object in small ranged GETs
+
+    Input Arguments:
+    - Bucket name
+    - File key
+    - Boto3 s3 client
+    - Byte offset
+    - Size of the object in bytes
+    """
+    if offset == 0:
+        return 0
+    # a line starts at offset if the byte before it is a line break
+    position = offset - 1
+    while position < size:
+        window = _read_range(
+            bucket_name, file_key, s3, position,
+            min(position + BOUNDARY_WINDOW, size))
+        newline = window.find(b"\n")
+        if newline != -1:
+            return position + newline + 1
+        position += len(window)
+    return size
+
+
+def plan_partitions(bucket_name, file_key, s3, size, data_start,
+                    partition_size=DEFAULT_PARTITION_SIZE):
+    """Splits the lines of an object into byte ranges of about
+    partition_size bytes that start and end on line boundaries
+
+    Input Arguments:
+    - Bucket name
+    - File key
+    - Boto3 s3 client
+    - Size of the object in bytes
+    - Offset of the first line to split, e.g. after a CSV header
+    - Nominal size of each range in bytes
+
+    Returns:
+    - list of (start, end) byte ranges covering [data_start, size)
+    """
+    boundaries = [data_start]
+    for offset in range(data_start + partition_size, size, partition_size):
+        boundary = next_line_start(bucket_name, file_key, s3, offset, size)
+        if boundary > boundaries[-1] and boundary < size:
+            boundaries.append(boundary)
+    boundaries.append(size)
+    return [(start, end) for start, end
+            in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def read_first_line(bucket_name, file_key, s3, size):
+    """Returns the first line of an object, without its line break, and
+    the offset of the line after it, or (None, None) if the line is longer
+    than MAX_FIRST_LINE bytes, e.g. a JSON document on a single line"""
+    line = bytearray()
+    while len(line) < size and len(line) <= MAX_FIRST_LINE:
+        window = _read_range(
+            bucket_name, file_key, s3, len(line),
+            min(len(line) + BOUNDARY_WINDOW, size))
+        newline = window.find(b"\n")
+        if newline != -1:
+            line += window[:newline + 1]
+            break
+        line += window
+    if len(line) > MAX_FIRST_LINE:
+        return None, None
+    return bytes(line).rstrip(b"\r\n"), len(line)
+
+
+def obfuscate_partition(bucket_name, file_key, s3, partition, pii_fields,
+                        chunk_size=DEFAULT_CHUNK_SIZE, strategies=None,
+                        hash_key=None, cache=None, compression=None,
+                        categorical=False):
+    """Worker side: obfuscates one byte range of a CSV or JSON Lines
+    object and writes it to its part object
+
+    The range is parsed straight off a ranged GET in chunks of chunk_size
+    rows (or records) and streamed to the part object, compressed with
+    the output codec if one is given; gzip members and zstd frames
+    concatenate into a valid file.
+
+    Input Arguments:
+    - Bucket name
+    - File key of the source object
+    - Boto3 s3 client
+    - Partition dictionary from the coordinator: "start", "end",
+    "index", "part_key", "file_type" and, for CSV, the "header" columns
+    - pii fields to obfuscate
+    - Rows (CSV) or records (JSON Lines) per chunk
+    - Optional strategy per field, hash key and ValueCache, as for
+    obfuscate_pii
+    - Output codec, "gzip", "zstd" or None
+    - Categorical flag for CSV chunks, as for obfuscate_pii
+
+    Returns:
+    - dictionary with the "part_key", its "size" and the "rows" written
+    """
+    body = s3.get_object(
+        Bucket=bucket_name, Key=file_key,
+        Range=f"bytes={partition['start']}-{partition['end'] - 1}")["Body"]
+    rows = 0
+    output = S3MultipartWriter(bucket_name, partition["part_key"], s3)
+    with output, compressing_writer(output, compression) as sink:
+        if partition["file_type"] == "csv":
+            header = partition["header"]
+            if partition["index"] == 0:
+                sink.write(pd.DataFrame(columns=header).to_csv(
+                    index=False).encode("utf-8"))
+            for chunk in pd.read_csv(body, header=None, names=header,
+                                     chunksize=chunk_size, dtype=str):
+                chunk = obfuscate_pii(
+                    chunk, pii_fields, strategies, hash_key, cache,
+                    categorical)
+                buffer = BytesIO()
+                chunk.to_csv(buffer, index=False, header=False)
+                sink.write(buffer.getbuffer())
+                rows += len(chunk)
+        else:
+            batch = []
+            for line in body.iter_lines(chunk_size=1024 * 1024):
+                if line.strip():
+                    batch.append(line)
+                if len(batch) >= chunk_size:
+                    sink.write(obfuscate_json_lines(
+                        batch, pii_fields, strategies, hash_key, cache))
+                    rows += len(batch)
+                    batch = []
+            if batch:
+                sink.write(obfuscate_json_lines(
+                    batch, pii_fields, strategies, hash_key, cache))
+                rows += len(batch)
+    return {"part_key": partition["part_key"],
+            "size": output.bytes_written, "rows": rows}
+
+
+def stitch_parts(bucket_name, file_key, parts, s3):
+    """Concatenates part objects into one object with a multipart upload.
+
+    Parts of at least MIN_PART_SIZE bytes are copied server-side with
+    upload_part_copy; smaller ones are downloaded and merged with their
+    neighbours until they reach the minimum, since S3 only allows the last
+    part of an upload to be smaller. The upload is aborted on error.
+
+    Input Arguments:
+    - Bucket name
+    - Key of the stitched object
+    - list of (part key, size) in order
+    - Boto3 s3 client
+
+    Returns:
+    - number of parts copied server-side
+    """
+    upload_id = s3.create_multipart_upload(
+        Bucket=bucket_name, Key=file_key)["UploadId"]
+    completed = []
+    copied = 0
+    pending = bytearray()
+
+    def upload(body):
+        response = s3.upload_part(
+            Bucket=bucket_name, Key=file_key, UploadId=upload_id,
+            PartNumber=len(completed) + 1, Body=bytes(body))
+        completed.append({"ETag": response["ETag"],
+                          "PartNumber": len(completed) + 1})
+
+    try:
+        for part_key, size in parts:
+            if not pending and size >= MIN_PART_SIZE:
+                response = s3.upload_part_copy(
+                    Bucket=bucket_name, Key=file_key, UploadId=upload_id,
+                    PartNumber=len(completed) + 1,
+                    CopySource={"Bucket": bucket_name, "Key": part_key})
+                completed.append({
+                    "ETag": response["CopyPartResult"]["ETag"],
+                    "PartNumber": len(completed) + 1})
+                copied += 1
+                continue
+            pending += s3.get_object(
+                Bucket=bucket_name, Key=part_key)["Body"].read()
+            if len(pending) >= MIN_PART_SIZE:
+                upload(pending)
+                pending = bytearray()
+        if pending or not completed:
+            upload(pending)
+        s3.complete_multipart_upload(
+            Bucket=bucket_name, Key=file_key, UploadId=upload_id,
+            MultipartUpload={"Parts": completed})
+    except Exception:
+        s3.abort_multipart_upload(
+            Bucket=bucket_name, Key=file_key, UploadId=upload_id)
+        raise
+    return copied
+
+
+def _delete_objects(bucket_name, keys, s3):
+    # delete_objects takes at most 1000 keys per call
+    for i in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=bucket_name, Delete={
+            "Objects": [{"Key": key} for key in keys[i:i + 1000]],
+            "Quiet": True})
+
+
+def fanout_obfuscate_file(bucket_name, file_key, s3, file_type,
+                          obfuscated_file_key, worker_event, invoke,
+                          partition_size=DEFAULT_PARTITION_SIZE,
+                          max_workers=DEFAULT_FANOUT_WORKERS):
+    """Coordinator side: obfuscates a CSV or JSON Lines object by fanning
+    its byte ranges out to worker executions and stitching their parts
+
+    Input Arguments:
+    - Bucket name
+    - File key of the source object
+    - Boto3 s3 client
+    - File type: "csv" or "json"
+    - Key of the obfuscated file
+    - Event every worker receives, extended with its "fanout_part"
+    - Invoker: function of a worker event returning its response
+    - Nominal size of each range in bytes
+    - Number of workers invoked at a time
+
+    Returns:
+    - dictionary with the "file_key" written, the number of
+    "partitions" and of "copied_parts"; None when the object is a
+    single range or a JSON document, which are not worth (or not
+    possible to) split; or an error message
+
+    Exception:
+    - botocore ClientError if the source object cannot be read
+    """
+    size = s3.head_object(Bucket=bucket_name, Key=file_key)["ContentLength"]
+    first_line, data_start = read_first_line(bucket_name, file_key, s3, size)
+    if not first_line:
+        return None
+    header = None
+    if file_type == "csv":
+        header = next(csv.reader([first_line.decode("utf-8")]))
+    elif not is_json_lines(first_line):
+        return None
+    else:
+        data_start = 0
+    partitions = plan_partitions(
+        bucket_name, file_key, s3, size, data_start, partition_size)
+    if len(partitions) <= 1:
+        return None
+    partitions = [{
+        "start": start,
+        "end": end,
+        "index": index,
+        "part_key": f"{obfuscated_file_key}.parts/{index:05d}",
+        "file_type": file_type,
+        "header": header,
+    } for index, (start, end) in enumerate(partitions)]
+
+    def run(partition):
+        return invoke({**worker_event, "fanout_part": partition})
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            responses = list(pool.map(run, partitions))
+        failed = [response for response in responses
+                  if response.get("statusCode") != 200]
+        if failed:
+            return f"Error in fan-out worker: {failed[0].get('body')}"
+        copied = stitch_parts(
+            bucket_name, obfuscated_file_key,
+            [(response["part_key"], response["size"])
+             for response in responses], s3)
+    except Exception as e:
+        return f"Error stitching obfuscated parts in S3: {e}"
+    finally:
+        _delete_objects(
+            bucket_name, [partition["part_key"] for partition in partitions],
+            s3)
+    return {"file_key": obfuscated_file_key, "partitions": len(partitions),
+            "copied_parts": copied}
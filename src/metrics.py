@@ -0,0 +1,178 @@
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# CloudWatch namespace of the embedded metric format (EMF) block
+METRICS_NAMESPACE = "GDPRObfuscator"
+# Units of the per-stage measurements, as CloudWatch expects them
+STAGE_UNITS = {
+    "seconds": "Seconds",
+    "bytes_read": "Bytes",
+    "bytes_written": "Bytes",
+    "rows": "Count",
+    "process_peak_rss_bytes": "Bytes",
+    "peak_traced_bytes": "Bytes",
+}
+
+# tracemalloc is process wide: it is started by the first invocation
+# that asks for it and stopped when the last one finishes, unless it was
+# already tracing (e.g. python -X tracemalloc)
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_tracing_owned = False
+
+
+def peak_rss_bytes():
+    """Returns the peak resident set size of the process in bytes, or None
+    where the resource module is not available"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _start_tracing():
+    global _tracing_users, _tracing_owned
+    with _tracing_lock:
+        if _tracing_users == 0:
+            _tracing_owned = not tracemalloc.is_tracing()
+            if _tracing_owned:
+                tracemalloc.start()
+        _tracing_users += 1
+
+
+def _stop_tracing():
+    global _tracing_users
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0 and _tracing_owned:
+            tracemalloc.stop()
+
+
+class StageMetrics:
+    """Measurements of one pipeline stage. Only sizes, counts and timings
+    are recorded, never data values.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = None
+        self.bytes_read = None
+        self.bytes_written = None
+        self.rows = None
+        self.process_peak_rss_bytes = None
+        self.peak_traced_bytes = None
+
+    def to_dict(self):
+        """Returns the recorded measurements, skipping unset ones"""
+        return {
+            unit: getattr(self, unit) for unit in STAGE_UNITS
+            if getattr(self, unit) is not None
+        }
+
+
+class PipelineMetrics:
+    """Opt-in stage timing and memory instrumentation for one invocation.
+
+    Each stage records its wall time and, as process_peak_rss_bytes, the
+    process's RSS high-water mark at its end: ru_maxrss never decreases,
+    so it covers every earlier stage and invocation of the container, not
+    the stage alone. With trace_memory, the peak memory traced by
+    tracemalloc during the stage is recorded too (tracemalloc slows
+    allocations, so it is off by default). Callers add bytes read/written
+    and row counts to the stage. When disabled, stages are not timed or
+    recorded.
+
+    tracemalloc is process wide: when files of a batch run on concurrent
+    threads, each stage's traced peak also counts the allocations of the
+    stages running beside it, and one stage resetting the peak lowers
+    the others'.
+
+    Input Arguments:
+    - Whether metrics are recorded
+    - Whether tracemalloc peaks are recorded
+    - CloudWatch namespace of the EMF block
+    """
+
+    def __init__(self, enabled=False, trace_memory=False,
+                 namespace=METRICS_NAMESPACE):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.namespace = namespace
+        self.dimensions = {}
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """Times the wrapped block as the stage `name` and yields its
+        StageMetrics, so the block can record bytes and rows. The stage
+        is recorded even when the block raises.
+        """
+        stage = StageMetrics(name)
+        if not self.enabled:
+            yield stage
+            return
+        if self.trace_memory:
+            _start_tracing()
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds = round(time.perf_counter() - start, 6)
+            stage.process_peak_rss_bytes = peak_rss_bytes()
+            if self.trace_memory:
+                stage.peak_traced_bytes = tracemalloc.get_traced_memory()[1]
+                _stop_tracing()
+            self.stages.append(stage)
+
+    def to_emf(self):
+        """Returns the recorded stages as a CloudWatch embedded metric
+        format document: one metric per stage and measurement, named
+        "<stage>_<measurement>", plus "total_seconds".
+
+        Returns:
+        - dictionary ready to be logged as one JSON line
+        """
+        values = {}
+        metrics = []
+        for stage in self.stages:
+            for unit, value in stage.to_dict().items():
+                name = f"{stage.name}_{unit}"
+                values[name] = value
+                metrics.append({"Name": name, "Unit": STAGE_UNITS[unit]})
+        values["total_seconds"] = round(
+            sum(stage.seconds for stage in self.stages), 6)
+        metrics.append({"Name": "total_seconds", "Unit": "Seconds"})
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [sorted(self.dimensions)],
+                    "Metrics": metrics,
+                }],
+            },
+            **self.dimensions,
+            **values,
+        }
+
+    def log(self):
+        """Prints the EMF document as one JSON line, which CloudWatch
+        Logs turns into metrics when the function runs in Lambda
+
+        Returns:
+        - the EMF document
+        """
+        document = self.to_emf()
+        print(json.dumps(document))
+        return document
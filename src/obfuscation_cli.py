@@ -0,0 +1,407 @@
+"""Command-line runner that obfuscates local (or NFS mounted) files with
+the same masking, hashing and format logic as the lambda.
+
+Files, and byte ranges of large CSV and JSON Lines files, are spread
+across a process pool sized to the machine's cores. e.g:
+
+    python src/obfuscation_cli.py /data/dumps --pii-fields name email \\
+        --output-dir /data/obfuscated
+
+Every csv, parquet and json file under a directory is obfuscated to
+"<name>_obfuscated.<ext>", mirroring the directory tree under
+--output-dir (or next to the source file). Progress is printed to stderr
+and a throughput summary is printed when all files are done.
+"""
+import argparse
+import json
+import mmap
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from utils import (
+    obfuscate_pii,
+    obfuscate_json_lines,
+    obfuscate_parquet_row_groups,
+    serialize_dataframe,
+    read_csv_bytes,
+    is_json_lines,
+    get_file_type,
+    get_compression,
+    missing_fields_message,
+    ValueCache,
+    STRATEGIES,
+    DEFAULT_CACHE_SIZE,
+    DEFAULT_CHUNK_SIZE,
+    JSON_FORMATS,
+    DEFAULT_JSON_FORMAT,
+)
+
+FILE_TYPES = ("csv", "parquet", "json")
+# Files bigger than this are split into byte ranges of about this size
+DEFAULT_SPLIT_SIZE = 64 * 1024 * 1024
+
+
+def list_local_files(paths):
+    """Lists the csv, parquet and json files in the given files and
+    directories (recursively). Files written by the obfuscator itself are
+    skipped, and so are compressed files, which cannot be split into byte
+    ranges.
+
+    Input Arguments:
+    - list of file and directory paths
+
+    Returns:
+    - list of (root, file path) pairs, where root is the directory the
+    file was found under (its own directory for files given directly)
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in sorted(os.walk(path)):
+                for name in sorted(names):
+                    files.append((path, os.path.join(directory, name)))
+        else:
+            files.append((os.path.dirname(path), path))
+    return [
+        (root, path) for root, path in files
+        if get_file_type(path) in FILE_TYPES
+        and get_compression(path) is None
+        and not path.endswith(f"_obfuscated.{get_file_type(path)}")
+    ]
+
+
+def obfuscated_path(root, path, output_dir=None):
+    """Returns the path the obfuscated version of a file is written to,
+    e.g. "out/new_data/file1_obfuscated.csv" for "in/new_data/file1.csv"
+    with root "in" and output_dir "out"
+    """
+    file_type = get_file_type(path)
+    name = path[: -len(file_type) - 1] + f"_obfuscated.{file_type}"
+    if output_dir is None:
+        return name
+    return os.path.join(output_dir, os.path.relpath(name, root))
+
+
+def record_offsets(data, split_size, quoted=False):
+    """Splits a buffer of newline separated records into ranges of about
+    split_size bytes that start and end on record boundaries.
+
+    With quoted, newlines inside double quoted CSV values are not
+    boundaries: a newline ends a record only when the number of quotes
+    before it is even, which also holds for escaped ("") quotes.
+
+    Input Arguments:
+    - bytes-like buffer supporting find and slicing, e.g. an mmap
+    - target size of each range
+    - whether records are CSV rows that may contain quoted newlines
+
+    Returns:
+    - list of offsets, from 0 to len(data); range i is
+    data[offsets[i]:offsets[i + 1]]
+    """
+    offsets = [0]
+    quotes = 0
+    position = 0
+    while offsets[-1] + split_size < len(data):
+        end = data.find(b"\n", offsets[-1] + split_size)
+        while end != -1 and quoted:
+            # counted a slice at a time, since mmap has no count
+            quotes += data[position:end].count(b'"')
+            position = end
+            if quotes % 2 == 0:
+                break
+            end = data.find(b"\n", end + 1)
+        if end == -1 or end + 1 >= len(data):
+            break
+        offsets.append(end + 1)
+    offsets.append(len(data))
+    return offsets
+
+
+class MissingFieldsError(ValueError):
+    """Raised when pii fields are not among the columns of a file"""
+
+
+def check_pii_fields(path, columns, pii_fields, strategies=None):
+    """Raises MissingFieldsError naming the pii fields that are not among
+    the columns of a file, with the lambda's 400 message and the path, so
+    a misspelt field never leaves the real one in clear"""
+    message = missing_fields_message(columns, pii_fields, strategies)
+    if message is not None:
+        raise MissingFieldsError(f"{message} ({path})")
+
+
+def _read_range(path, start, end):
+    with open(path, "rb") as source:
+        source.seek(start)
+        return source.read(end - start)
+
+
+def _csv_header(path):
+    # Column names from the first row, parsed like the rest of the file
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def obfuscate_range(task):
+    """Obfuscates one file, or one byte range of a CSV or JSON Lines file,
+    into a local output file. Runs in a worker process.
+
+    Input Arguments:
+    - task dictionary with "path", "output", "file_type", "pii_fields",
+    "strategies", "hash_key", "json_format" and, for ranges, "start",
+    "end" and "columns" (CSV column names, given for every range but
+    the first)
+
+    Returns:
+    - number of rows written
+    """
+    path = task["path"]
+    pii_fields = task["pii_fields"]
+    strategies = task["strategies"]
+    hash_key = task["hash_key"]
+    cache = ValueCache(DEFAULT_CACHE_SIZE) if hash_key else None
+    file_type = task["file_type"]
+    if file_type == "parquet":
+        with open(task["output"], "wb") as sink:
+            return obfuscate_parquet_row_groups(
+                pq.ParquetFile(path), pii_fields, sink,
+                strategies, hash_key, cache)
+    if "start" not in task:
+        # JSON documents are read whole
+        df = pd.read_json(path, lines=task["json_lines"], dtype=False,
+                          convert_dates=False)
+        check_pii_fields(path, df.columns, pii_fields, strategies)
+        df = obfuscate_pii(df, pii_fields, strategies, hash_key, cache)
+        with open(task["output"], "wb") as sink:
+            sink.write(serialize_dataframe(df, "json", task["json_format"]))
+        return len(df)
+    data = _read_range(path, task["start"], task["end"])
+    if not data:
+        open(task["output"], "wb").close()
+        return 0
+    if file_type == "json":
+        lines = [line for line in data.split(b"\n") if line.strip()]
+        with open(task["output"], "wb") as sink:
+            for i in range(0, len(lines), DEFAULT_CHUNK_SIZE):
+                sink.write(obfuscate_json_lines(
+                    lines[i:i + DEFAULT_CHUNK_SIZE], pii_fields,
+                    strategies, hash_key, cache))
+        return len(lines)
+    # parsed like the lambda parses the whole file, so both write the
+    # same bytes
+    df = read_csv_bytes(data, columns=task["columns"])
+    df = obfuscate_pii(df, pii_fields, strategies, hash_key, cache)
+    with open(task["output"], "wb") as sink:
+        sink.write(df.to_csv(
+            index=False, header=not task["columns"]).encode("utf-8"))
+    return len(df)
+
+
+def plan_tasks(path, output, pii_fields, strategies, hash_key,
+               split_size=DEFAULT_SPLIT_SIZE, json_format=DEFAULT_JSON_FORMAT):
+    """Splits the obfuscation of one file into worker tasks: one per byte
+    range of CSV and JSON Lines files, one for other files. Ranges are
+    written to "<output>.part<i>" files that are joined in order once
+    every range is done.
+
+    Returns:
+    - list of task dictionaries for obfuscate_range
+
+    Exception:
+    - MissingFieldsError if a pii field is not in the CSV header, the
+    Parquet schema or the first JSON Lines record. JSON documents are
+    checked by obfuscate_range once parsed.
+    """
+    file_type = get_file_type(path)
+    base = {
+        "path": path,
+        "output": output,
+        "file_type": file_type,
+        "pii_fields": pii_fields,
+        "strategies": strategies,
+        "hash_key": hash_key,
+        "json_format": json_format,
+    }
+    if file_type == "parquet":
+        check_pii_fields(
+            path, pq.read_schema(path).names, pii_fields, strategies)
+        return [base]
+    if os.path.getsize(path) == 0:
+        return [{**base, "start": 0, "end": 0, "columns": None}]
+    with open(path, "rb") as source, mmap.mmap(
+            source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        end = data.find(b"\n")
+        first_line = data[:end if end != -1 else len(data)]
+        if file_type == "json" and not is_json_lines(first_line):
+            return [{**base, "json_lines": False}]
+        offsets = record_offsets(data, split_size, file_type == "csv")
+    columns = None
+    if file_type == "csv":
+        columns = _csv_header(path)
+        check_pii_fields(path, columns, pii_fields, strategies)
+    else:
+        check_pii_fields(
+            path, list(json.loads(first_line)), pii_fields, strategies)
+    tasks = []
+    for i, (start, end) in enumerate(zip(offsets, offsets[1:])):
+        task = {**base, "start": start, "end": end, "columns": None}
+        if len(offsets) > 2:
+            task["output"] = f"{output}.part{i}"
+        if i > 0 and columns is not None:
+            task["columns"] = columns
+        tasks.append(task)
+    return tasks
+
+
+def join_parts(output, parts):
+    # Concatenates the range outputs of a file in order
+    with open(output, "wb") as sink:
+        for part in parts:
+            with open(part, "rb") as source:
+                shutil.copyfileobj(source, sink)
+            os.remove(part)
+
+
+def run(paths, pii_fields, output_dir=None, strategies=None, hash_key=None,
+        workers=None, split_size=DEFAULT_SPLIT_SIZE,
+        json_format=DEFAULT_JSON_FORMAT, progress=sys.stderr):
+    """Obfuscates every csv, parquet and json file in paths on a process
+    pool and prints progress as tasks finish.
+
+    Input Arguments:
+    - list of file and directory paths
+    - pii fields to obfuscate
+    - directory to write obfuscated files to, mirroring the input tree;
+    next to the source files by default
+    - optional strategy per field and hash key, as for obfuscate_pii
+    - number of worker processes, defaults to the number of cores
+    - target size of the byte ranges large files are split into
+    - shape of JSON document output, as for serialize_dataframe
+    - text stream for progress lines, or None
+
+    Returns:
+    - summary dictionary with files, rows, bytes, seconds, rows_per_s,
+    mb_per_s and the list of obfuscated paths
+
+    Exception:
+    - MissingFieldsError if a pii field is not in one of the files
+    """
+    start = time.perf_counter()
+    outputs = {}
+    tasks = []
+    total_bytes = 0
+    for root, path in list_local_files(paths):
+        output = obfuscated_path(root, path, output_dir)
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        file_tasks = plan_tasks(
+            path, output, pii_fields, strategies or {}, hash_key,
+            split_size, json_format)
+        outputs[output] = [task["output"] for task in file_tasks]
+        tasks.extend(file_tasks)
+        total_bytes += os.path.getsize(path)
+    rows = 0
+    done_bytes = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = {pool.submit(obfuscate_range, task): task for task in tasks}
+        for done, future in enumerate(as_completed(futures), 1):
+            task = futures[future]
+            rows += future.result()
+            done_bytes += task.get("end", os.path.getsize(task["path"])) \
+                - task.get("start", 0)
+            if progress is not None:
+                print(
+                    f"[{done}/{len(tasks)}] "
+                    f"{done_bytes / 1e6:.1f}/{total_bytes / 1e6:.1f} MB "
+                    f"{task['path']}",
+                    file=progress)
+    for output, parts in outputs.items():
+        if parts != [output]:
+            join_parts(output, parts)
+    seconds = time.perf_counter() - start
+    return {
+        "files": len(outputs),
+        "rows": rows,
+        "bytes": total_bytes,
+        "seconds": round(seconds, 3),
+        "rows_per_s": round(rows / seconds, 1),
+        "mb_per_s": round(total_bytes / 1e6 / seconds, 3),
+        "outputs": list(outputs),
+    }
+
+
+def parse_strategies(values):
+    """Parses repeated "field=strategy" arguments into a dictionary
+
+    Returns:
+    - strategy per field, or an error message
+    """
+    strategies = {}
+    for value in values or []:
+        field, _, strategy = value.partition("=")
+        if strategy not in STRATEGIES:
+            return (f"Unsupported obfuscation strategy for {field}. "
+                    "Expected one of: mask, hash")
+        strategies[field] = strategy
+    return strategies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Obfuscate pii fields in local csv, parquet and json "
+                    "files.")
+    parser.add_argument(
+        "paths", nargs="+", help="files or directories to obfuscate")
+    parser.add_argument(
+        "--pii-fields", nargs="+", required=True,
+        help="fields to obfuscate")
+    parser.add_argument(
+        "--output-dir",
+        help="directory for obfuscated files (default: next to the source)")
+    parser.add_argument(
+        "--strategy", action="append", metavar="FIELD=STRATEGY",
+        help="mask (default) or hash, e.g. email_address=hash")
+    parser.add_argument(
+        "--hash-key",
+        default=os.environ.get("OBFUSCATION_HASH_KEY"),
+        help="key for the hash strategy "
+             "(default: OBFUSCATION_HASH_KEY environment variable)")
+    parser.add_argument(
+        "--workers", type=int,
+        help="worker processes (default: number of cores)")
+    parser.add_argument(
+        "--split-size", type=int, default=DEFAULT_SPLIT_SIZE,
+        help="bytes per range when splitting large csv and JSON Lines files")
+    parser.add_argument(
+        "--json-format", choices=JSON_FORMATS, default=DEFAULT_JSON_FORMAT,
+        help="output shape of JSON documents")
+    parser.add_argument(
+        "--quiet", action="store_true", help="do not print progress")
+    args = parser.parse_args(argv)
+    strategies = parse_strategies(args.strategy)
+    if isinstance(strategies, str):
+        parser.error(strategies)
+    if "hash" in strategies.values() and not args.hash_key:
+        parser.error("A hash key is required for the hash strategy.")
+    try:
+        summary = run(
+            args.paths, args.pii_fields, args.output_dir, strategies,
+            args.hash_key, args.workers, args.split_size, args.json_format,
+            None if args.quiet else sys.stderr)
+    except MissingFieldsError as e:
+        parser.error(str(e))
+    print(
+        f"Obfuscated {summary['files']} files, {summary['rows']} rows, "
+        f"{summary['bytes'] / 1e6:.1f} MB in {summary['seconds']} s "
+        f"({summary['rows_per_s']:.0f} rows/s, "
+        f"{summary['mb_per_s']} MB/s)")
+    return summary
+
+
+if __name__ == "__main__":
+    main()
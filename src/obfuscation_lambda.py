@@ -1,24 +1,84 @@
-import boto3
 import pandas as pd
+import pyarrow as pa
 import base64
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from utils import (
     parse_input_json,
-    read_csv_from_s3,
     obfuscate_pii,
-    write_csv_obfuscated_file_to_s3,
-    write_parquet_obfuscated_file_to_s3,
-    read_parquet_from_s3,
-    write_json_obfuscated_file_to_s3,
-    read_json_from_s3,
-    csv_bytestream_for_boto3_put,
-    parquet_bytestream_for_boto3_put,
-    json_bytestream_for_boto3_put,
+    read_csv_bytes,
+    read_parquet_bytes,
+    read_json_bytes,
+    download_s3_object,
+    read_csv_chunks_from_s3,
+    write_csv_chunks_obfuscated_file_to_s3,
+    obfuscate_parquet_s3_object,
+    obfuscate_json_lines_s3_object,
+    obfuscate_json_lines_buffer,
+    is_json_lines_buffer,
+    json_records_writer,
+    read_csv_arrow_bytes,
+    obfuscate_arrow_table,
+    csv_bytestream_from_arrow_table,
+    get_file_type,
+    get_compression,
+    output_compression,
+    compress_bytes,
+    is_obfuscated_key,
+    build_obfuscated_file_key,
+    output_fingerprint,
+    s3_object_exists,
+    probe_s3_columns,
+    missing_fields_message,
+    serialize_dataframe,
+    put_obfuscated_bytes_to_s3,
+    get_s3_client,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_JSON_FORMAT,
+    JSON_FORMATS,
+    DEFAULT_CSV_BACKEND,
+    CSV_BACKENDS,
+    COMPRESSION_OPTIONS,
+    STRATEGIES,
+    DEFAULT_CACHE_SIZE,
+    ValueCache,
+)
+from metrics import PipelineMetrics
+from async_pipeline import run_stream_obfuscate_file, DEFAULT_PREFETCH
+from planner import plan_s3_object
+from parallel_parquet import (
+    obfuscate_parquet_row_groups_parallel,
+    obfuscate_parquet_s3_object_parallel,
+)
+from fanout import (
+    fanout_obfuscate_file,
+    obfuscate_partition,
+    LambdaInvoker,
+    DEFAULT_PARTITION_SIZE,
+    DEFAULT_FANOUT_WORKERS,
 )
 
-s3_client = boto3.client("s3")
+# Parsers of the buffer returned by download_s3_object, per file type
+PARSERS = {
+    "csv": read_csv_bytes,
+    "parquet": read_parquet_bytes,
+    "json": read_json_bytes,
+}
+BATCH_KEYS = ("files_to_obfuscate", "prefix_to_obfuscate", "max_workers")
+DEFAULT_BATCH_WORKERS = 16
+# Lambda responses are capped at 6 MB, so larger bodies are offloaded to a
+# presigned URL of the output, valid for DEFAULT_PRESIGNED_URL_EXPIRY
+# seconds
+DEFAULT_MAX_INLINE_BYTES = 5 * 1024 * 1024
+DEFAULT_PRESIGNED_URL_EXPIRY = 3600
+# Name or ARN of the function deployed with partition_lambda_handler,
+# which "partitioned" mode invokes for its workers
+WORKER_FUNCTION_ENV = "OBFUSCATION_WORKER_FUNCTION"
 
 
-def lambda_handler(event, context, s3_client=None):
+def lambda_handler(event, context, s3_client=None, invoker=None):
     """Obfuscation lambda to obfuscate sensitive data in a file
 
     Input Arguments:
@@ -26,14 +86,27 @@ def lambda_handler(event, context, s3_client=None):
     contains json string contains s3 uri for the file to obfuscate
     and pii fields to be obfuscated.
     - context: supplied by AWS
-    - s3_client: boto3 s3 client.
+    - s3_client: boto3 s3 client. Defaults to the container's shared
+    client from get_s3_client, which is reused across warm invocations.
+    - invoker: function of a worker event returning its response, used
+    by "partitioned" mode. Defaults to a LambdaInvoker of the worker
+    function named by OBFUSCATION_WORKER_FUNCTION, or to
+    partition_lambda_handler in-process when there is no context (local
+    runs).
 
     Returned Output:
     - output dictionary contains 3 keys:
         - status_code key: a key shows the status code for the request. Codes
         are either 200 or 400.
         - file_key key: s3 uri for the obfuscated file.
-        - body key: bytestream representation for the file.
+        - body key: bytestream representation for the file. Not returned
+        in streaming mode, where the file is never held in memory.
+        - size, sha256, presigned_url and expires_in keys: returned
+        instead of the body when it would be larger than
+        "max_inline_bytes" (base64 encoded for binary output) and in
+        streaming mode, with a presigned GET URL of the obfuscated file.
+        - skipped key: True, without a body, when "idempotent" found the
+        output of an unchanged file already in the bucket.
 
     This function is triggered by an event bridge, step machine, etc.
     the function obfuscates sensitive data in files stored in S3 bucket.
@@ -50,133 +123,803 @@ def lambda_handler(event, context, s3_client=None):
     saves the obfuscated file back to S3 bucket, and returns
     a bytestream of the file and the S3 URI of the obfuscated file.
     Supported file types are CSV, Parquet, and JSON.
+
+    The obfuscated file is serialized once; the same bytes are saved to S3
+    and returned in the body.
+
+    Optional event keys:
+    - "stream": when not given, a planner compares the object size
+    (head_object ContentLength) and format with the Lambda's memory and
+    picks in-memory, chunked streaming or spill-to-/tmp execution; its
+    choice is returned as "execution_plan" and does not change the shape
+    of the output. true always streams and
+    false always reads the file into memory. Streaming processes CSV
+    files in chunks of "chunk_size" rows (default 100000), Parquet files
+    row group by row group with Arrow and JSON Lines files in batches of
+    "chunk_size" records, so memory does not grow with the file size.
+    Other JSON documents are read whole.
+    With "async_io": true the chunks go through an asyncio pipeline that
+    downloads and parses the next chunk while the current one is
+    obfuscated and the previous one uploaded, with up to "prefetch"
+    (default 2) chunks queued between stages.
+    - "json_format": shape of JSON output, "lines" for JSON Lines
+    (default) or "array" for a JSON array of records, whether the file
+    is read into memory or streamed.
+    - "csv_backend": "pandas" (default) or "arrow" to parse and write CSV
+    files with the multithreaded pyarrow.csv reader and writer.
+    - "strategies": obfuscation strategy per pii field, "mask" (default,
+    replaces values with "***") or "hash" (HMAC-SHA256 token of the value
+    under "hash_key", or the OBFUSCATION_HASH_KEY environment variable),
+    e.g. {"email_address": "hash"}. Hashed values are memoized for the
+    invocation in an LRU cache of "cache_size" entries (default 100000);
+    its hit/miss/eviction counters are returned as "cache_stats", except
+    for Parquet files with "parquet_workers" above 1, whose worker
+    processes keep caches of their own.
+    - "categorical_output": true keeps obfuscated columns of CSV and
+    Parquet files as pandas Categoricals (Arrow dictionary arrays) while
+    they are processed, so a masked column costs one small code per row
+    instead of one string per row. Parquet output is dictionary-encoded
+    and reads back as category columns; CSV output is unchanged.
+    - "compression": codec of CSV and JSON output, "gzip", "zstd" or
+    "none". Inputs with a .gz or .zst suffix are decompressed on the fly
+    and, by default, the output keeps their codec.
+    - "idempotent": true writes to a key derived from the source ETag and
+    the settings, and skips files whose output already exists ("skipped"
+    in the response). "force": true bypasses the lookup.
+    - "max_inline_bytes": bodies larger than this (default 5 MiB) are
+    replaced by the output's size, sha256 and a presigned URL.
+    - "partitioned": true splits an uncompressed CSV or JSON Lines file
+    into line-aligned byte ranges of about "partition_size" bytes
+    (default 64 MiB), obfuscates them in parallel worker executions (at
+    most "fanout_workers" at a time, default 16) and stitches the parts
+    with upload_part_copy, see fanout_obfuscate_file. Files of a single
+    range and JSON documents are processed as usual. Workers write JSON
+    Lines with the pandas CSV backend, so "json_format": "array" (JSON
+    files) and "csv_backend": "arrow" (CSV files) are rejected.
+    - "parquet_workers": number of processes Parquet row groups are
+    spread across (default 1), see obfuscate_parquet_row_groups_parallel.
+    Falls back to one process where shared memory is not available, so
+    it has no effect on AWS Lambda, which has no /dev/shm.
+    - "metrics": true times each stage of the pipeline (download, parse,
+    obfuscate, serialize and upload, or a single "stream" stage) and
+    records bytes read/written, row counts and the process's peak RSS
+    so far. "trace_memory": true adds the tracemalloc peak of each stage,
+    which in batches includes the files processed concurrently. The
+    measurements are returned as "metrics", a CloudWatch embedded metric
+    format (EMF) document that is also printed to the logs.
+
+    Batches of files are obfuscated in one invocation by passing
+    "files_to_obfuscate" (a list of s3 uris) or "prefix_to_obfuscate"
+    (an s3 uri prefix) instead of "file_to_obfuscate", see batch_handler.
+
     For GDPR compliance:
-    - The obfuscation tool performs irreversible anonymization.
+    - The obfuscation tool performs irreversible anonymization. The
+    "hash" strategy is pseudonymization: tokens can be linked back to
+    values by whoever holds the key, so the key must be managed as
+    personal data by the caller.
     - No lookup tables or re-identification keys are retained.
-    - Logs and debug output never capture original data."""
+    - Logs and debug output never capture original data. The metrics
+    block only holds sizes, counts and timings."""
 
+    metrics = None
     try:
-        s3_client = s3_client or boto3.client("s3")
-        bucket_name, file_key, pii_fields = parse_input_json(event)
-        if bucket_name == "Input JSON is empty.":
+        s3_client = s3_client or get_s3_client()
+        if "files_to_obfuscate" in event or "prefix_to_obfuscate" in event:
+            return batch_handler(event, s3_client)
+        if "fanout_part" in event:
+            # worker events are only accepted by partition_lambda_handler,
+            # which only the coordinator may invoke
             return {
                 "statusCode": 400,
-                "body": "Input JSON is empty.",
+                "body": "Unexpected fanout_part in a file event.",
             }
-        if bucket_name == "bucket or file key is missing":
+        if invoker is None and event.get("partitioned"):
+            invoker = default_invoker(context, s3_client)
+        metrics = PipelineMetrics(
+            enabled=bool(event.get("metrics")),
+            trace_memory=bool(event.get("trace_memory")))
+        response = file_handler(event, s3_client, metrics, invoker)
+    except Exception as e:
+        response = {
+            "statusCode": 500,
+            "body": f"Internal server error: {e}",
+        }
+    # the metrics block holds sizes, counts and timings only
+    if metrics is not None and metrics.stages:
+        response["metrics"] = metrics.log()
+    return response
+
+
+def partition_lambda_handler(event, context, s3_client=None):
+    """Entry point of the fan-out worker function, see partition_handler.
+
+    It is deployed as a function of its own that only the coordinator's
+    role may invoke, so byte ranges and part keys never come from the
+    public event of lambda_handler.
+
+    Input Arguments:
+    - event: file event of the coordinator plus "fanout_part"
+    - context: supplied by AWS
+    - s3_client: boto3 s3 client, defaults to get_s3_client
+
+    Returned Output:
+    - dictionary as returned by partition_handler
+    """
+    try:
+        return partition_handler(event, s3_client or get_s3_client())
+    except Exception as e:
+        return {
+            "statusCode": 500,
+            "body": f"Internal server error: {e}",
+        }
+
+
+def default_invoker(context, s3_client):
+    """Returns the invoker of fan-out workers: a LambdaInvoker of the
+    worker function named by OBFUSCATION_WORKER_FUNCTION in AWS, or
+    partition_lambda_handler called in-process when there is no Lambda
+    context, e.g. locally or in tests
+
+    Exception:
+    - ValueError if the worker function is not configured in AWS
+    """
+    if context is not None:
+        function_name = os.environ.get(WORKER_FUNCTION_ENV)
+        if not function_name:
+            raise ValueError(
+                f"{WORKER_FUNCTION_ENV} is required for partitioned mode")
+        return LambdaInvoker(function_name)
+
+    def invoke(event):
+        return partition_lambda_handler(event, None, s3_client=s3_client)
+    return invoke
+
+
+def file_handler(event, s3_client, metrics, invoker=None):
+    """Obfuscates the file of a single file event, see lambda_handler.
+
+    Input Arguments:
+    - event: single file event
+    - boto3 s3 client
+    - PipelineMetrics recording each stage of the pipeline
+    - invoker of fan-out workers, for "partitioned" mode
+
+    Returned Output:
+    - output dictionary as returned by lambda_handler
+    """
+    bucket_name, file_key, pii_fields = parse_input_json(event)
+    if bucket_name == "Input JSON is empty.":
+        return {
+            "statusCode": 400,
+            "body": "Input JSON is empty.",
+        }
+    if bucket_name == "bucket or file key is missing":
+        return {
+            "statusCode": 400,
+            "body": "No bucket name or file key provided",
+        }
+    if bucket_name == "Invalid S3 URI format":
+        return {
+            "statusCode": 400,
+            "body":
+                ("Invalid S3 URI format. "
+                    "Expected format: s3://bucket_name/file_key"),
+        }
+    if file_key == "Unsupported file type":
+        return {
+            "statusCode": 400,
+            "body":
+                ("Unsupported file type. Only CSV,"
+                    "Parquet, and JSON files are supported."),
+        }
+    if pii_fields == ["No pii fields provided"]:
+        return {
+            "statusCode": 400,
+            "body": "No PII fields provided for obfuscation.",
+        }
+    strategies = event.get("strategies") or {}
+    if not isinstance(strategies, dict) or any(
+            strategy not in STRATEGIES
+            for strategy in strategies.values()):
+        return {
+            "statusCode": 400,
+            "body":
+                ("Unsupported obfuscation strategy. "
+                    "Expected one of: mask, hash"),
+        }
+    hash_key = event.get("hash_key") or os.environ.get(
+        "OBFUSCATION_HASH_KEY")
+    if "hash" in strategies.values() and not hash_key:
+        return {
+            "statusCode": 400,
+            "body": "A hash_key is required for the hash strategy.",
+        }
+    json_format = event.get("json_format", DEFAULT_JSON_FORMAT)
+    if json_format not in JSON_FORMATS:
+        return {
+            "statusCode": 400,
+            "body":
+                ("Unsupported JSON format. "
+                    "Expected one of: lines, array"),
+        }
+    csv_backend = event.get("csv_backend", DEFAULT_CSV_BACKEND)
+    if csv_backend not in CSV_BACKENDS:
+        return {
+            "statusCode": 400,
+            "body":
+                ("Unsupported CSV backend. "
+                    "Expected one of: pandas, arrow"),
+        }
+    compression = event.get("compression")
+    if compression is not None and compression not in COMPRESSION_OPTIONS:
+        return {
+            "statusCode": 400,
+            "body":
+                ("Unsupported compression. "
+                    "Expected one of: gzip, zstd, none"),
+        }
+    # hashed values are memoized for this invocation only
+    cache = None
+    if "hash" in strategies.values():
+        cache = ValueCache(event.get("cache_size", DEFAULT_CACHE_SIZE))
+    categorical = bool(event.get("categorical_output"))
+    parquet_workers = event.get("parquet_workers", 1)
+    file_type = get_file_type(file_key)
+    # worker processes keep caches of their own, which the counters of
+    # this one do not see
+    report_cache = cache is not None and not (
+        file_type == "parquet" and parquet_workers > 1)
+    # Streaming obfuscation: output is sent to S3 as it is produced and
+    # the file is never held in memory as a whole. JSON documents that
+    # are not JSON Lines fall back to the in-memory path.
+    metrics.dimensions["FileType"] = file_type
+    # Content-addressed output: the key is derived from the source ETag
+    # and the settings, so retries and re-triggers of an unchanged file
+    # find the existing output with one head_object and skip the work.
+    # "force" bypasses the lookup and rewrites the output.
+    fingerprint = None
+    if event.get("idempotent"):
+        try:
+            with metrics.stage("lookup"):
+                source_head = s3_client.head_object(
+                    Bucket=bucket_name, Key=file_key)
+                fingerprint = output_fingerprint(
+                    source_head, pii_fields, strategies, hash_key, {
+                        "json_format": json_format,
+                        "csv_backend": csv_backend,
+                        "categorical": categorical,
+                        "compression": output_compression(
+                            file_key, compression),
+                    })
+                obfus_file_key = build_obfuscated_file_key(
+                    file_key, compression, fingerprint)
+                exists = (not event.get("force") and s3_object_exists(
+                    bucket_name, obfus_file_key, s3_client))
+        except Exception:
             return {
                 "statusCode": 400,
-                "body": "No bucket name or file key provided",
+                "body":
+                    ("Error, no such file, specified key does not exist"),
             }
-        if bucket_name == "Invalid S3 URI format":
+        if exists:
+            return {
+                "statusCode": 200,
+                "file_key": f"s3://{bucket_name}/{obfus_file_key}",
+                "skipped": True,
+            }
+    # The pii fields are checked against the header or schema of the
+    # file, read with a small ranged GET, so a misspelt field fails here
+    # instead of after the whole file is downloaded and parsed. JSON
+    # documents have no cheap header and are checked once parsed.
+    try:
+        with metrics.stage("probe"):
+            columns = probe_s3_columns(
+                bucket_name, file_key, s3_client, file_type)
+    except Exception:
+        return {
+            "statusCode": 400,
+            "body":
+                ("Error, no such file, specified key does not exist"),
+        }
+    if columns is not None:
+        response = missing_fields_response(
+            columns, pii_fields, strategies, categorical)
+        if response is not None:
+            return response
+    # Partitioned mode: byte ranges of the file are obfuscated by worker
+    # executions in parallel and their parts stitched server-side
+    if (event.get("partitioned") and file_type in ("csv", "json")
+            and get_compression(file_key) is None):
+        # parts are concatenated, so workers write JSON Lines, and CSV
+        # through pandas
+        if ((file_type == "json" and json_format != "lines")
+                or (file_type == "csv" and csv_backend != "pandas")):
             return {
                 "statusCode": 400,
                 "body":
-                    ("Invalid S3 URI format. "
-                        "Expected format: s3://bucket_name/file_key"),
+                    ("Partitioned mode supports JSON Lines output "
+                        "and the pandas CSV backend only."),
             }
-        if file_key == "Unsupported file type":
+        obfus_file_key = build_obfuscated_file_key(
+            file_key, compression, fingerprint)
+        worker_event = {
+            k: v for k, v in event.items() if k != "partitioned"}
+        try:
+            with metrics.stage("fanout"):
+                result = fanout_obfuscate_file(
+                    bucket_name,
+                    file_key,
+                    s3_client,
+                    file_type,
+                    obfus_file_key,
+                    worker_event,
+                    invoker,
+                    event.get("partition_size", DEFAULT_PARTITION_SIZE),
+                    event.get("fanout_workers", DEFAULT_FANOUT_WORKERS))
+        except Exception:
             return {
                 "statusCode": 400,
                 "body":
-                    ("Unsupported file type. Only CSV,"
-                        "Parquet, and JSON files are supported."),
+                    ("Error, no such file, specified key does not exist"),
             }
-        if pii_fields == ["No pii fields provided"]:
+        if isinstance(result, str):
             return {
                 "statusCode": 400,
-                "body": "No PII fields provided for obfuscation.",
+                "body": "Error writing obfuscated file to S3",
             }
-        # CSV file obfuscation
-        if file_key.endswith(".csv"):
-            df_csv = read_csv_from_s3(bucket_name, file_key, s3_client)
-            if (not isinstance(df_csv, (pd.DataFrame)) and
-                    df_csv.startswith("Error")):
-                return {
-                    "statusCode": 400,
-                    "body":
-                        ("Error, no such file, specified key does not exist"),
-                }
-
-            df_obfuscate = obfuscate_pii(df_csv, pii_fields)
-            csv_bytes = csv_bytestream_for_boto3_put(df_obfuscate)
-            obfus_file_key = write_csv_obfuscated_file_to_s3(
-                    bucket_name,
-                    file_key,
-                    df_obfuscate,
-                    s3_client)
-            if obfus_file_key.startswith("Error"):
-                return {
-                    "statusCode": 400,
-                    "body": "Error writing obfuscated file to S3",
-                }
+        if result is not None:
             return {
                 "statusCode": 200,
                 "file_key": f"s3://{bucket_name}/{obfus_file_key}",
-                "body": csv_bytes
+                "partitions": result["partitions"],
+                "copied_parts": result["copied_parts"],
             }
-        # Parquet file obfuscation
-        elif file_key.endswith(".parquet"):
-            df_parquet = read_parquet_from_s3(bucket_name, file_key, s3_client)
-            if (not isinstance(df_parquet, (pd.DataFrame)) and
-                    df_parquet.startswith("Error")):
-                return {
-                    "statusCode": 400,
-                    "body":
-                        ("Error, no such file, specified key does not exist"),
-                }
-
-            df_obfuscate = obfuscate_pii(df_parquet, pii_fields)
-            parq_bytes = parquet_bytestream_for_boto3_put(df_obfuscate)
-
-            obfus_file_key = write_parquet_obfuscated_file_to_s3(
-                    bucket_name,
-                    file_key,
-                    df_obfuscate,
-                    s3_client)
-            if obfus_file_key.startswith("Error"):
-                return {
-                    "statusCode": 400,
-                    "body": "Error writing obfuscated file to S3",
-                }
-
+    # Unless "stream" is given, the execution mode is planned from the
+    # object size and the memory available, so large files are streamed
+    # or spilled to /tmp instead of running out of memory. The arrow CSV
+    # backend only runs in memory, so those files are spilled rather
+    # than streamed and the output does not depend on the file size.
+    plan = None
+    stream = event.get("stream")
+    if stream is None:
+        streamable = not (file_type == "csv" and csv_backend == "arrow")
+        try:
+            with metrics.stage("plan"):
+                plan = plan_s3_object(
+                    bucket_name, file_key, s3_client, file_type,
+                    streamable)
+        except Exception:
             return {
-                "statusCode": 200,
-                "file_key": f"s3://{bucket_name}/{obfus_file_key}",
-                "body": base64.b64encode(parq_bytes).decode("utf-8")
+                "statusCode": 400,
+                "body":
+                    ("Error, no such file, specified key does not exist"),
             }
-        # JSON file obfuscation
-        elif file_key.endswith(".json"):
-            df_json = read_json_from_s3(bucket_name, file_key, s3_client)
-            if (
-                    not isinstance(df_json, (pd.DataFrame)) and
-                    df_json.startswith("Error")):
-                return {
-                    "statusCode": 400,
-                    "body":
+        stream = plan["mode"] != "in_memory" and streamable
+    if stream:
+        # download, parse, obfuscation and upload overlap, so streaming
+        # is timed as a single stage
+        stream_args = (
+                bucket_name,
+                file_key,
+                pii_fields,
+                s3_client,
+                event.get("chunk_size", DEFAULT_CHUNK_SIZE),
+                strategies,
+                hash_key,
+                cache,
+                categorical,
+                compression,
+                fingerprint)
+        output_stats = {}
+        with metrics.stage("stream") as stage:
+            if event.get("async_io"):
+                obfus_file_key = run_stream_obfuscate_file(
+                    *stream_args,
+                    prefetch=event.get("prefetch", DEFAULT_PREFETCH),
+                    json_format=json_format, stats=output_stats)
+            else:
+                obfus_file_key = stream_obfuscate_file(
+                    *stream_args, parquet_workers=parquet_workers,
+                    json_format=json_format, stats=output_stats)
+            stage.bytes_written = output_stats.get("size")
+            stage.rows = output_stats.get("rows")
+        if obfus_file_key.startswith("Error reading"):
+            return {
+                "statusCode": 400,
+                "body":
                     ("Error, no such file, specified key does not exist"),
-                }
-
-            obfuscated_df = obfuscate_pii(df_json, pii_fields)
-            json_bytes = json_bytestream_for_boto3_put(obfuscated_df)
-            obfus_file_key = write_json_obfuscated_file_to_s3(
-                    bucket_name,
-                    file_key,
-                    obfuscated_df,
-                    s3_client)
-            if obfus_file_key.startswith("Error"):
-                return {
-                    "statusCode": 400,
-                    "body": "Error writing obfuscated file to S3",
-                }
-
+            }
+        if obfus_file_key.startswith("Error"):
             return {
+                "statusCode": 400,
+                "body": "Error writing obfuscated file to S3",
+            }
+        if obfus_file_key != "Not JSON Lines":
+            response = {
                 "statusCode": 200,
                 "file_key": f"s3://{bucket_name}/{obfus_file_key}",
-                "body": json_bytes,
-                    }
+            }
+            # the output was never held in memory: its size and sha256
+            # were tracked while it was uploaded
+            response["size"] = output_stats["size"]
+            response["sha256"] = output_stats["sha256"]
+            response.update(presigned_output(
+                bucket_name, obfus_file_key, s3_client, event))
+            if report_cache:
+                response["cache_stats"] = cache.stats()
+            if plan is not None:
+                response["execution_plan"] = plan
+            return response
+    # In-memory obfuscation: the masked frame is serialized once and
+    # the same bytes are written to S3 and returned in the body
+    parser = PARSERS[file_type]
+    if file_type == "csv" and csv_backend == "arrow":
+        parser = read_csv_arrow_bytes
+    try:
+        with metrics.stage("download") as stage:
+            # JSON documents and arrow-backed CSV files too large for
+            # memory land here, and are spilled to /tmp. They are still
+            # parsed whole: the spill only keeps the downloaded bytes
+            # out of memory.
+            spill = plan is not None and plan["mode"] != "in_memory"
+            source = download_s3_object(
+                bucket_name, file_key, s3_client, spill_to_disk=spill)
+            stage.bytes_read = len(source)
+        # parquet inputs are never wrapped in a codec
+        input_codec = get_compression(file_key)
+        # row groups spread across processes are written straight to
+        # parquet, and JSON Lines records are obfuscated one by one like
+        # when streaming, so there is no frame to parse or serialize
+        if file_type == "parquet" and parquet_workers > 1:
+            data = None
+        elif file_type == "json" and is_json_lines_buffer(
+                source, input_codec):
+            data = None
+        else:
+            with metrics.stage("parse") as stage:
+                if input_codec is None:
+                    data = parser(source)
+                else:
+                    data = parser(source, input_codec)
+                stage.rows = len(data)
+    except Exception:
+        return {
+            "statusCode": 400,
+            "body":
+                ("Error, no such file, specified key does not exist"),
+        }
+    # JSON documents are only checked once parsed, as they have no header
+    # to probe; a misspelt field must not leave the real one in clear
+    if data is not None:
+        columns = (data.columns if isinstance(data, pd.DataFrame)
+                   else data.column_names)
+        response = missing_fields_response(
+            columns, pii_fields, strategies, categorical)
+        if response is not None:
+            return response
+
+    # JSON output has no dictionary encoding to preserve
+    categorical = categorical and file_type != "json"
+    if data is None and file_type == "json":
+        with metrics.stage("obfuscate") as stage:
+            output = BytesIO()
+            with json_records_writer(output, json_format) as sink:
+                stage.rows = obfuscate_json_lines_buffer(
+                    source, pii_fields, sink, strategies, hash_key, cache,
+                    input_codec,
+                    event.get("chunk_size", DEFAULT_CHUNK_SIZE))
+            file_bytes = output.getvalue()
+    elif data is None:
+        with metrics.stage("obfuscate") as stage:
+            sink = pa.BufferOutputStream()
+            stage.rows = obfuscate_parquet_row_groups_parallel(
+                source, pii_fields, sink, strategies, hash_key, cache,
+                categorical, parquet_workers)
+            file_bytes = sink.getvalue().to_pybytes()
+    elif isinstance(data, pd.DataFrame):
+        with metrics.stage("obfuscate") as stage:
+            df_obfuscate = obfuscate_pii(
+                data, pii_fields, strategies, hash_key, cache, categorical)
+            stage.rows = len(df_obfuscate)
+        with metrics.stage("serialize"):
+            file_bytes = serialize_dataframe(
+                df_obfuscate, file_type, json_format)
+    else:
+        with metrics.stage("obfuscate") as stage:
+            table_obfuscate = obfuscate_arrow_table(
+                data, pii_fields, strategies, hash_key, cache, categorical)
+            stage.rows = table_obfuscate.num_rows
+        with metrics.stage("serialize"):
+            file_bytes = csv_bytestream_from_arrow_table(table_obfuscate)
+    codec = output_compression(file_key, compression)
+    if codec is not None and isinstance(file_bytes, bytes):
+        with metrics.stage("compress"):
+            file_bytes = compress_bytes(file_bytes, codec)
+    with metrics.stage("upload") as stage:
+        obfus_file_key = put_obfuscated_bytes_to_s3(
+                bucket_name,
+                file_key,
+                file_bytes,
+                s3_client,
+                compression,
+                fingerprint)
+        if isinstance(file_bytes, bytes):
+            stage.bytes_written = len(file_bytes)
+    if not is_obfuscated_key(obfus_file_key):
+        return {
+            "statusCode": 400,
+            "body": "Error writing obfuscated file to S3",
+        }
+    response = {
+        "statusCode": 200,
+        "file_key": f"s3://{bucket_name}/{obfus_file_key}",
+    }
+    # binary output is returned base64 encoded, which grows it by a third
+    binary = file_type == "parquet" or codec is not None
+    body_size = len(file_bytes)
+    if binary:
+        body_size = 4 * -(-len(file_bytes) // 3)
+    if body_size <= event.get("max_inline_bytes", DEFAULT_MAX_INLINE_BYTES):
+        if binary:
+            file_bytes = base64.b64encode(file_bytes).decode("utf-8")
+        response["body"] = file_bytes
+    else:
+        # too large for a Lambda response: the caller downloads the
+        # output from S3 instead, and the body is never built
+        response["size"] = len(file_bytes)
+        response["sha256"] = hashlib.sha256(file_bytes).hexdigest()
+        response.update(presigned_output(
+            bucket_name, obfus_file_key, s3_client, event))
+    if report_cache:
+        response["cache_stats"] = cache.stats()
+    if plan is not None:
+        response["execution_plan"] = plan
+    return response
+
+
+def presigned_output(bucket_name, obfus_file_key, s3_client, event):
+    """Returns the presigned_url and expires_in keys of a response whose
+    output is downloaded from S3 instead of returned in the body"""
+    expires_in = event.get(
+        "presigned_url_expiry", DEFAULT_PRESIGNED_URL_EXPIRY)
+    return {
+        "presigned_url": s3_client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket_name, "Key": obfus_file_key},
+            ExpiresIn=expires_in),
+        "expires_in": expires_in,
+    }
+
+
+def missing_fields_response(columns, pii_fields, strategies=None,
+                            categorical=False):
+    """Returns the 400 response of pii fields that are not among the
+    columns of a file, or None when every field is there
+
+    Input Arguments:
+    - Column names of the file
+    - pii fields to obfuscate
+    - Optional strategy per field and categorical flag, as for
+    compile_plan
+    """
+    message = missing_fields_message(
+        columns, pii_fields, strategies, categorical)
+    if message is None:
+        return None
+    return {
+        "statusCode": 400,
+        "body": message,
+    }
+
+
+def stream_obfuscate_file(bucket_name, file_key, pii_fields, s3_client,
+                          chunk_size=DEFAULT_CHUNK_SIZE, strategies=None,
+                          hash_key=None, cache=None, categorical=False,
+                          compression=None, fingerprint=None,
+                          parquet_workers=1,
+                          json_format=DEFAULT_JSON_FORMAT, stats=None):
+    """Obfuscates a file in bounded pieces and streams the output to S3:
+    CSV in chunks of chunk_size rows, Parquet row group by row group and
+    JSON Lines in batches of chunk_size records, written as JSON Lines or
+    as a JSON array.
+
+    Input Arguments:
+    - Bucket name that contains the file to obfuscate
+    - File key to obfuscate
+    - pii fields to obfuscate
+    - boto3 s3 client
+    - Rows (CSV) or records (JSON Lines) per chunk
+    - Optional strategy per field, hash key, ValueCache and categorical
+    flag, as for obfuscate_pii
+    - Output codec, as for output_compression. Compressed CSV and JSON
+    inputs are detected from their .gz or .zst suffix.
+    - Optional output fingerprint, as for build_obfuscated_file_key
+    - Number of processes Parquet row groups are spread across
+    - JSON output format, "lines" or "array"
+    - Optional dict that receives the number of rows written and the
+    size and sha256 of the written object
+
+    Returns:
+    - s3 key of the obfuscated file, an error message, or
+    "Not JSON Lines" for JSON documents that cannot be streamed
+    """
+    file_type = get_file_type(file_key)
+    if file_type == "csv":
+        chunks = read_csv_chunks_from_s3(
+                bucket_name, file_key, s3_client, chunk_size)
+        if isinstance(chunks, str):
+            return chunks
+        return write_csv_chunks_obfuscated_file_to_s3(
+                bucket_name, file_key, chunks, pii_fields, s3_client,
+                strategies, hash_key, cache, categorical, compression,
+                fingerprint, stats)
+    if file_type == "parquet" and parquet_workers > 1:
+        return obfuscate_parquet_s3_object_parallel(
+                bucket_name, file_key, pii_fields, s3_client,
+                strategies, hash_key, cache, categorical, fingerprint,
+                parquet_workers, stats)
+    if file_type == "parquet":
+        return obfuscate_parquet_s3_object(
+                bucket_name, file_key, pii_fields, s3_client,
+                strategies, hash_key, cache, categorical, fingerprint,
+                stats)
+    return obfuscate_json_lines_s3_object(
+            bucket_name, file_key, pii_fields, s3_client, chunk_size,
+            strategies, hash_key, cache, compression, fingerprint,
+            json_format, stats)
+
+
+def partition_handler(event, s3_client):
+    """Worker side of "partitioned" mode: obfuscates the byte range in
+    the event's "fanout_part" into its part object. The coordinator has
+    validated every other key of the event; it is only reachable through
+    partition_lambda_handler.
+
+    Input Arguments:
+    - event: file event of the coordinator plus "fanout_part"
+    - boto3 s3 client
+
+    Returned Output:
+    - dictionary with statusCode, and the "part_key", "size" and "rows"
+    written on success or an error "body"
+    """
+    bucket_name, file_key, pii_fields = parse_input_json(event)
+    strategies = event.get("strategies") or {}
+    hash_key = event.get("hash_key") or os.environ.get(
+        "OBFUSCATION_HASH_KEY")
+    cache = None
+    if "hash" in strategies.values():
+        cache = ValueCache(event.get("cache_size", DEFAULT_CACHE_SIZE))
+    try:
+        result = obfuscate_partition(
+            bucket_name,
+            file_key,
+            s3_client,
+            event["fanout_part"],
+            pii_fields,
+            event.get("chunk_size", DEFAULT_CHUNK_SIZE),
+            strategies,
+            hash_key,
+            cache,
+            output_compression(file_key, event.get("compression")),
+            bool(event.get("categorical_output")))
     except Exception as e:
         return {
             "statusCode": 500,
-            "body": f"Internal server error: {e}",
+            "body": f"Error obfuscating partition: {e}",
         }
+    return {"statusCode": 200, **result}
+
+
+def list_files_to_obfuscate(prefix_uri, s3_client):
+    """Lists the csv, parquet and json files under an s3 uri prefix.
+    Files written by the obfuscator itself are skipped.
+
+    Input Arguments:
+    - s3 uri prefix, e.g. "s3://my_bucket/new_data/"
+    - boto3 s3 client
+
+    Returns:
+    - List of s3 uris of the files to obfuscate
+    """
+    bucket_name, _, prefix = prefix_uri[5:].partition("/")
+    paginator = s3_client.get_paginator("list_objects_v2")
+    uris = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            file_type = get_file_type(key)
+            if (file_type in PARSERS and not is_obfuscated_key(key) and
+                    not (file_type == "parquet" and get_compression(key))):
+                uris.append(f"s3://{bucket_name}/{key}")
+    return uris
+
+
+def batch_handler(event, s3_client):
+    """Obfuscates many files in one invocation.
+
+    Files are processed concurrently on a bounded thread pool, since the
+    work is mostly S3 I/O, and share the same s3 client and connection
+    pool. Every other event key (pii_fields, stream, json_format, ...) is
+    applied to each file as in a single file event.
+
+    Input Arguments:
+    - event: json string with the files and pii fields. e.g:
+        {
+            "files_to_obfuscate": ["s3://my_bucket/a.csv",
+                                   "s3://my_bucket/b.json"],
+            "pii_fields": ["field_1", "field_2"],
+            "max_workers": 16
+        }
+    or with "prefix_to_obfuscate": "s3://my_bucket/new_data/" to process
+    every csv, parquet and json file under the prefix. "max_workers"
+    defaults to 16 and should not exceed the client's connection pool.
+    - boto3 s3 client
+
+    Returned Output:
+    - output dictionary with keys:
+        - statusCode: 200 when every file succeeded, 207 when some failed.
+        - succeeded / failed: number of files in each state.
+        - files: manifest with "file_to_obfuscate", "statusCode" and
+        either "file_key" or "error" for each file, plus the "size" and
+        "sha256" of files obfuscated in memory or streamed. Bodies are
+        not returned for batches.
+    """
+    if "files_to_obfuscate" in event:
+        uris = event["files_to_obfuscate"]
+        if not isinstance(uris, list) or not all(
+                isinstance(uri, str) for uri in uris):
+            return {
+                "statusCode": 400,
+                "body": "files_to_obfuscate must be a list of s3 uris",
+            }
+    else:
+        prefix_uri = event["prefix_to_obfuscate"]
+        if not isinstance(prefix_uri, str) or not prefix_uri.startswith(
+                "s3://"):
+            return {
+                "statusCode": 400,
+                "body":
+                    ("Invalid S3 URI format. "
+                        "Expected format: s3://bucket_name/prefix"),
+            }
+        uris = list_files_to_obfuscate(prefix_uri, s3_client)
+    if not uris:
+        return {
+            "statusCode": 400,
+            "body": "No files found to obfuscate",
+        }
+    file_event = {k: v for k, v in event.items() if k not in BATCH_KEYS}
+    # bodies are not returned for batches, so they are never built
+    file_event["max_inline_bytes"] = -1
+    max_workers = event.get("max_workers", DEFAULT_BATCH_WORKERS)
+
+    def obfuscate_file(uri):
+        response = lambda_handler(
+            {**file_event, "file_to_obfuscate": uri},
+            None,
+            s3_client=s3_client)
+        status = {"file_to_obfuscate": uri,
+                  "statusCode": response["statusCode"]}
+        if response["statusCode"] == 200:
+            status["file_key"] = response["file_key"]
+            if response.get("skipped"):
+                status["skipped"] = True
+            if "sha256" in response:
+                status["size"] = response["size"]
+                status["sha256"] = response["sha256"]
+        else:
+            status["error"] = response["body"]
+        if "metrics" in response:
+            status["metrics"] = response["metrics"]
+        return status
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        manifest = list(pool.map(obfuscate_file, uris))
+    failed = sum(1 for status in manifest if status["statusCode"] != 200)
+    return {
+        "statusCode": 200 if failed == 0 else 207,
+        "succeeded": len(manifest) - failed,
+        "failed": failed,
+        "files": manifest,
+    }
@@ -0,0 +1,261 @@
+"""Parquet obfuscation with row groups spread across a process pool.
+
+Every worker process maps the source file. A source streamed from S3 is
+downloaded into a file in /tmp that the workers map directly; a source
+held in memory is copied once into a shared memory block first. A worker
+reads its row group from the mapping, masks the pii columns with Arrow
+and writes the result as an Arrow IPC stream into a shared memory block
+of its own, so only file and block names cross the process boundary.
+The parent maps each result in row group order, hands it to
+ParquetWriter without copying and frees the block. Blocks are mapped
+through their /dev/shm files, so this runs on Linux. At most
+2 * workers row groups are in flight, which bounds memory.
+
+Workers are started with forkserver (or spawn), never fork: the parent
+may run batch threads and boto3 connection pools, and a forked child can
+inherit a lock another thread held and deadlock on it.
+
+Where processes or shared memory are not available the row groups are
+processed serially instead. AWS Lambda has no /dev/shm, so there this
+always runs serially and "parquet_workers" has no effect.
+"""
+import multiprocessing
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils import (
+    download_s3_object,
+    build_obfuscated_file_key,
+    obfuscate_arrow_table,
+    obfuscate_parquet_row_groups,
+    parquet_output_plan,
+    S3MultipartWriter,
+    ValueCache,
+    DEFAULT_CACHE_SIZE,
+)
+
+# POSIX shared memory blocks are files here on Linux; Arrow maps them
+# itself, so no Python buffer export pins a block that is being freed
+SHARED_MEMORY_DIR = "/dev/shm"
+# start method of the worker processes, see the module docstring
+START_METHOD = ("forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn")
+# per-process cache of hashed values, kept across the row groups a
+# worker processes
+_worker_cache = None
+
+
+def _segment_path(name):
+    return os.path.join(SHARED_MEMORY_DIR, name.lstrip("/"))
+
+
+def _create_segment(size):
+    # Creates a shared memory block and returns its name; it outlives
+    # this handle until it is unlinked
+    segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    segment.close()
+    return segment.name
+
+
+def _unlink_segment(name):
+    shared_memory.SharedMemory(name=name).unlink()
+
+
+def _write_ipc(table, schema, stream):
+    with pa.ipc.new_stream(stream, schema) as writer:
+        writer.write_table(table)
+
+
+def obfuscate_row_group(source_path, index, masked_fields, output_schema,
+                        strategies=None, hash_key=None, categorical=False,
+                        cache_size=DEFAULT_CACHE_SIZE):
+    """Worker side: obfuscates one row group of a parquet file it maps
+    from a file or shared memory block
+
+    Input Arguments:
+    - Path of the file or shared memory block holding the parquet file
+    - Index of the row group
+    - Fields to obfuscate and output schema, from parquet_output_plan
+    - Optional strategy per field, hash key and categorical flag, as for
+    obfuscate_pii
+    - Entries of the worker's cache of hashed values
+
+    Returns:
+    - name of the shared memory block holding the obfuscated row group
+    as an Arrow IPC stream, and the number of rows. The caller frees the
+    block.
+    """
+    global _worker_cache
+    if _worker_cache is None and hash_key:
+        _worker_cache = ValueCache(cache_size)
+    with pa.memory_map(source_path) as source:
+        table = pq.ParquetFile(source).read_row_group(index)
+    table = obfuscate_arrow_table(
+        table, masked_fields, strategies, hash_key, _worker_cache,
+        categorical).cast(output_schema)
+    # the stream is sized first so it is written once, straight into the
+    # block
+    counter = pa.MockOutputStream()
+    _write_ipc(table, output_schema, counter)
+    name = _create_segment(counter.size())
+    try:
+        with pa.memory_map(_segment_path(name), "r+") as output:
+            _write_ipc(table, output_schema, output)
+    except BaseException:
+        _unlink_segment(name)
+        raise
+    return name, table.num_rows
+
+
+def _write_result(writer, result):
+    # Writes an obfuscated row group from its shared memory block without
+    # copying it, then frees the block
+    name, rows = result
+    try:
+        with pa.memory_map(_segment_path(name)) as source:
+            writer.write_table(pa.ipc.open_stream(source).read_all())
+    finally:
+        _unlink_segment(name)
+    return rows
+
+
+def _free_result(future):
+    # Frees the block of a row group that will not be written
+    if future.cancel() or future.exception() is not None:
+        return
+    _unlink_segment(future.result()[0])
+
+
+def obfuscate_parquet_row_groups_parallel(
+        source, pii_fields, sink, strategies=None, hash_key=None, cache=None,
+        categorical=False, workers=None, cache_size=DEFAULT_CACHE_SIZE,
+        source_path=None):
+    """Obfuscates a parquet file with its row groups spread across a
+    process pool, and writes the obfuscated row groups to the sink in
+    order. Output is the same as obfuscate_parquet_row_groups.
+
+    Falls back to obfuscate_parquet_row_groups in this process when there
+    is a single worker or row group, or when processes or shared memory
+    cannot be created (e.g. on AWS Lambda).
+
+    Input Arguments:
+    - Buffer holding the parquet file, e.g. from download_s3_object
+    - pii fields to obfuscate
+    - Binary file-like sink, e.g. S3MultipartWriter
+    - Optional strategy per field, hash key, ValueCache (used by the
+    serial fallback; each worker keeps its own) and categorical flag, as
+    for obfuscate_pii
+    - Number of worker processes (default: one per CPU)
+    - Entries of each worker's cache of hashed values
+    - Optional path of a file holding the buffer's bytes, e.g. the one it
+    was downloaded into, which workers map instead of a shared memory
+    copy of the buffer
+
+    Returns:
+    - Number of rows written
+    """
+    parquet_file = pq.ParquetFile(pa.BufferReader(pa.py_buffer(source)))
+    workers = workers or os.cpu_count() or 1
+    pool = None
+    shared = None
+    if (workers > 1 and parquet_file.num_row_groups > 1
+            and os.path.isdir(SHARED_MEMORY_DIR)):
+        try:
+            if source_path is None:
+                shared = _create_segment(len(source))
+                source_path = _segment_path(shared)
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context(START_METHOD))
+        except (OSError, NotImplementedError):
+            if shared is not None:
+                _unlink_segment(shared)
+    if pool is None:
+        return obfuscate_parquet_row_groups(
+            parquet_file, pii_fields, sink, strategies, hash_key, cache,
+            categorical)
+
+    masked_fields, output_schema = parquet_output_plan(
+        parquet_file, pii_fields, categorical)
+    rows = 0
+    pending = deque()
+    try:
+        if shared is not None:
+            with pa.memory_map(source_path, "r+") as block:
+                block.write(source)
+        with pool, pq.ParquetWriter(sink, output_schema) as writer:
+            for index in range(parquet_file.num_row_groups):
+                pending.append(pool.submit(
+                    obfuscate_row_group, source_path, index, masked_fields,
+                    output_schema, strategies, hash_key, categorical,
+                    cache_size))
+                if len(pending) >= 2 * workers:
+                    rows += _write_result(writer, pending.popleft().result())
+            while pending:
+                rows += _write_result(writer, pending.popleft().result())
+    finally:
+        for future in pending:
+            _free_result(future)
+        if shared is not None:
+            _unlink_segment(shared)
+    return rows
+
+
+def obfuscate_parquet_s3_object_parallel(
+        bucket_name, file_key, pii_fields, s3, strategies=None,
+        hash_key=None, cache=None, categorical=False, fingerprint=None,
+        workers=None, stats=None):
+    """Obfuscates a parquet file in an S3 bucket with its row groups
+    spread across a process pool and streams the result back to the
+    bucket, see obfuscate_parquet_s3_object. The source is downloaded
+    into a named file in /tmp that the workers map, so it is not copied
+    again into shared memory.
+
+    Input Arguments:
+    - Bucket name that contains the file to obfuscate
+    - File key to obfuscate - parquet file
+    - pii fields to obfuscate
+    - Boto3 s3 client
+    - Optional strategy per field, hash key, ValueCache and categorical
+    flag, as for obfuscate_pii
+    - Optional output fingerprint, as for build_obfuscated_file_key
+    - Number of worker processes (default: one per CPU)
+    - Optional dict that receives the number of rows written and the
+    size and sha256 of the written object
+
+    Returns:
+    - s3 key of the obfuscated written file
+
+    Exception:
+    - General error
+    """
+    try:
+        if file_key is None or file_key == "":
+            return "No file key provided"
+        if not file_key.endswith(".parquet"):
+            return "File key must have a .parquet extension"
+        with tempfile.NamedTemporaryFile() as spill_file:
+            try:
+                source = download_s3_object(
+                    bucket_name, file_key, s3, spill_file=spill_file)
+            except Exception as e:
+                return (f"Error reading parquet from S3: {e}")
+            obfuscated_file_key = build_obfuscated_file_key(
+                file_key, fingerprint=fingerprint)
+            with S3MultipartWriter(
+                    bucket_name, obfuscated_file_key, s3) as sink:
+                rows = obfuscate_parquet_row_groups_parallel(
+                    source, pii_fields, sink, strategies, hash_key, cache,
+                    categorical, workers, source_path=spill_file.name)
+        if stats is not None:
+            stats.update(sink.stats(), rows=rows)
+        return obfuscated_file_key
+    except Exception as e:
+        return (f"Error obfuscating parquet file in S3: {e}")
@@ -0,0 +1,109 @@
+import os
+
+from utils import get_compression
+
+# Estimated peak memory of the in-memory path as a multiple of the file
+# size: downloaded bytes, parsed frame, obfuscated columns, serialized
+# output and response body. Parquet is compressed and columnar, so it
+# expands the most when decoded into a DataFrame.
+EXPANSION_FACTORS = {"csv": 5, "json": 6, "parquet": 8}
+# Share of the function's memory the planner lets one invocation use
+MEMORY_HEADROOM = 0.8
+# Execution modes, from fastest to most frugal
+EXECUTION_MODES = ("in_memory", "streaming", "spill")
+# How each file type runs when it does not fit in memory: CSV and JSON
+# Lines are streamed off the network in chunks, Parquet needs random
+# access to its footer so it is spilled to /tmp and read row group by row
+# group. Files whose options cannot be streamed are spilled too, but are
+# then parsed whole, so for them spilling only keeps the downloaded bytes
+# out of memory.
+LARGE_FILE_MODES = {"csv": "streaming", "json": "streaming",
+                    "parquet": "spill"}
+# Typical ratio of decompressed to compressed size of text files, applied
+# on top of the expansion factor for .gz and .zst objects
+COMPRESSION_RATIOS = {"gzip": 5, "zstd": 6}
+
+
+def current_rss_bytes():
+    """Returns the resident set size of the process in bytes, or 0 where
+    /proc is not available"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def available_memory_bytes():
+    """Returns the memory an invocation can still use: a share of the
+    Lambda's configured memory (AWS_LAMBDA_FUNCTION_MEMORY_SIZE, in MB),
+    or of the machine's memory outside Lambda, minus what the process
+    already uses
+    """
+    memory_size = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    if memory_size:
+        total = int(memory_size) * 1024 * 1024
+    else:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return max(0, int(total * MEMORY_HEADROOM) - current_rss_bytes())
+
+
+def plan_execution(file_type, content_length, memory_bytes,
+                   compression=None, streamable=True):
+    """Picks how a file is obfuscated from its size, format and the
+    memory available: in memory when the estimated peak fits, otherwise
+    chunked streaming (CSV, JSON Lines) or a spill to /tmp (Parquet).
+    Slower modes return no body; streaming and Parquet spills also do not
+    run out of memory.
+
+    A file that is not streamable, because an option such as the arrow
+    CSV backend only exists in memory, is spilled instead of streamed so
+    its output has the same shape whatever its size. It is still parsed
+    whole.
+
+    Input Arguments:
+    - File type: "csv", "parquet" or "json"
+    - Size of the file in bytes, e.g. ContentLength from head_object
+    - Memory available in bytes, e.g. from available_memory_bytes
+    - Codec of the file, "gzip", "zstd" or None
+    - Whether the file can be streamed with the requested options
+
+    Returns:
+    - dictionary with "mode", "content_length", "estimated_bytes" and
+    "memory_bytes", to be recorded in the response
+    """
+    estimated_bytes = content_length * EXPANSION_FACTORS[file_type]
+    if compression is not None:
+        estimated_bytes *= COMPRESSION_RATIOS[compression]
+    mode = "in_memory"
+    if estimated_bytes > memory_bytes:
+        mode = LARGE_FILE_MODES[file_type] if streamable else "spill"
+    return {
+        "mode": mode,
+        "content_length": content_length,
+        "estimated_bytes": estimated_bytes,
+        "memory_bytes": memory_bytes,
+    }
+
+
+def plan_s3_object(bucket_name, file_key, s3, file_type, streamable=True):
+    """Plans the obfuscation of an S3 object from its head_object
+    ContentLength and the codec of its key suffix, see plan_execution
+
+    Input Arguments:
+    - Bucket name that contains the file to obfuscate
+    - File key to obfuscate
+    - Boto3 s3 client
+    - File type: "csv", "parquet" or "json"
+    - Whether the file can be streamed with the requested options
+
+    Returns:
+    - execution plan dictionary
+
+    Exception:
+    - botocore ClientError if the object cannot be read
+    """
+    head = s3.head_object(Bucket=bucket_name, Key=file_key)
+    return plan_execution(
+        file_type, head["ContentLength"], available_memory_bytes(),
+        get_compression(file_key), streamable)
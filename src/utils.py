@@ -1,9 +1,126 @@
 import boto3
 import csv
+import functools
+import hashlib
+import hmac
 import io
-from io import StringIO, BytesIO
+from io import BytesIO
+import numpy as np
 import pandas as pd
 import json
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MASK_VALUE = "***"
+# Per-field obfuscation strategies: irreversible mask, or keyed
+# HMAC-SHA256 pseudonymization that keeps equal values joinable
+STRATEGIES = ("mask", "hash")
+DEFAULT_STRATEGY = "mask"
+# Entries kept by the per-invocation cache of transformed values
+DEFAULT_CACHE_SIZE = 100_000
+DEFAULT_CHUNK_SIZE = 100_000
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+# Ranged parallel download, overridable through the Lambda environment
+DEFAULT_DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_DOWNLOAD_CONCURRENCY = 8
+# CSV parse/serialize backends: pandas, or multithreaded pyarrow.csv
+CSV_BACKENDS = ("pandas", "arrow")
+DEFAULT_CSV_BACKEND = "pandas"
+# Strings pandas read_csv reads as null by default; the arrow backend
+# reads the same ones, so both backends write the same CSV
+CSV_NULL_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+    "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a",
+    "nan", "null"]
+# JSON output shape: "lines" (JSON Lines) or "array" (one JSON array)
+JSON_FORMATS = ("lines", "array")
+DEFAULT_JSON_FORMAT = "lines"
+# S3 client tuning, overridable through the Lambda environment
+DEFAULT_MAX_POOL_CONNECTIONS = 32
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_MODE = "standard"
+# Streaming codecs for CSV and JSON files and their key suffixes, e.g.
+# "new_data/file1.csv.gz". "none" asks for uncompressed output.
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+COMPRESSION_OPTIONS = ("gzip", "zstd", "none")
+# Bytes read from the start of a csv or json file to find its header or
+# first record, and from the end of a parquet file to find its footer
+PROBE_SIZE = 1024 * 1024
+PARQUET_FOOTER_PROBE = 64 * 1024
+# Compiled obfuscation plans kept per process, one per schema and settings
+PLAN_CACHE_SIZE = 128
+# Hex digits of the output fingerprint used in content-addressed keys
+FINGERPRINT_LENGTH = 32
+OBFUSCATED_KEY_PREFIXES = {
+    "csv": "csv_files",
+    "parquet": "parq_files",
+    "json": "json_files",
+}
+
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+
+def get_s3_client(max_pool_connections=None, max_attempts=None,
+                  retry_mode=None, tcp_keepalive=None):
+    """Returns a tuned boto3 s3 client that is built once per container and
+    reused by every warm invocation, so its connection pool (and the TLS
+    connections in it) survive between invocations.
+
+    Settings not passed in are read from the environment variables
+    S3_MAX_POOL_CONNECTIONS, S3_MAX_ATTEMPTS, S3_RETRY_MODE and
+    S3_TCP_KEEPALIVE. One client is cached per distinct set of settings.
+
+    Input Arguments:
+    - Maximum number of pooled connections
+    - Maximum number of attempts per request, including the first
+    - botocore retry mode: "legacy", "standard" or "adaptive"
+    - Whether to enable TCP keep-alive on pooled connections
+
+    Returns:
+    - boto3 s3 client
+    """
+    if max_pool_connections is None:
+        max_pool_connections = int(os.environ.get(
+            "S3_MAX_POOL_CONNECTIONS", DEFAULT_MAX_POOL_CONNECTIONS))
+    if max_attempts is None:
+        max_attempts = int(os.environ.get(
+            "S3_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS))
+    if retry_mode is None:
+        retry_mode = os.environ.get("S3_RETRY_MODE", DEFAULT_RETRY_MODE)
+    if tcp_keepalive is None:
+        tcp_keepalive = os.environ.get(
+            "S3_TCP_KEEPALIVE", "true").lower() == "true"
+    settings = (max_pool_connections, max_attempts, retry_mode, tcp_keepalive)
+    with _s3_clients_lock:
+        if settings not in _s3_clients:
+            config = Config(
+                max_pool_connections=max_pool_connections,
+                retries={
+                    "total_max_attempts": max_attempts,
+                    "mode": retry_mode,
+                },
+                tcp_keepalive=tcp_keepalive)
+            _s3_clients[settings] = boto3.client("s3", config=config)
+        return _s3_clients[settings]
 
 
 def parse_input_json(input_json):
@@ -33,10 +150,14 @@ def parse_input_json(input_json):
                     not file_to_obfuscate.startswith("s3://") or
                     file_to_obfuscate.count("/") < 2):
                 return "Invalid S3 URI format", "", []
+            # parquet compresses its own pages, so only csv and json
+            # files may carry a compression suffix
+            base_key, compression = split_compression(file_to_obfuscate)
             if (
-                not (file_to_obfuscate.endswith(".csv") or
-                     file_to_obfuscate.endswith(".parquet") or
-                     file_to_obfuscate.endswith(".json"))):
+                not (base_key.endswith(".csv") or
+                     base_key.endswith(".parquet") or
+                     base_key.endswith(".json")) or
+                    (compression and base_key.endswith(".parquet"))):
                 return "", "Unsupported file type", []
             else:
                 bucket_name = file_to_obfuscate[
@@ -59,15 +180,211 @@ def parse_input_json(input_json):
         return "", "", []
 
 
-def obfuscate_pii(df, pii_fields):
+def _categorical_series(codes, categories, series):
+    # Builds a categorical column from codes (-1 for null) and categories
+    return pd.Series(
+        pd.Categorical.from_codes(codes, categories=categories),
+        index=series.index,
+        name=series.name)
+
+
+def mask_column(series, categorical=False):
+    """ Masks every non-null value of a column in one vectorised pass
+
+    Builds the masked column from a null mask and a single assignment
+    instead of calling a Python function per cell. The result (values and
+    dtype) is the same as applying
+    `lambda x: "***" if pd.notnull(x) else x` to the column.
+
+    With categorical the masked column is a pandas Categorical with the
+    single category "***", so it costs one int8 code per row instead of
+    one string object per row.
+
+    Input Arguments:
+    - Pandas series of the column to mask
+    - Whether to return a categorical column
+
+    Returns:
+    - Pandas series with non-null values replaced by "***"
+    """
+    not_null = series.notna().to_numpy()
+    if categorical and not_null.any():
+        codes = np.where(not_null, 0, -1).astype(np.int8)
+        return _categorical_series(codes, [MASK_VALUE], series)
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # apply maps categoricals over their categories only
+        return series.apply(lambda x: MASK_VALUE if pd.notnull(x) else x)
+    if not not_null.any():
+        return series.copy()
+    values = series.to_numpy(dtype=object, copy=True)
+    values[not_null] = MASK_VALUE
+    return pd.Series(values, index=series.index, name=series.name)
+
+
+def _key_bytes(hash_key):
+    if isinstance(hash_key, str):
+        return hash_key.encode("utf-8")
+    return hash_key
+
+
+def canonical_string(value):
+    """Returns the string form a pii value is hashed as, so a value gets
+    the same token whichever path parsed it: strings are kept as they are,
+    booleans are "true"/"false", and integral numbers are written without
+    a fractional part (2, 2.0 and numpy 2 are all "2")"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (bool, np.bool_)):
+        return "true" if value else "false"
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    if isinstance(value, (float, np.floating)):
+        value = float(value)
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    return str(value)
+
+
+def hash_value(value, hash_key):
+    """Returns the HMAC-SHA256 token (hex) of a value's canonical string"""
+    return hmac.new(
+        _key_bytes(hash_key),
+        canonical_string(value).encode("utf-8"),
+        hashlib.sha256).hexdigest()
+
+
+def _hash_values(values, hash_key):
+    # Keys the HMAC once and copies its state for every value, which
+    # skips re-deriving the inner and outer pads per value
+    keyed = hmac.new(_key_bytes(hash_key), digestmod=hashlib.sha256)
+    tokens = []
+    for value in values:
+        mac = keyed.copy()
+        mac.update(canonical_string(value).encode("utf-8"))
+        tokens.append(mac.hexdigest())
+    return tokens
+
+
+class ValueCache:
+    """Bounded LRU cache of transformed pii values keyed by field and
+    the value's canonical_string, shared by every chunk and batch of one
+    invocation so repeated emails, names and postcodes are transformed
+    once. Keying on the string that is hashed keeps values which compare
+    equal but hash differently (True, 1 and 1.0) apart.
+
+    Input Arguments:
+    - Maximum number of cached values; the least recently used value is
+    evicted when the cache is full
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values = OrderedDict()
+
+    def transform(self, field, values, transform):
+        """Returns the transformed version of each of the distinct values,
+        calling transform (a list -> list function) on cache misses only
+        """
+        results = [None] * len(values)
+        keys = [(field, canonical_string(value)) for value in values]
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self._values:
+                self._values.move_to_end(key)
+                results[i] = self._values[key]
+                self.hits += 1
+            else:
+                missing.append(i)
+        self.misses += len(missing)
+        if missing:
+            transformed = transform([values[i] for i in missing])
+            for i, result in zip(missing, transformed):
+                results[i] = result
+                self._values[keys[i]] = result
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+                self.evictions += 1
+        return results
+
+    def stats(self):
+        """Returns the hit, miss and eviction counters (no values)"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._values),
+            "max_size": self.max_size,
+        }
+
+
+def _transform_distinct(field, values, transform, cache=None):
+    # Transforms a list of distinct values, through the cache if given
+    if cache is None:
+        return transform(values)
+    return cache.transform(field, values, transform)
+
+
+def hash_column(series, hash_key, cache=None, categorical=False):
+    """ Pseudonymizes every non-null value of a column with a keyed
+    HMAC-SHA256 token, so equal values get equal tokens and stay joinable
+    across obfuscated datasets that share the key.
+
+    The column is factorized and only its distinct values are hashed
+    (skipping values already in the cache); the tokens are then broadcast
+    back to the rows with one take. Nulls are kept, like mask_column.
+    Values are hashed as their canonical_string.
+
+    Input Arguments:
+    - Pandas series of the column to pseudonymize
+    - Key for the HMAC, as str or bytes
+    - Optional ValueCache of tokens, keyed by the series name
+    - Whether to return a categorical column, whose categories are the
+    tokens of the distinct values
+
+    Returns:
+    - Pandas series with non-null values replaced by their tokens
+    """
+    keys = series
+    if keys.dtype == object:
+        # mixed values like 1 and 1.0 share one canonical string
+        keys = keys.map(canonical_string, na_action="ignore")
+    codes, uniques = pd.factorize(keys)
+    if len(uniques) == 0:
+        return series.copy()
+    tokens = np.array(_transform_distinct(
+        series.name,
+        [canonical_string(value) for value in uniques],
+        lambda misses: _hash_values(misses, hash_key),
+        cache), dtype=object)
+    # distinct values with the same string form share a token
+    if categorical and len(set(tokens)) == len(tokens):
+        return _categorical_series(codes, tokens, series)
+    values = series.to_numpy(dtype=object, copy=True)
+    not_null = codes != -1
+    values[not_null] = tokens[codes[not_null]]
+    return pd.Series(values, index=series.index, name=series.name)
+
+
+def obfuscate_pii(df, pii_fields, strategies=None, hash_key=None,
+                  cache=None, categorical=False):
     """ Obfuscates pii fields in a dataframe
 
     Input Arguments:
     - Dataframe of the file to obfuscate
     - pii fields to obfuscate
+    - Optional strategy per field, e.g. {"email_address": "hash"}. Fields
+    without one are masked with "***".
+    - Key for the "hash" strategy
+    - Optional ValueCache of hashed values
+    - Whether obfuscated columns are returned as pandas Categoricals
 
     Returns:
-    - Dataframe with pii fields obfuscated
+    - Dataframe with pii fields obfuscated. Fields not in the dataframe
+    are ignored; callers check them with ObfuscationPlan.missing first.
 
     Exception:
     - General error
@@ -76,14 +393,212 @@ def obfuscate_pii(df, pii_fields):
         return "no pii fields provided"
     if not isinstance(df, pd.DataFrame):
         return "no data frame provided"
-    try:
-        for field in pii_fields:
-            df[field] = df[field].apply(
-                        lambda x: "***" if pd.notnull(x) else x)
-        return df
-    except Exception as e:
+    plan = compile_plan(df.columns, pii_fields, strategies, categorical)
+    return plan.apply(df, hash_key, cache)
+
+
+def _dictionary_column(indices, dictionary):
+    # Builds a dictionary-encoded column chunk by chunk from int32 indices
+    dictionary = pa.array(dictionary, pa.string())
+    if isinstance(indices, pa.ChunkedArray):
+        return pa.chunked_array(
+            [pa.DictionaryArray.from_arrays(chunk, dictionary)
+             for chunk in indices.chunks],
+            type=pa.dictionary(pa.int32(), pa.string()))
+    return pa.DictionaryArray.from_arrays(indices, dictionary)
+
+
+def mask_arrow_column(column, dictionary=False):
+    """Masks every non-null value of an Arrow column with Arrow compute
+    kernels. Like mask_column, nulls (and NaN) are kept, a column with no
+    values is returned unchanged and masked columns become strings.
+
+    Input Arguments:
+    - Arrow array or chunked array of the column to mask
+    - Whether to return a dictionary-encoded column with the single
+    dictionary value "***"
+
+    Returns:
+    - Arrow string column with non-null values replaced by "***"
+    """
+    is_null = pc.is_null(column, nan_is_null=True)
+    if pc.all(is_null).as_py():
+        return column
+    if dictionary:
+        indices = pc.if_else(
+            is_null, pa.scalar(None, pa.int32()), pa.scalar(0, pa.int32()))
+        return _dictionary_column(indices, [MASK_VALUE])
+    return pc.if_else(
+        is_null, pa.scalar(None, pa.string()), pa.scalar(MASK_VALUE))
+
+
+def hash_arrow_column(column, hash_key, cache=None, field=None,
+                      dictionary=False):
+    """Pseudonymizes every non-null value of an Arrow column with a keyed
+    HMAC-SHA256 token. Only the distinct values are hashed, and the tokens
+    are broadcast back to the rows with Arrow compute. Values are hashed
+    as their canonical_string, like hash_column.
+
+    Input Arguments:
+    - Arrow array or chunked array of the column to pseudonymize
+    - Key for the HMAC, as str or bytes
+    - Optional ValueCache of tokens, and the field name to key it by
+    - Whether to return a dictionary-encoded column whose dictionary is
+    the tokens of the distinct values
+
+    Returns:
+    - Arrow string column with non-null values replaced by their tokens
+    """
+    if column.null_count == len(column):
+        return column
+    if pa.types.is_dictionary(column.type):
+        column = pc.cast(column, column.type.value_type)
+    uniques = pc.drop_null(pc.unique(column))
+    if pa.types.is_floating(column.type):
+        # NaN is null to pandas, so it is kept rather than hashed
+        column = pc.if_else(pc.is_nan(column), None, column)
+        uniques = pc.filter(uniques, pc.invert(pc.is_nan(uniques)))
+    tokens = pa.array(_transform_distinct(
+        field,
+        [canonical_string(value) for value in uniques.to_pylist()],
+        lambda misses: _hash_values(misses, hash_key),
+        cache), pa.string())
+    indices = pc.index_in(column, value_set=uniques)
+    if dictionary:
+        return _dictionary_column(indices, tokens)
+    return pc.take(tokens, indices)
+
+
+def obfuscate_arrow_table(table, pii_fields, strategies=None, hash_key=None,
+                          cache=None, categorical=False):
+    """Obfuscates pii fields of an Arrow table. Other columns are passed
+    through untouched; fields not in the table are ignored.
+
+    Input Arguments:
+    - Arrow table
+    - pii fields to obfuscate
+    - Optional strategy per field, as for obfuscate_pii
+    - Key for the "hash" strategy
+    - Optional ValueCache of hashed values
+    - Whether obfuscated columns are returned dictionary-encoded
+
+    Returns:
+    - Arrow table with pii fields obfuscated
+    """
+    plan = compile_plan(
+        table.schema.names, pii_fields, strategies, categorical)
+    return plan.apply_arrow(table, hash_key, cache)
+
+
+class ObfuscationPlan:
+    """Obfuscation of pii fields compiled against the columns of a file.
+    Each field is resolved once to its column position and strategy, so
+    chunks, row groups and files with the same columns are obfuscated
+    without looking fields up again. Fields the columns do not hold are
+    listed in "missing".
+
+    Input Arguments:
+    - Column names, e.g. from probe_s3_columns
+    - pii fields to obfuscate
+    - Optional strategy per field, as for obfuscate_pii
+    - Whether obfuscated columns are returned as pandas Categoricals /
+    dictionary-encoded Arrow columns
+    """
+
+    def __init__(self, columns, pii_fields, strategies=None,
+                 categorical=False):
+        strategies = strategies or {}
+        self.columns = tuple(columns)
+        positions = {}
+        for index, column in enumerate(self.columns):
+            positions.setdefault(column, index)
+        self.fields = tuple(
+            (field, positions[field],
+             strategies.get(field, DEFAULT_STRATEGY))
+            for field in pii_fields if field in positions)
+        self.missing = tuple(
+            field for field in pii_fields if field not in positions)
+        self.categorical = categorical
+
+    def matches(self, columns):
+        """Checks whether the plan was compiled for these columns"""
+        return tuple(columns) == self.columns
+
+    def apply(self, df, hash_key=None, cache=None):
+        """Obfuscates the pii columns of a dataframe with the plan's
+        columns in place and returns it
+
+        Input Arguments:
+        - Dataframe
+        - Key for the "hash" strategy
+        - Optional ValueCache of hashed values
+        """
+        for field, index, strategy in self.fields:
+            column = df.iloc[:, index]
+            if strategy == "hash":
+                column = hash_column(
+                    column, hash_key, cache, self.categorical)
+            else:
+                column = mask_column(column, self.categorical)
+            df.isetitem(index, column)
         return df
 
+    def apply_arrow(self, table, hash_key=None, cache=None):
+        """Returns an Arrow table with the plan's columns with its pii
+        columns obfuscated, see apply"""
+        for field, index, strategy in self.fields:
+            if strategy == "hash":
+                column = hash_arrow_column(
+                    table.column(index), hash_key, cache, field,
+                    self.categorical)
+            else:
+                column = mask_arrow_column(
+                    table.column(index), self.categorical)
+            table = table.set_column(index, field, column)
+        return table
+
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def _compile_plan(columns, pii_fields, strategies, categorical):
+    return ObfuscationPlan(columns, pii_fields, dict(strategies), categorical)
+
+
+def compile_plan(columns, pii_fields, strategies=None, categorical=False):
+    """Returns the ObfuscationPlan of columns and settings, compiled once
+    per process and shared by every chunk, row group and file with the
+    same schema
+
+    Input Arguments:
+    - Column names
+    - pii fields to obfuscate
+    - Optional strategy per field, as for obfuscate_pii
+    - Whether obfuscated columns are categorical
+
+    Returns:
+    - ObfuscationPlan
+    """
+    return _compile_plan(
+        tuple(columns), tuple(pii_fields),
+        tuple(sorted((strategies or {}).items())), bool(categorical))
+
+
+def missing_fields_message(columns, pii_fields, strategies=None,
+                           categorical=False):
+    """Returns the error naming the pii fields that are not among the
+    columns of a file, or None when every field is there
+
+    Input Arguments:
+    - Column names of the file
+    - pii fields to obfuscate
+    - Optional strategy per field and categorical flag, as for
+    compile_plan
+    """
+    missing = compile_plan(
+        columns, pii_fields, strategies, categorical).missing
+    if not missing:
+        return None
+    return f"Error, pii fields not found in file: {', '.join(missing)}"
+
 
 def check_s3_file_df_valid(bucket_name, file_key, df):
     """Checks if a bucket name, file key, and df are valid
@@ -111,6 +626,563 @@ def check_s3_file_df_valid(bucket_name, file_key, df):
     except Exception as e:
         return f"Error checking parameters, {e}"
 
+
+def split_compression(file_key):
+    """Splits the compression suffix off a file key,
+    e.g. ("new_data/file1.csv", "gzip") for "new_data/file1.csv.gz" and
+    ("new_data/file1.csv", None) for an uncompressed file
+    """
+    for compression, suffix in COMPRESSIONS.items():
+        if file_key.lower().endswith(suffix):
+            return file_key[:-len(suffix)], compression
+    return file_key, None
+
+
+def get_compression(file_key):
+    """Returns the codec of a file key from its suffix, "gzip" or "zstd",
+    or None for an uncompressed file"""
+    return split_compression(file_key)[1]
+
+
+def get_file_type(file_key):
+    """Returns the file type of a file key from its extension,
+    e.g. "csv" for "new_data/file1.csv" or "new_data/file1.csv.gz"
+    """
+    return split_compression(file_key)[0].rsplit(".", 1)[-1].lower()
+
+
+def output_compression(file_key, compression=None):
+    """Returns the codec the obfuscated version of a file is written with
+
+    Input Arguments:
+    - File key of the file to obfuscate
+    - Requested codec: "gzip", "zstd", "none" for uncompressed output, or
+    None to keep the codec of the input file
+
+    Returns:
+    - "gzip", "zstd" or None. Parquet output is never wrapped in a codec.
+    """
+    if get_file_type(file_key) == "parquet" or compression == "none":
+        return None
+    if compression is None:
+        return get_compression(file_key)
+    return compression
+
+
+def build_obfuscated_file_key(file_key, compression=None, fingerprint=None):
+    """Builds the key the obfuscated version of a file is written to, e.g.
+    "csv_files/20250101120000_new_data/file1_obfuscated.csv"
+
+    Input Arguments:
+    - File key of the file to obfuscate
+    - Output codec, as for output_compression
+    - Optional fingerprint from output_fingerprint, used instead of the
+    timestamp so the same source and settings always map to the same key
+
+    Returns:
+    - File key of the obfuscated file, with the suffix of its codec
+    """
+    file_type = get_file_type(file_key)
+    base_key = split_compression(file_key)[0]
+    timestamp = pd.Timestamp.now().strftime("%Y%m%d%H%M%S")
+    if fingerprint is not None:
+        timestamp = fingerprint[:FINGERPRINT_LENGTH]
+    obfuscated_file_key = base_key.replace(
+        f".{file_type}", f"_obfuscated.{file_type}")
+    codec = output_compression(file_key, compression)
+    if codec:
+        obfuscated_file_key += COMPRESSIONS[codec]
+    prefix = OBFUSCATED_KEY_PREFIXES[file_type]
+    return f"{prefix}/{timestamp}_{obfuscated_file_key}"
+
+
+def output_fingerprint(source_head, pii_fields, strategies=None,
+                       hash_key=None, options=None):
+    """Fingerprints the obfuscated output of a file from everything it
+    depends on: the source object's ETag and version, the pii fields,
+    their strategies, the hash key and the output options. Re-running an
+    unchanged file with the same settings gives the same fingerprint.
+
+    The hash key is never stored: when one is given the fingerprint is an
+    HMAC under it, otherwise a plain SHA-256.
+
+    Input Arguments:
+    - head_object response of the source object
+    - pii fields to obfuscate
+    - Optional strategy per field and hash key, as for obfuscate_pii
+    - Optional dictionary of output options, e.g. {"json_format": "lines"}
+
+    Returns:
+    - Hex digest
+    """
+    strategies = strategies or {}
+    payload = json.dumps({
+        "etag": source_head.get("ETag"),
+        "version_id": source_head.get("VersionId"),
+        "strategies": {
+            field: strategies.get(field, DEFAULT_STRATEGY)
+            for field in pii_fields},
+        "options": options or {},
+    }, sort_keys=True).encode("utf-8")
+    if hash_key:
+        return hmac.new(
+            _key_bytes(hash_key), payload, hashlib.sha256).hexdigest()
+    return hashlib.sha256(payload).hexdigest()
+
+
+def s3_object_exists(bucket_name, file_key, s3):
+    """Checks with a head_object call whether an S3 object exists
+
+    Input Arguments:
+    - Bucket name
+    - File key
+    - Boto3 s3 client
+
+    Returns:
+    - True if the object exists, False if it does not
+
+    Exception:
+    - botocore ClientError for errors other than a missing object
+    """
+    try:
+        s3.head_object(Bucket=bucket_name, Key=file_key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+def is_obfuscated_key(file_key):
+    """Checks whether a file key was written by the obfuscator,
+    e.g. "csv_files/20250101120000_file1_obfuscated.csv.gz"
+    """
+    return split_compression(file_key)[0].endswith(
+        f"_obfuscated.{get_file_type(file_key)}")
+
+
+def serialize_dataframe(df, file_type, json_format=DEFAULT_JSON_FORMAT):
+    """Serializes a dataframe once into the bytes of a csv, parquet or
+    json file. The same bytes can then be put to S3 and returned to the
+    caller without encoding the dataframe again.
+
+    The file is written into one BytesIO, whose getvalue hands its buffer
+    over without copying it; CSV rows are encoded chunk by chunk straight
+    into it rather than built as one str and encoded again.
+
+    Input Arguments:
+    - Pandas dataframe
+    - File type: "csv", "parquet" or "json"
+    - JSON shape: "lines" for JSON Lines or "array" for a JSON array
+
+    Returns:
+    - Bytes of the serialized file
+
+    Exception:
+    - General error
+    """
+    try:
+        if not isinstance(df, pd.DataFrame):
+            return "Invalid dataframe provided"
+        buffer = BytesIO()
+        if file_type == "csv":
+            df.to_csv(buffer, index=False)
+        elif file_type == "parquet":
+            df.to_parquet(buffer, engine="pyarrow", index=False)
+        elif file_type == "json":
+            if json_format not in JSON_FORMATS:
+                return f"Unsupported JSON format: {json_format}"
+            if json_format == "lines" and len(df):
+                # pandas builds the whole document as a str before writing
+                # it, so records are written in chunks of rows to keep
+                # that str small
+                for start in range(0, len(df), DEFAULT_CHUNK_SIZE):
+                    df.iloc[start:start + DEFAULT_CHUNK_SIZE].to_json(
+                        buffer, orient="records", lines=True)
+            else:
+                df.to_json(
+                    buffer, orient="records", lines=(json_format == "lines"))
+        else:
+            return f"Unsupported file type: {file_type}"
+        return buffer.getvalue()
+    except Exception as e:
+        return f"Error serializing dataframe: {e}"
+
+
+def put_obfuscated_bytes_to_s3(bucket_name, file_key, body, s3,
+                               compression=None, fingerprint=None):
+    """Writes already serialized obfuscated file bytes to an S3 bucket
+
+    Input Arguments:
+    - Bucket name of where the file to be written
+    - File key of the file that was obfuscated
+    - Bytes of the obfuscated file, e.g. from serialize_dataframe, already
+    compressed with the output codec. bytes and bytearray are sent as
+    they are and other buffers (memoryview, pyarrow Buffer) through a
+    reader over their memory, so the body is never copied.
+    - Boto3 s3 client
+    - Output codec, as for output_compression
+    - Optional output fingerprint, as for build_obfuscated_file_key
+
+    Returns:
+    - s3 key for the written file
+
+    Exception:
+    - General error
+    """
+    try:
+        if file_key is None or file_key == "":
+            return "No file key provided"
+        if bucket_name is None or bucket_name == "":
+            return "No bucket name provided"
+        if not isinstance(body, (bytes, bytearray, memoryview, pa.Buffer)):
+            return "No valid file bytes provided"
+        if not isinstance(body, (bytes, bytearray)):
+            # boto3 takes bytes, bytearray or a file-like object
+            body = pa.BufferReader(body)
+        obfuscated_file_key = build_obfuscated_file_key(
+            file_key, compression, fingerprint)
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=obfuscated_file_key,
+            Body=body)
+        return obfuscated_file_key
+    except Exception as e:
+        return (f"Error writing obfuscated file to S3: {e}")
+
+
+#######################
+# Compression
+#######################
+
+
+def decompressing_reader(source, compression):
+    """Wraps a binary file-like object, e.g. an S3 StreamingBody or a
+    pyarrow BufferReader, in a reader that decompresses it block by block
+    as it is read, so compressed files stream like uncompressed ones
+
+    Input Arguments:
+    - Binary file-like object
+    - Codec of its content: "gzip", "zstd" or None
+
+    Returns:
+    - Buffered binary reader of the decompressed content, or the source
+    itself when it is not compressed
+    """
+    if compression is None:
+        return source
+    if not isinstance(source, pa.NativeFile):
+        source = pa.PythonFile(source, mode="r")
+    return io.BufferedReader(
+        pa.CompressedInputStream(source, compression), 1024 * 1024)
+
+
+def decompress_buffer(data, compression):
+    """Returns a reader of the decompressed content of a downloaded
+    buffer, e.g. the memoryview returned by download_s3_object"""
+    return decompressing_reader(
+        pa.BufferReader(pa.py_buffer(data)), compression)
+
+
+class _CodecSink(io.RawIOBase):
+    # Forwards compressed blocks to a sink without closing it, so the sink
+    # alone decides whether an upload is completed or aborted
+    def __init__(self, sink):
+        self.sink = sink
+        self.discard = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if not self.discard:
+            self.sink.write(data)
+        return len(data)
+
+
+@contextmanager
+def compressing_writer(sink, compression):
+    """Compresses everything written to it into a binary sink, e.g. an
+    S3MultipartWriter, block by block. The codec is flushed into the sink
+    when the block succeeds; on error nothing more reaches the sink, which
+    is left open for its owner to abort.
+
+    Input Arguments:
+    - Binary sink with a write method
+    - Codec: "gzip", "zstd" or None to write to the sink as is
+
+    Returns:
+    - Binary writer
+    """
+    if compression is None:
+        yield sink
+        return
+    target = _CodecSink(sink)
+    stream = pa.CompressedOutputStream(target, compression)
+    try:
+        yield stream
+    except BaseException:
+        target.discard = True
+        stream.close()
+        raise
+    stream.close()
+
+
+def compress_bytes(data, compression):
+    """Compresses serialized file bytes in one call, or returns them as
+    they are when compression is None"""
+    if compression is None:
+        return data
+    return pa.Codec(compression).compress(data, asbytes=True)
+
+
+#######################
+# S3 ranged download
+#######################
+
+
+def _read_body_into(body, view):
+    # Reads a streaming body straight into its slot of the preallocated
+    # buffer, with no intermediate bytes per chunk
+    position = 0
+    while position < len(view):
+        read = body.readinto(
+            view[position: min(position + 1024 * 1024, len(view))])
+        if not read:
+            raise IOError("S3 body ended before the requested range")
+        position += read
+
+
+def download_s3_object(bucket_name, file_key, s3, part_size=None,
+                       max_concurrency=None, spill_to_disk=False,
+                       spill_file=None):
+    """Downloads an S3 object with parallel ranged GETs into one
+    preallocated buffer.
+
+    The first range also returns the object size, so small objects cost a
+    single request and no head_object. The remaining ranges are fetched on
+    a thread pool, each pinned to the first response's ETag so a
+    concurrent overwrite cannot mix two versions. With spill_to_disk the
+    buffer is a memory-mapped temporary file in /tmp instead of memory,
+    or the given spill_file, which other processes can then map by name.
+
+    Input Arguments:
+    - Bucket name that contains the file
+    - File key of the file to download
+    - Boto3 s3 client
+    - Bytes per ranged GET (default S3_DOWNLOAD_PART_SIZE or 8 MiB)
+    - Number of ranged GETs in flight (default S3_DOWNLOAD_CONCURRENCY
+    or 8)
+    - Whether to download into a memory-mapped file in /tmp
+    - Optional file opened for reading and writing, e.g. a
+    NamedTemporaryFile, to download into instead
+
+    Returns:
+    - memoryview over the object's bytes, to be read without copying,
+    e.g. through pyarrow.BufferReader
+
+    Exception:
+    - Errors from S3 are raised to the caller
+    """
+    if part_size is None:
+        part_size = int(os.environ.get(
+            "S3_DOWNLOAD_PART_SIZE", DEFAULT_DOWNLOAD_PART_SIZE))
+    if max_concurrency is None:
+        max_concurrency = int(os.environ.get(
+            "S3_DOWNLOAD_CONCURRENCY", DEFAULT_DOWNLOAD_CONCURRENCY))
+    try:
+        first = s3.get_object(
+            Bucket=bucket_name, Key=file_key, Range=f"bytes=0-{part_size - 1}")
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "InvalidRange":
+            raise
+        # ranged GETs on an empty object are rejected
+        s3.head_object(Bucket=bucket_name, Key=file_key)
+        return memoryview(bytearray())
+    if "ContentRange" in first:
+        total = int(first["ContentRange"].rsplit("/", 1)[1])
+    else:
+        total = first["ContentLength"]
+    if spill_file is not None and total > 0:
+        spill_file.truncate(total)
+        buffer = mmap.mmap(spill_file.fileno(), total)
+    elif spill_to_disk and total > 0:
+        with tempfile.TemporaryFile() as spill_file:
+            spill_file.truncate(total)
+            buffer = mmap.mmap(spill_file.fileno(), total)
+    else:
+        buffer = bytearray(total)
+    view = memoryview(buffer)
+    first_end = min(part_size, total)
+    _read_body_into(first["Body"], view[:first_end])
+
+    def fetch_range(start):
+        end = min(start + part_size, total)
+        response = s3.get_object(
+            Bucket=bucket_name,
+            Key=file_key,
+            Range=f"bytes={start}-{end - 1}",
+            IfMatch=first["ETag"])
+        _read_body_into(response["Body"], view[start:end])
+
+    starts = range(first_end, total, part_size)
+    if starts:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+            list(pool.map(fetch_range, starts))
+    return view
+
+
+################
+# S3 output sink
+################
+
+
+class S3MultipartWriter(io.BufferedIOBase):
+    """Binary file-like sink that streams its content to an S3 object
+    through multipart upload.
+
+    Bytes are buffered until a part is full, then the part is uploaded on
+    a background thread while the caller keeps serializing, so upload and
+    serialization overlap. At most max_pending_parts parts are in flight,
+    which bounds memory to roughly (max_pending_parts + 1) * part_size.
+    Output smaller than one part is sent with a single put_object.
+
+    Closing the writer completes the upload. Leaving a `with` block on an
+    exception, calling abort(), or garbage collecting an unclosed writer
+    aborts the multipart upload so no partial object is left behind.
+    The size and sha256 of the written bytes are tracked as they go, see
+    stats().
+
+    Input Arguments:
+    - Bucket name of where the file to be written
+    - File key to be written
+    - Boto3 s3 client
+    - Part size in bytes (raised to the 5 MiB S3 minimum)
+    - Number of parts that may be uploading at the same time
+    """
+
+    mode = "wb"
+
+    def __init__(self, bucket_name, file_key, s3,
+                 part_size=DEFAULT_PART_SIZE, max_pending_parts=2):
+        super().__init__()
+        self.bucket_name = bucket_name
+        self.file_key = file_key
+        self.s3 = s3
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.max_pending_parts = max_pending_parts
+        self.bytes_written = 0
+        self._sha256 = hashlib.sha256()
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._part_number = 0
+        self._futures = []
+        self._executor = None
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_written
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed S3MultipartWriter")
+        data = memoryview(data).cast("B")
+        self._buffer += data
+        self._sha256.update(data)
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            # the full buffer becomes the part and only the bytes past it
+            # are copied into a new buffer
+            part = self._buffer
+            self._buffer = bytearray(part[self.part_size:])
+            del part[self.part_size:]
+            self._submit_part(part)
+        return len(data)
+
+    def _submit_part(self, body):
+        if self._upload_id is None:
+            response = self.s3.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.file_key)
+            self._upload_id = response["UploadId"]
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_pending_parts)
+        pending = [f for f in self._futures if not f.done()]
+        if len(pending) >= self.max_pending_parts:
+            pending[0].result()
+        for future in self._futures:
+            if future.done():
+                # surfaces a failed part upload to the writing code
+                future.result()
+        self._part_number += 1
+        self._futures.append(self._executor.submit(
+            self._upload_part, self._part_number, body))
+
+    def _upload_part(self, part_number, body):
+        response = self.s3.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.file_key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body)
+        return {"ETag": response["ETag"], "PartNumber": part_number}
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self.s3.put_object(
+                    Bucket=self.bucket_name,
+                    Key=self.file_key,
+                    Body=self._buffer)
+            else:
+                if self._buffer:
+                    self._submit_part(self._buffer)
+                parts = [future.result() for future in self._futures]
+                self.s3.complete_multipart_upload(
+                    Bucket=self.bucket_name,
+                    Key=self.file_key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": parts})
+                self._executor.shutdown()
+        except Exception:
+            self.abort()
+            raise
+        self._buffer = bytearray()
+        super().close()
+
+    def stats(self):
+        """Returns the size and sha256 hex digest of the bytes written so
+        far, i.e. of the object once the writer is closed"""
+        return {"size": self.bytes_written, "sha256": self._sha256.hexdigest()}
+
+    def abort(self):
+        """Aborts the multipart upload and discards any buffered bytes"""
+        if self.closed:
+            return
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+        if self._upload_id is not None:
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.file_key,
+                UploadId=self._upload_id)
+        self._buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def __del__(self):
+        if not self.closed:
+            self.abort()
+
+
 #####################
 # CSV file processing
 #####################
@@ -132,15 +1204,25 @@ def read_csv_from_s3(bucket_name, file_key, s3):
     - General error exception
     """
     try:
-        obj = s3.get_object(Bucket=bucket_name, Key=file_key)
-        csv_data = obj["Body"].read().decode("utf-8")
-        csv_io = StringIO(csv_data)
-        df_csv = pd.read_csv(csv_io)
-        return df_csv
+        csv_data = download_s3_object(bucket_name, file_key, s3)
+        return read_csv_bytes(csv_data)
     except Exception as e:
         return (f"Error reading CSV from S3: {e}")
 
 
+def read_csv_bytes(csv_data, compression=None, columns=None):
+    """Parses downloaded CSV bytes into a pandas DataFrame without copying
+    them, e.g. the buffer returned by download_s3_object. Compressed
+    bytes are decompressed as they are parsed. Columns are read as
+    strings, like the chunked and streaming readers, so values such as
+    "007" or "1.50" pass through as they appear in the source. Bytes
+    without a header row, e.g. a later range of a split file, are read
+    with the given column names."""
+    return pd.read_csv(
+        decompress_buffer(csv_data, compression), dtype=str,
+        header=None if columns else "infer", names=columns)
+
+
 def write_csv_obfuscated_file_to_s3(bucket_name, file_key, df, s3):
     """ Writes the obfuscated dataframe back to an S3 bucket as a CSV file
 
@@ -164,12 +1246,8 @@ def write_csv_obfuscated_file_to_s3(bucket_name, file_key, df, s3):
             timestamp = pd.Timestamp.now().strftime("%Y%m%d%H%M%S")
             obfuscated_file_key = file_key.replace(".csv", "_obfuscated.csv")
             file_key = f"csv_files/{timestamp}_{obfuscated_file_key}"
-            csv_buffer = StringIO()
-            df.to_csv(csv_buffer, index=False)
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=file_key,
-                Body=csv_buffer.getvalue())
+            with S3MultipartWriter(bucket_name, file_key, s3) as csv_sink:
+                df.to_csv(csv_sink, index=False)
             return file_key
         else:
             return check_params
@@ -194,13 +1272,180 @@ def csv_bytestream_for_boto3_put(df_obf_csv):
         if not isinstance(df_obf_csv, pd.DataFrame) or df_obf_csv.empty:
             return "Invalid dataframe provided"
         else:
-            csv_str = df_obf_csv.to_csv(index=False)
-            csv_bytes = csv_str.encode("utf-8")
-            return csv_bytes
+            return serialize_dataframe(df_obf_csv, "csv")
     except Exception as e:
         return f"Errro converting dataframe to bytestream,{e}"
 
 
+def read_csv_arrow_from_s3(bucket_name, file_key, s3):
+    """Reads a CSV file from an S3 bucket into an Arrow table with the
+    multithreaded pyarrow.csv reader, straight from the downloaded bytes.
+
+    Every column is read as strings, so values pass through exactly as
+    they appear in the source and only the pii fields are rewritten.
+    Like read_csv_bytes, the pandas default null strings (CSV_NULL_VALUES)
+    are read as nulls and written back empty, so both backends write the
+    same bytes.
+
+    Input Arguments:
+    - bucket name that contains the file to obfuscate
+    - file key to obfuscate - csv file
+    - boto3 s3 client
+
+    Returns:
+    - Arrow table that contains file's data
+
+    Exception:
+    - General error exception
+    """
+    try:
+        csv_data = download_s3_object(bucket_name, file_key, s3)
+        return read_csv_arrow_bytes(csv_data)
+    except Exception as e:
+        return (f"Error reading CSV from S3: {e}")
+
+
+def read_csv_arrow_bytes(csv_data, compression=None):
+    """Parses downloaded CSV bytes into an Arrow table of string columns
+    with the multithreaded pyarrow.csv reader, decompressing them first
+    when a codec is given"""
+    csv_data = pa.py_buffer(csv_data)
+
+    def source():
+        reader = pa.BufferReader(csv_data)
+        if compression is None:
+            return reader
+        return pa.CompressedInputStream(reader, compression)
+
+    # the first block is enough to learn the column names
+    column_names = pcsv.open_csv(source()).schema.names
+    convert_options = pcsv.ConvertOptions(
+        column_types={name: pa.string() for name in column_names},
+        null_values=CSV_NULL_VALUES,
+        strings_can_be_null=True)
+    return pcsv.read_csv(source(), convert_options=convert_options)
+
+
+def csv_bytestream_from_arrow_table(table):
+    """Serializes an Arrow table into CSV bytes with pyarrow.csv.
+
+    Output is written unquoted, which matches pandas to_csv for values
+    without delimiters, quotes or line breaks. Tables holding such values
+    are written through pandas instead so quoting stays identical.
+
+    Input Arguments:
+    - Arrow table
+
+    Returns:
+    - CSV bytestream representation of the table
+
+    Exception:
+    - General error
+    """
+    try:
+        csv_sink = BytesIO()
+        write_options = pcsv.WriteOptions(
+            quoting_style="none", quoting_header="none")
+        try:
+            pcsv.write_csv(table, csv_sink, write_options)
+        except pa.ArrowInvalid:
+            return serialize_dataframe(table.to_pandas(), "csv")
+        return csv_sink.getvalue()
+    except Exception as e:
+        return f"Error converting table to bytestream, {e}"
+
+
+def read_csv_chunks_from_s3(
+        bucket_name, file_key, s3, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Reads a CSV file from an S3 bucket as an iterator of DataFrames,
+    each holding at most chunk_size rows.
+
+    The S3 body is parsed straight off the network stream, so only one
+    chunk is held in memory at a time. Files with a .gz or .zst suffix are
+    decompressed on the fly. Values are read as strings so every chunk
+    keeps the source formatting regardless of what the other chunks
+    contain.
+
+    Input Arguments:
+    - bucket name that contains the file to obfuscate
+    - file key to obfuscate - csv file
+    - boto3 s3 client
+    - number of rows per chunk
+
+    Returns:
+    - Iterator of pandas dataframes
+
+    Exception:
+    - General error exception
+    """
+    try:
+        obj = s3.get_object(Bucket=bucket_name, Key=file_key)
+        body = decompressing_reader(obj["Body"], get_compression(file_key))
+        return pd.read_csv(body, chunksize=chunk_size, dtype=str)
+    except Exception as e:
+        return (f"Error reading CSV from S3: {e}")
+
+
+def write_csv_chunks_obfuscated_file_to_s3(
+        bucket_name, file_key, chunks, pii_fields, s3,
+        strategies=None, hash_key=None, cache=None, categorical=False,
+        compression=None, fingerprint=None, stats=None):
+    """Obfuscates an iterator of CSV chunks and writes them to an S3 bucket
+    as a single CSV file.
+
+    Each chunk is masked, compressed if asked to, and streamed to S3
+    through multipart upload before the next one is read, so peak memory
+    depends on the chunk and part sizes and not on the file size.
+
+    Input Arguments:
+    - Bucket name of where the file to be written
+    - Obfuscated file key to be written
+    - Iterator of pandas dataframes, e.g. from read_csv_chunks_from_s3
+    - pii fields to obfuscate
+    - Boto3 s3 client
+    - Optional strategy per field, hash key, ValueCache and categorical
+    flag, as for obfuscate_pii
+    - Output codec, as for output_compression
+    - Optional output fingerprint, as for build_obfuscated_file_key
+    - Optional dict that receives the number of rows written and the
+    size and sha256 of the written object
+
+    Returns:
+    - s3 uri for the written file
+
+    Exception:
+    - General error
+    """
+    try:
+        if file_key is None or file_key == "":
+            return "No file key provided"
+        if get_file_type(file_key) != "csv":
+            return "File key must have a .csv extension"
+        if bucket_name is None or bucket_name == "":
+            return "No bucket name provided"
+        codec = output_compression(file_key, compression)
+        file_key = build_obfuscated_file_key(
+            file_key, compression, fingerprint)
+        output = S3MultipartWriter(bucket_name, file_key, s3)
+        rows = 0
+        with output, compressing_writer(output, codec) as csv_sink:
+            for i, chunk in enumerate(chunks):
+                chunk = obfuscate_pii(
+                    chunk, pii_fields, strategies, hash_key, cache,
+                    categorical)
+                # one write per chunk, so compressed output does not
+                # depend on how pandas splits its writes
+                buffer = BytesIO()
+                chunk.to_csv(buffer, index=False, header=(i == 0))
+                csv_sink.write(buffer.getbuffer())
+                rows += len(chunk)
+        if stats is not None:
+            stats.update(output.stats(), rows=rows)
+        return file_key
+    except Exception as e:
+        return (f"Error writing obfuscated file to S3:{e}")
+
+
 #######################
 # parquet file processing
 #######################
@@ -220,14 +1465,18 @@ def read_parquet_from_s3(bucket_name, file_key, s3):
     - General error exception
     """
     try:
-        obj = s3.get_object(Bucket=bucket_name, Key=file_key)
-        parquet_data = obj['Body'].read()
-        df_parquet = pd.read_parquet(io.BytesIO(parquet_data))
-        return df_parquet
+        parquet_data = download_s3_object(bucket_name, file_key, s3)
+        return read_parquet_bytes(parquet_data)
     except Exception as e:
         return (f"Error reading parquet from S3: {e}")
 
 
+def read_parquet_bytes(parquet_data):
+    """Parses downloaded parquet bytes into a pandas DataFrame without
+    copying them"""
+    return pd.read_parquet(pa.BufferReader(pa.py_buffer(parquet_data)))
+
+
 def write_parquet_obfuscated_file_to_s3(bucket_name, file_key, df, s3):
     """Writes obfuscated dataframe back to an S3 bucket as a parquet file.
 
@@ -253,15 +1502,10 @@ def write_parquet_obfuscated_file_to_s3(bucket_name, file_key, df, s3):
                                     ".parquet",
                                     "_obfuscated.parquet")
             file_key = obfuscated_file_key
-            parq_buffer = io.BytesIO()
-            df.to_parquet(parq_buffer, engine="pyarrow", index=False)
-            parq_buffer.seek(0)
             time_stamp = pd.Timestamp.now().strftime("%Y%m%d%H%M%S")
             parq_file_key = f"parq_files/{time_stamp}_{file_key}"
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=parq_file_key,
-                Body=parq_buffer.getvalue())
+            with S3MultipartWriter(bucket_name, parq_file_key, s3) as sink:
+                df.to_parquet(sink, engine="pyarrow", index=False)
             return parq_file_key
     except Exception as e:
         return (f"Error writing obfuscated parquet file to s3: {e}")
@@ -285,13 +1529,162 @@ def parquet_bytestream_for_boto3_put(df_obf_parq):
         if not isinstance(df_obf_parq, pd.DataFrame) or df_obf_parq.empty:
             return "Invalid dataframe provided"
         else:
-            buffer = BytesIO()
-            df_obf_parq.to_parquet(buffer, index=False)
-            parq_bytes = buffer.getvalue()
-            return parq_bytes
+            return serialize_dataframe(df_obf_parq, "parquet")
     except Exception as e:
         return "Error converting to bytestream, {e}"
 
+
+def _obfuscated_parquet_schema(schema, pii_fields, categorical=False):
+    # Output schema: pii fields become strings (dictionary-encoded when
+    # categorical), and the pandas metadata stored by to_parquet is updated
+    # to match so readers get object or category columns
+    field_type = pa.string()
+    if categorical:
+        field_type = pa.dictionary(pa.int32(), pa.string())
+    for field in pii_fields:
+        index = schema.get_field_index(field)
+        if index != -1:
+            schema = schema.set(index, pa.field(field, field_type))
+    metadata = dict(schema.metadata or {})
+    if b"pandas" in metadata:
+        pandas_metadata = json.loads(metadata[b"pandas"])
+        for column in pandas_metadata.get("columns", []):
+            if column.get("name") not in pii_fields:
+                continue
+            if categorical:
+                column.update(
+                    pandas_type="categorical", numpy_type="int32",
+                    metadata={"num_categories": None, "ordered": False})
+            else:
+                column.update(
+                    pandas_type="unicode", numpy_type="object", metadata=None)
+        metadata[b"pandas"] = json.dumps(pandas_metadata).encode("utf-8")
+    return schema.with_metadata(metadata)
+
+
+def _parquet_column_all_null(parquet_file, field):
+    # Reads the footer statistics only; unknown statistics count as values
+    metadata = parquet_file.metadata
+    paths = [parquet_file.schema.column(j).path
+             for j in range(metadata.num_columns)]
+    if field not in paths:
+        return False
+    index = paths.index(field)
+    null_count = 0
+    for i in range(metadata.num_row_groups):
+        statistics = metadata.row_group(i).column(index).statistics
+        if statistics is None or not statistics.has_null_count:
+            return False
+        null_count += statistics.null_count
+    return null_count == metadata.num_rows
+
+
+def parquet_output_plan(parquet_file, pii_fields, categorical=False):
+    """Works out, from the footer of a parquet file, which pii fields are
+    obfuscated and the schema of the obfuscated file. Columns with no
+    values anywhere keep their type, like mask_column.
+
+    Input Arguments:
+    - pyarrow.parquet.ParquetFile to obfuscate
+    - pii fields to obfuscate
+    - Whether obfuscated columns are dictionary-encoded
+
+    Returns:
+    - list of fields to obfuscate and the output Arrow schema
+    """
+    schema = parquet_file.schema_arrow
+    masked_fields = [
+        field for field in pii_fields
+        if field in schema.names
+        and not _parquet_column_all_null(parquet_file, field)]
+    output_schema = _obfuscated_parquet_schema(
+        schema, masked_fields, categorical)
+    return masked_fields, output_schema
+
+
+def obfuscate_parquet_row_groups(parquet_file, pii_fields, sink,
+                                 strategies=None, hash_key=None, cache=None,
+                                 categorical=False):
+    """Obfuscates a parquet file row group by row group with Arrow and
+    writes each obfuscated row group to the sink as it goes. Non-pii
+    columns never go through pandas; only one row group is held in memory.
+
+    Input Arguments:
+    - pyarrow.parquet.ParquetFile to obfuscate
+    - pii fields to obfuscate
+    - Binary file-like sink, e.g. S3MultipartWriter
+    - Optional strategy per field, hash key, ValueCache and categorical
+    flag, as for obfuscate_pii
+
+    Returns:
+    - Number of rows written
+    """
+    masked_fields, output_schema = parquet_output_plan(
+        parquet_file, pii_fields, categorical)
+    rows = 0
+    with pq.ParquetWriter(sink, output_schema) as writer:
+        for i in range(parquet_file.num_row_groups):
+            table = parquet_file.read_row_group(i)
+            table = obfuscate_arrow_table(
+                table, masked_fields, strategies, hash_key, cache,
+                categorical)
+            writer.write_table(table.cast(output_schema))
+            rows += table.num_rows
+    return rows
+
+
+def obfuscate_parquet_s3_object(bucket_name, file_key, pii_fields, s3,
+                                strategies=None, hash_key=None, cache=None,
+                                categorical=False, fingerprint=None,
+                                stats=None):
+    """Obfuscates a parquet file in an S3 bucket row group by row group and
+    streams the result back to the bucket as a parquet file.
+
+    The source is downloaded with parallel ranged GETs into a
+    memory-mapped temporary file in /tmp and read one row group at a
+    time, and the output is uploaded through multipart upload, so peak
+    memory depends on the row group size and not on the file size.
+
+    Input Arguments:
+    - Bucket name that contains the file to obfuscate
+    - File key to obfuscate - parquet file
+    - pii fields to obfuscate
+    - Boto3 s3 client
+    - Optional strategy per field, hash key, ValueCache and categorical
+    flag, as for obfuscate_pii
+    - Optional output fingerprint, as for build_obfuscated_file_key
+    - Optional dict that receives the number of rows written and the
+    size and sha256 of the written object
+
+    Returns:
+    - s3 key of the obfuscated written file
+
+    Exception:
+    - General error
+    """
+    try:
+        if file_key is None or file_key == "":
+            return "No file key provided"
+        if not file_key.endswith(".parquet"):
+            return "File key must have a .parquet extension"
+        try:
+            source = download_s3_object(
+                bucket_name, file_key, s3, spill_to_disk=True)
+        except Exception as e:
+            return (f"Error reading parquet from S3: {e}")
+        parquet_file = pq.ParquetFile(pa.BufferReader(pa.py_buffer(source)))
+        obfuscated_file_key = build_obfuscated_file_key(
+            file_key, fingerprint=fingerprint)
+        with S3MultipartWriter(bucket_name, obfuscated_file_key, s3) as sink:
+            rows = obfuscate_parquet_row_groups(
+                parquet_file, pii_fields, sink, strategies, hash_key, cache,
+                categorical)
+        if stats is not None:
+            stats.update(sink.stats(), rows=rows)
+        return obfuscated_file_key
+    except Exception as e:
+        return (f"Error obfuscating parquet file in S3: {e}")
+
 ######################
 # json file processing
 ######################
@@ -299,7 +1692,8 @@ def parquet_bytestream_for_boto3_put(df_obf_parq):
 
 def read_json_from_s3(bucket_name, file_key, s3):
     """Reads a json file from an S3 bucket and returns
-        its content as a pandas DataFrame
+        its content as a pandas DataFrame. JSON Lines files are detected
+        from their first line and read record by record.
 
     Input Arguments:
     - bucket name that contains the file to obfuscate
@@ -314,14 +1708,48 @@ def read_json_from_s3(bucket_name, file_key, s3):
     """
 
     try:
-        obj = s3.get_object(Bucket=bucket_name, Key=file_key)
-        json_data = obj["Body"].read().decode("utf-8")
-        df_json = pd.read_json(StringIO(json_data))
-        return df_json
+        json_data = download_s3_object(bucket_name, file_key, s3)
+        return read_json_bytes(json_data)
     except Exception as e:
         return (f"Error reading json from S3: {e}")
 
 
+def read_json_bytes(json_data, compression=None):
+    """Parses a JSON or JSON Lines buffer, e.g. the one returned by
+    download_s3_object or plain bytes, into a pandas DataFrame, detecting
+    JSON Lines from the first non-blank line.
+    Values keep their JSON types: strings such as "007" are not coerced
+    to numbers and date-like columns are not converted.
+
+    With orjson installed the buffer is parsed where it is, a document at
+    once or JSON Lines a line at a time, and only the parsed values are
+    built. Compressed buffers are decompressed once into an Arrow buffer
+    first. Without orjson, pd.read_json reads and decodes a copy of the
+    whole file before parsing it."""
+    lines = is_json_lines_buffer(json_data, compression)
+    if orjson is None:
+        return pd.read_json(
+            decompress_buffer(json_data, compression),
+            lines=lines,
+            dtype=False,
+            convert_dates=False)
+    if lines:
+        return pd.DataFrame([
+            orjson.loads(line)
+            for line in iter_buffer_lines(json_data, compression)
+            if line.strip()])
+    if compression is None:
+        return pd.DataFrame(orjson.loads(memoryview(json_data)))
+    # decompressed block by block into Arrow memory, since reading the
+    # whole stream at once builds it in Python memory and copies it
+    stream = pa.CompressedInputStream(
+        pa.BufferReader(pa.py_buffer(json_data)), compression)
+    document = pa.BufferOutputStream()
+    while block := stream.read_buffer(1024 * 1024):
+        document.write(block)
+    return pd.DataFrame(orjson.loads(memoryview(document.getvalue())))
+
+
 def write_json_obfuscated_file_to_s3(bucket_name, file_key, df, s3):
     """Writes obfuscated dataframe back to an S3 bucket as a json file.
 
@@ -345,12 +1773,8 @@ def write_json_obfuscated_file_to_s3(bucket_name, file_key, df, s3):
             timestamp = pd.Timestamp.now().strftime("%Y%m%d%H%M%S")
             obfuscated_file_key = file_key.replace(".json", "_obfuscated.json")
             file_key = f"json_files/{timestamp}_{obfuscated_file_key}"
-            json_buffer = StringIO()
-            df.to_json(json_buffer, orient="records", lines=True)
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=file_key,
-                Body=json_buffer.getvalue())
+            with S3MultipartWriter(bucket_name, file_key, s3) as json_sink:
+                df.to_json(json_sink, orient="records", lines=True)
             return file_key
     except Exception as e:
         return (f"Error writing obfuscated file to S3: {e}")
@@ -373,8 +1797,354 @@ def json_bytestream_for_boto3_put(df_obf_jsn):
         if not isinstance(df_obf_jsn, pd.DataFrame) or df_obf_jsn.empty:
             return "Invalid dataframe provided"
         else:
-            json_str = df_obf_jsn.to_json(orient="records", lines=False)
-            json_bytes = json_str.encode("utf-8")
-            return json_bytes
+            return serialize_dataframe(df_obf_jsn, "json", "array")
     except Exception as e:
         return f"Error converting datafram to bytestream, {e}"
+
+
+# Bytes looked at to rule out a JSON Lines record before parsing a line
+_RECORD_PEEK_SIZE = 4096
+
+
+def _json_loads(line):
+    # orjson parses each line several times faster when it is installed
+    if orjson is not None:
+        return orjson.loads(line)
+    # json only takes str and bytes, not buffers such as memoryview
+    return json.loads(bytes(line))
+
+
+def _json_dumps(record):
+    if orjson is not None:
+        return orjson.dumps(record)
+    return json.dumps(record, separators=(",", ":")).encode("utf-8")
+
+
+def iter_body_lines(body, compression):
+    """Iterates over the lines of an S3 body without their line endings,
+    decompressing it on the fly when a codec is given"""
+    if compression is None:
+        return body.iter_lines(chunk_size=1024 * 1024)
+    return (line.rstrip(b"\r\n")
+            for line in decompressing_reader(body, compression))
+
+
+def iter_buffer_lines(data, compression=None):
+    """Iterates over the lines of a downloaded buffer (bytes, bytearray,
+    mmap or memoryview) without their line endings, decompressing it on
+    the fly when a codec is given. Lines are read through a buffered
+    reader, so the buffer is not copied as a whole."""
+    return (line.rstrip(b"\r\n")
+            for line in _buffered_reader(data, compression))
+
+
+def _buffered_reader(data, compression):
+    reader = decompress_buffer(data, compression)
+    if compression is None:
+        reader = io.BufferedReader(reader, 1024 * 1024)
+    return reader
+
+
+def is_json_lines_buffer(data, compression=None):
+    """Checks whether a downloaded json buffer is JSON Lines from its first
+    non-blank line, like obfuscate_json_lines_s3_object does for a body"""
+    reader = _buffered_reader(data, compression)
+    # JSON Lines records start with "{", so e.g. a JSON array is told
+    # apart without reading what may be a file on a single line
+    if not _may_be_record(reader.peek(_RECORD_PEEK_SIZE)):
+        return False
+    first_line = next((line for line in reader if line.strip()), None)
+    return first_line is not None and is_json_lines(first_line)
+
+
+def _may_be_record(head):
+    # False when the first non-blank byte of a line rules out an object
+    head = bytes(head[:_RECORD_PEEK_SIZE]).lstrip()
+    return not head or head.startswith(b"{")
+
+
+def is_json_lines(first_line):
+    """Checks whether the first line of a json file is a JSON Lines record
+
+    A JSON Lines record is a complete JSON object on one line holding at
+    least one scalar value. Column oriented JSON documents such as
+    {"name": ["Anas", "Bob"]} only hold lists or objects, so a one line
+    document of that shape is not mistaken for a record.
+
+    Input Arguments:
+    - First line of the file, as bytes
+
+    Returns:
+    - True if the file is JSON Lines, otherwise False
+    """
+    if not _may_be_record(first_line):
+        return False
+    try:
+        record = _json_loads(first_line)
+    except Exception:
+        return False
+    return isinstance(record, dict) and any(
+        not isinstance(value, (list, dict)) for value in record.values())
+
+
+def obfuscate_json_lines(lines, pii_fields, strategies=None, hash_key=None,
+                         cache=None):
+    """Obfuscates a batch of JSON Lines records without building a
+    DataFrame. Null values are kept, like obfuscate_pii, and for the
+    "hash" strategy each distinct value in the batch is hashed once.
+
+    Input Arguments:
+    - List of JSON Lines records, as bytes
+    - pii fields to obfuscate
+    - Optional strategy per field, hash key and ValueCache, as for
+    obfuscate_pii
+
+    Returns:
+    - JSON Lines bytes of the obfuscated records
+    """
+    strategies = strategies or {}
+    records = [_json_loads(line) for line in lines]
+    for field in pii_fields:
+        present = [record for record in records
+                   if record.get(field) is not None]
+        if strategies.get(field, DEFAULT_STRATEGY) == "hash":
+            values = [canonical_string(record[field]) for record in present]
+            distinct = list(dict.fromkeys(values))
+            tokens = dict(zip(distinct, _transform_distinct(
+                field,
+                distinct,
+                lambda misses: _hash_values(misses, hash_key),
+                cache)))
+            for record, value in zip(present, values):
+                record[field] = tokens[value]
+        else:
+            for record in present:
+                record[field] = MASK_VALUE
+    return b"\n".join(_json_dumps(record) for record in records) + b"\n"
+
+
+def obfuscate_json_lines_buffer(
+        json_data, pii_fields, sink, strategies=None, hash_key=None,
+        cache=None, compression=None, batch_size=DEFAULT_CHUNK_SIZE):
+    """Obfuscates a downloaded JSON Lines buffer in batches of records
+    with obfuscate_json_lines and writes them to a binary sink, e.g. one
+    from json_records_writer. Records are never loaded into a DataFrame,
+    so the output is byte for byte what streaming, the async pipeline and
+    partitioned workers write for the same file.
+
+    Input Arguments:
+    - Buffer returned by download_s3_object
+    - pii fields to obfuscate
+    - Binary sink with a write method
+    - Optional strategy per field, hash key and ValueCache, as for
+    obfuscate_pii
+    - Codec of the buffer, "gzip", "zstd" or None
+    - Number of records per batch
+
+    Returns:
+    - Number of records written
+    """
+    lines = (line for line in iter_buffer_lines(json_data, compression)
+             if line.strip())
+    rows = 0
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            sink.write(obfuscate_json_lines(
+                batch, pii_fields, strategies, hash_key, cache))
+            rows += len(batch)
+            batch = []
+    if batch:
+        sink.write(obfuscate_json_lines(
+            batch, pii_fields, strategies, hash_key, cache))
+        rows += len(batch)
+    return rows
+
+
+class _JSONArraySink:
+    # Joins the JSON Lines batches written to it into one JSON array:
+    # records never contain raw line breaks, so each batch becomes a
+    # comma-separated run of records by replacing them. records counts
+    # the records written so far.
+    def __init__(self, sink):
+        self._sink = sink
+        self.records = 0
+
+    def write(self, lines):
+        lines = lines.rstrip(b"\n")
+        if lines:
+            self._sink.write(
+                (b"," if self.records else b"[")
+                + lines.replace(b"\n", b","))
+            self.records += lines.count(b"\n") + 1
+
+
+@contextmanager
+def json_records_writer(sink, json_format=DEFAULT_JSON_FORMAT):
+    """Writes the JSON Lines batches of obfuscate_json_lines into a binary
+    sink in the shape of json_format: as they are for "lines", or as a
+    single JSON array of records for "array", like serialize_dataframe.
+
+    Input Arguments:
+    - Binary sink with a write method
+    - JSON output format, "lines" or "array"
+
+    Returns:
+    - Binary writer
+    """
+    if json_format == "lines":
+        yield sink
+        return
+    array = _JSONArraySink(sink)
+    yield array
+    sink.write(b"]" if array.records else b"[]")
+
+
+def obfuscate_json_lines_s3_object(
+        bucket_name, file_key, pii_fields, s3, batch_size=DEFAULT_CHUNK_SIZE,
+        strategies=None, hash_key=None, cache=None, compression=None,
+        fingerprint=None, json_format=DEFAULT_JSON_FORMAT, stats=None):
+    """Obfuscates a JSON Lines file in an S3 bucket in bounded batches of
+    records and streams the result back to the bucket as JSON Lines, or
+    as a JSON array with json_format "array".
+
+    Lines are read off the S3 body stream (decompressed on the fly for
+    .gz and .zst files), parsed (with orjson when it is installed), masked
+    and written to a multipart upload batch by batch, compressed if asked
+    to, so memory stays flat however large the file is.
+
+    Input Arguments:
+    - Bucket name that contains the file to obfuscate
+    - File key to obfuscate - json file
+    - pii fields to obfuscate
+    - Boto3 s3 client
+    - Number of records per batch
+    - Optional strategy per field, hash key and ValueCache, as for
+    obfuscate_pii
+    - Output codec, as for output_compression
+    - Optional output fingerprint, as for build_obfuscated_file_key
+    - JSON output format, "lines" or "array"
+    - Optional dict that receives the number of rows written and the
+    size and sha256 of the written object
+
+    Returns:
+    - s3 key of the obfuscated written file, or "Not JSON Lines" if the
+    file is a JSON document that has to be read as a whole
+
+    Exception:
+    - General error
+    """
+    try:
+        obj = s3.get_object(Bucket=bucket_name, Key=file_key)
+    except Exception as e:
+        return (f"Error reading json from S3: {e}")
+    try:
+        lines = (line for line in iter_body_lines(
+            obj["Body"], get_compression(file_key)) if line.strip())
+        first_line = next(lines, None)
+        if first_line is None or not is_json_lines(first_line):
+            obj["Body"].close()
+            return "Not JSON Lines"
+        codec = output_compression(file_key, compression)
+        obfuscated_file_key = build_obfuscated_file_key(
+            file_key, compression, fingerprint)
+        output = S3MultipartWriter(bucket_name, obfuscated_file_key, s3)
+        with output, compressing_writer(output, codec) as compressed, \
+                json_records_writer(compressed, json_format) as sink:
+            rows = 0
+            batch = [first_line]
+            for line in lines:
+                batch.append(line)
+                if len(batch) >= batch_size:
+                    sink.write(obfuscate_json_lines(
+                        batch, pii_fields, strategies, hash_key, cache))
+                    rows += len(batch)
+                    batch = []
+            if batch:
+                sink.write(obfuscate_json_lines(
+                    batch, pii_fields, strategies, hash_key, cache))
+                rows += len(batch)
+        if stats is not None:
+            stats.update(output.stats(), rows=rows)
+        return obfuscated_file_key
+    except Exception as e:
+        return (f"Error writing obfuscated file to S3: {e}")
+
+
+#######################
+# Schema probe
+#######################
+
+
+def _probe_first_line(bucket_name, file_key, s3):
+    # First line of a csv or json file, or None if it is longer than
+    # PROBE_SIZE. Compressed files are read off the stream, which is
+    # closed after the first line.
+    compression = get_compression(file_key)
+    if compression is None:
+        data = s3.get_object(
+            Bucket=bucket_name, Key=file_key,
+            Range=f"bytes=0-{PROBE_SIZE - 1}")["Body"].read()
+        end = data.find(b"\n")
+        if end == -1 and len(data) >= PROBE_SIZE:
+            return None
+        line = data if end == -1 else data[:end]
+    else:
+        body = s3.get_object(Bucket=bucket_name, Key=file_key)["Body"]
+        try:
+            line = decompressing_reader(body, compression).readline(
+                PROBE_SIZE + 1)
+        finally:
+            body.close()
+        if len(line) > PROBE_SIZE:
+            return None
+    return line.rstrip(b"\r\n")
+
+
+def _probe_parquet_columns(bucket_name, file_key, s3):
+    # A parquet file ends with its footer, its 4 byte length and "PAR1";
+    # the footer alone, behind the leading magic, reads as a schema
+    tail = s3.get_object(
+        Bucket=bucket_name, Key=file_key,
+        Range=f"bytes=-{PARQUET_FOOTER_PROBE}")["Body"].read()
+    footer_length = int.from_bytes(tail[-8:-4], "little") + 8
+    if footer_length > len(tail):
+        tail = s3.get_object(
+            Bucket=bucket_name, Key=file_key,
+            Range=f"bytes=-{footer_length}")["Body"].read()
+    return pq.read_schema(
+        pa.BufferReader(b"PAR1" + tail[-footer_length:])).names
+
+
+def probe_s3_columns(bucket_name, file_key, s3, file_type=None):
+    """Reads the column names of a file in S3 without downloading it: the
+    header of a csv file, the keys of the first record of a JSON Lines
+    file or the schema in the footer of a parquet file, with one or two
+    small ranged GETs. Compressed files are decompressed as they are read.
+
+    Input Arguments:
+    - Bucket name
+    - File key
+    - Boto3 s3 client
+    - File type: "csv", "parquet" or "json" (default: from the key)
+
+    Returns:
+    - list of column names, or None if they cannot be told from the
+    start of the file, e.g. for JSON documents
+
+    Exception:
+    - botocore ClientError if the object cannot be read, or a pyarrow
+    error if the parquet footer is not valid
+    """
+    file_type = file_type or get_file_type(file_key)
+    if file_type == "parquet":
+        return _probe_parquet_columns(bucket_name, file_key, s3)
+    first_line = _probe_first_line(bucket_name, file_key, s3)
+    if first_line is None:
+        return None
+    if file_type == "csv":
+        return next(csv.reader([first_line.decode("utf-8-sig")]), [])
+    if not is_json_lines(first_line):
+        return None
+    return list(_json_loads(first_line.strip()))
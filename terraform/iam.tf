@@ -32,6 +32,8 @@ data "aws_iam_policy_document" "obfuscate_s3_policy" {
     sid = "1"
 
     actions = ["s3:PutObject",
+      "s3:DeleteObject",
+      "s3:AbortMultipartUpload",
       "s3:Get*",
       "s3:List*",
       "s3:Describe*",
@@ -40,6 +42,14 @@ data "aws_iam_policy_document" "obfuscate_s3_policy" {
     resources = ["*"
     ]
   }
+
+  # partitioned mode invokes the fan-out worker function
+  statement {
+    sid = "2"
+
+    actions   = ["lambda:InvokeFunction"]
+    resources = [aws_lambda_function.obfuscation_partition_worker.arn]
+  }
 }
 
 
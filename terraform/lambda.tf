@@ -16,6 +16,19 @@ resource "aws_lambda_function" "obfuscation_lambda" {
   source_code_hash = data.archive_file.lambda_zip.output_base64sha256
   memory_size   = 256
   timeout       = var.default_timeout
+  # tuning for the s3 client shared across warm invocations
+  environment {
+    variables = {
+      S3_MAX_POOL_CONNECTIONS = "32"
+      S3_MAX_ATTEMPTS         = "3"
+      S3_RETRY_MODE           = "standard"
+      S3_TCP_KEEPALIVE        = "true"
+      S3_DOWNLOAD_PART_SIZE   = "8388608"
+      S3_DOWNLOAD_CONCURRENCY = "8"
+      # partitioned mode invokes this function for its workers
+      OBFUSCATION_WORKER_FUNCTION = aws_lambda_function.obfuscation_partition_worker.function_name
+    }
+  }
   # panda layer from external source 
   layers = [
     "arn:aws:lambda:us-east-1:336392948345:layer:AWSSDKPandas-Python311:23"
@@ -27,6 +40,36 @@ resource "aws_lambda_function" "obfuscation_lambda" {
 }
 
 
+# Creates the fan-out worker of partitioned mode. It has its own entry
+# point, so worker events are never accepted from the public handler,
+# and only the obfuscation role may invoke it.
+resource "aws_lambda_function" "obfuscation_partition_worker" {
+  function_name = "obfuscation_partition_worker"
+  handler       = "obfuscation_lambda.partition_lambda_handler"
+  runtime       = var.python_runtime
+  role          = aws_iam_role.obfuscate_lambda_role.arn
+  filename      = data.archive_file.lambda_zip.output_path
+  source_code_hash = data.archive_file.lambda_zip.output_base64sha256
+  memory_size   = 256
+  timeout       = var.default_timeout
+  environment {
+    variables = {
+      S3_MAX_POOL_CONNECTIONS = "32"
+      S3_MAX_ATTEMPTS         = "3"
+      S3_RETRY_MODE           = "standard"
+      S3_TCP_KEEPALIVE        = "true"
+    }
+  }
+  layers = [
+    "arn:aws:lambda:us-east-1:336392948345:layer:AWSSDKPandas-Python311:23"
+  ]
+  tags      = {
+    Name        = "gdpr-obfuscate-${var.environment}"
+    Environment = var.environment
+  }
+}
+
+
 # Creates s3 bucket for lambda code
 resource "aws_s3_bucket" "code_bucket" {
   bucket_prefix = "gdpr-obfuscate-code-"
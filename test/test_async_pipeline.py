@@ -0,0 +1,168 @@
+import asyncio
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pytest
+import sys
+import threading
+from io import BytesIO
+from moto import mock_aws
+
+sys.path.append("src/")
+from async_pipeline import (
+    run_pipeline,
+    run_stream_obfuscate_file,
+    download_s3_object_async,
+    put_obfuscated_bytes_to_s3_async,
+)
+from obfuscation_lambda import lambda_handler, stream_obfuscate_file
+
+
+# Creates Boto3 s3 mock client
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        yield s3
+
+
+# Tests for the three stage pipeline
+class TestRunPipeline:
+    def test_run_pipeline_keeps_order(self):
+        # Tests chunks are transformed and written in order
+
+        written = []
+        count = asyncio.run(run_pipeline(
+            iter(range(10)), lambda x: x * 2, written.append))
+        assert count == 10
+        assert written == [x * 2 for x in range(10)]
+
+    def test_run_pipeline_prefetches_next_chunk(self):
+        # Tests the next chunk is read while the current one is processed
+
+        next_chunk_read = threading.Event()
+
+        def chunks():
+            yield 1
+            next_chunk_read.set()
+            yield 2
+
+        def transform(chunk):
+            if chunk == 1:
+                # only returns if chunk 2 is read in the meantime
+                assert next_chunk_read.wait(timeout=5)
+            return chunk
+
+        written = []
+        asyncio.run(run_pipeline(chunks(), transform, written.append))
+        assert written == [1, 2]
+
+    def test_run_pipeline_raises_stage_error(self):
+        # Tests a failing stage stops the pipeline with its own error
+
+        written = []
+        earlier_chunks_written = threading.Event()
+
+        def transform(chunk):
+            if chunk == 3:
+                # fails once the chunks before it are written, since the
+                # failure cancels the writer wherever it is
+                assert earlier_chunks_written.wait(timeout=5)
+                raise ValueError("bad chunk")
+            return chunk
+
+        def write(chunk):
+            written.append(chunk)
+            if chunk == 2:
+                earlier_chunks_written.set()
+
+        with pytest.raises(ValueError, match="bad chunk"):
+            asyncio.run(run_pipeline(
+                iter(range(100)), transform, write, prefetch=1))
+        assert written == [0, 1, 2]
+
+    def test_async_s3_helpers(self, s3_client):
+        # Tests the thread-offloaded read and write helpers
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        s3_client.put_object(Bucket="test-bucket", Key="a.csv", Body=b"a\n1\n")
+
+        async def roundtrip():
+            data = await download_s3_object_async(
+                "test-bucket", "a.csv", s3_client)
+            return await put_obfuscated_bytes_to_s3_async(
+                "test-bucket", "a.csv", bytes(data), s3_client)
+
+        key = asyncio.run(roundtrip())
+        obj = s3_client.get_object(Bucket="test-bucket", Key=key)
+        assert obj["Body"].read() == b"a\n1\n"
+
+
+# Tests for the async streaming path
+class TestStreamObfuscateFileAsync:
+    @pytest.mark.parametrize("file_key", ["test.csv", "test.json",
+                                          "test.parquet", "test.csv.gz",
+                                          "test.json.zst"])
+    def test_async_matches_sync_stream(self, s3_client, file_key):
+        # Tests the async pipeline writes the same file as the sync path
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        df = pd.DataFrame({
+            "name": [f"name_{i}" if i % 3 else None for i in range(50)],
+            "email_address": [f"user_{i % 7}@example.com" for i in range(50)],
+            "age": range(50),
+        })
+        file_type, _, suffix = file_key[5:].partition(".")
+        if file_type == "csv":
+            body = df.to_csv(index=False).encode("utf-8")
+        elif file_type == "json":
+            body = df.to_json(orient="records", lines=True).encode("utf-8")
+        else:
+            body = df.to_parquet(index=False, row_group_size=10)
+        if suffix:
+            codec = {"gz": "gzip", "zst": "zstd"}[suffix]
+            body = pa.Codec(codec).compress(body, asbytes=True)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=body)
+        args = (bucket_name, file_key, ["name", "email_address"], s3_client,
+                8, {"email_address": "hash"}, "secret")
+        sync_key = stream_obfuscate_file(*args)
+        async_key = run_stream_obfuscate_file(*args, prefetch=1)
+        assert async_key.endswith(file_key.replace(".", "_obfuscated.", 1))
+        sync_obj = s3_client.get_object(Bucket=bucket_name, Key=sync_key)
+        async_obj = s3_client.get_object(Bucket=bucket_name, Key=async_key)
+        assert async_obj["Body"].read() == sync_obj["Body"].read()
+
+    def test_async_no_file(self, s3_client):
+        # Tests a missing source is reported as a read error
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        result = run_stream_obfuscate_file(
+            "test-bucket", "missing.parquet", ["name"], s3_client)
+        assert result.startswith("Error reading parquet from S3")
+
+    def test_lambda_handler_async_io(self, s3_client):
+        # Tests the handler drives the async pipeline when asked to
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        csv_data = ("name,email_address,age\n"
+                    "Anas,anas@example.com,22\n"
+                    "Bob,bob@example.com,21\n")
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=csv_data)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "stream": True,
+            "async_io": True,
+            "chunk_size": 1,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        obfus_file_key = response["file_key"].replace(
+            f"s3://{bucket_name}/", "")
+        obj = s3_client.get_object(Bucket=bucket_name, Key=obfus_file_key)
+        df_obfuscated = pd.read_csv(BytesIO(obj["Body"].read()))
+        assert df_obfuscated["name"].tolist() == ["***", "***"]
+        assert df_obfuscated["age"].tolist() == [22, 21]
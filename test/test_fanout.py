@@ -0,0 +1,367 @@
+import boto3
+import json
+import pandas as pd
+import pyarrow as pa
+import pytest
+import sys
+from io import BytesIO
+from moto import mock_aws
+
+sys.path.append("src/")
+from fanout import (
+    plan_partitions,
+    read_first_line,
+    stitch_parts,
+    LambdaInvoker,
+)
+from obfuscation_lambda import (
+    lambda_handler,
+    partition_lambda_handler,
+    default_invoker,
+)
+from utils import MIN_PART_SIZE
+
+
+# Creates Boto3 s3 mock client
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        yield s3
+
+
+def make_dataframe(rows=300):
+    return pd.DataFrame({
+        "name": [f"name_{i}" if i % 7 else None for i in range(rows)],
+        "email_address": [f"user_{i % 11}@example.com" for i in range(rows)],
+        "age": range(rows),
+    })
+
+
+def output_bytes(s3_client, bucket_name, response):
+    obj = s3_client.get_object(
+        Bucket=bucket_name,
+        Key=response["file_key"].replace(f"s3://{bucket_name}/", ""))
+    return obj["Body"].read()
+
+
+# Tests for splitting objects into line-aligned ranges
+class TestPlanPartitions:
+    def test_plan_partitions_on_line_boundaries(self, s3_client):
+        # Tests ranges start after a line break and cover the data
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        data = b"name,age\n" + b"".join(
+            b"name_%d,%d\n" % (i, i) for i in range(500))
+        s3_client.put_object(Bucket="test-bucket", Key="a.csv", Body=data)
+        header, data_start = read_first_line(
+            "test-bucket", "a.csv", s3_client, len(data))
+        assert header == b"name,age"
+        assert data_start == len(b"name,age\n")
+        partitions = plan_partitions(
+            "test-bucket", "a.csv", s3_client, len(data), data_start, 1000)
+        assert len(partitions) > 3
+        assert partitions[0][0] == data_start
+        assert partitions[-1][1] == len(data)
+        for (_, end), (start, _) in zip(partitions, partitions[1:]):
+            assert end == start
+            assert data[start - 1:start] == b"\n"
+
+    def test_read_first_line_too_long(self, s3_client, monkeypatch):
+        # Tests a first line longer than the limit is not split
+
+        monkeypatch.setattr("fanout.MAX_FIRST_LINE", 100)
+        s3_client.create_bucket(Bucket="test-bucket")
+        data = json.dumps({"name": ["x" * 10] * 50}).encode()
+        s3_client.put_object(Bucket="test-bucket", Key="a.json", Body=data)
+        assert read_first_line(
+            "test-bucket", "a.json", s3_client, len(data)) == (None, None)
+
+
+# Tests for stitching parts with upload_part_copy
+class TestStitchParts:
+    def test_stitch_parts_copies_large_parts(self, s3_client):
+        # Tests large parts are copied and small ones merged
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        bodies = [b"a" * (MIN_PART_SIZE + 1), b"b" * (MIN_PART_SIZE + 2),
+                  b"c" * 10, b"d" * 20]
+        parts = []
+        for i, body in enumerate(bodies):
+            s3_client.put_object(
+                Bucket="test-bucket", Key=f"parts/{i}", Body=body)
+            parts.append((f"parts/{i}", len(body)))
+        copied = stitch_parts("test-bucket", "out.csv", parts, s3_client)
+        assert copied == 2
+        obj = s3_client.get_object(Bucket="test-bucket", Key="out.csv")
+        assert obj["Body"].read() == b"".join(bodies)
+
+    def test_stitch_parts_merges_small_parts(self, s3_client):
+        # Tests a small part before a large one is merged into it
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        bodies = [b"a" * 10, b"b" * (MIN_PART_SIZE + 1), b"c" * 10]
+        parts = []
+        for i, body in enumerate(bodies):
+            s3_client.put_object(
+                Bucket="test-bucket", Key=f"parts/{i}", Body=body)
+            parts.append((f"parts/{i}", len(body)))
+        copied = stitch_parts("test-bucket", "out.csv", parts, s3_client)
+        assert copied == 0
+        obj = s3_client.get_object(Bucket="test-bucket", Key="out.csv")
+        assert obj["Body"].read() == b"".join(bodies)
+
+
+# Tests for the partitioned mode of the lambda handler
+class TestPartitionedHandler:
+    @pytest.mark.parametrize("file_key", ["test.csv", "test.json"])
+    def test_partitioned_matches_stream(self, s3_client, file_key):
+        # Tests fan-out output is the same as the streaming output
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        df = make_dataframe()
+        if file_key.endswith(".csv"):
+            body = df.to_csv(index=False)
+        else:
+            body = df.to_json(orient="records", lines=True)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=body)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "strategies": {"email_address": "hash"},
+            "hash_key": "secret",
+            "chunk_size": 50,
+        }
+        streamed = lambda_handler(
+            {**input_event, "stream": True}, None, s3_client=s3_client)
+        response = lambda_handler(
+            {**input_event, "partitioned": True, "partition_size": 1000,
+             "fanout_workers": 4},
+            None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert response["partitions"] > 3
+        assert output_bytes(s3_client, bucket_name, response) == (
+            output_bytes(s3_client, bucket_name, streamed))
+        keys = [obj["Key"] for obj in s3_client.list_objects_v2(
+            Bucket=bucket_name)["Contents"]]
+        assert not [key for key in keys if ".parts/" in key]
+
+    def test_json_lines_output_is_the_same_in_every_mode(self, s3_client):
+        # Tests in-memory, streaming, async and partitioned runs write the
+        # same bytes for JSON Lines, floats and escaped slashes included
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        records = [
+            {"name": f"name_{i}", "email_address": f"user_{i % 5}@x.com",
+             "score": 2.0, "n": 3, "ratio": 0.5, "url": "http://x/y",
+             "city": "Zürich", "tag": None}
+            for i in range(200)]
+        body = "\n".join(
+            json.dumps(record, ensure_ascii=False) for record in records)
+        s3_client.put_object(
+            Bucket=bucket_name, Key="test.json", Body=body.encode())
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/test.json",
+            "pii_fields": ["name", "email_address"],
+            "strategies": {"email_address": "hash"},
+            "hash_key": "secret",
+            "chunk_size": 50,
+        }
+        outputs = []
+        for options in (
+                {"stream": False},
+                {"stream": True},
+                {"stream": True, "async_io": True},
+                {"partitioned": True, "partition_size": 5000}):
+            response = lambda_handler(
+                {**input_event, **options}, None, s3_client=s3_client)
+            assert response["statusCode"] == 200
+            outputs.append(output_bytes(s3_client, bucket_name, response))
+        assert all(output == outputs[0] for output in outputs)
+        first = outputs[0].split(b"\n")[0]
+        assert b'"score":2.0,"n":3,' in first
+        assert b'"url":"http://x/y"' in first
+
+    def test_partitioned_compressed_output(self, s3_client):
+        # Tests compressed parts concatenate into one valid file
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        df = make_dataframe()
+        s3_client.put_object(
+            Bucket=bucket_name, Key="test.csv", Body=df.to_csv(index=False))
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/test.csv",
+            "pii_fields": ["name", "email_address"],
+            "partitioned": True,
+            "partition_size": 1000,
+        }
+        plain = lambda_handler(input_event, None, s3_client=s3_client)
+        packed = lambda_handler(
+            {**input_event, "compression": "gzip"}, None,
+            s3_client=s3_client)
+        assert packed["file_key"].endswith("_obfuscated.csv.gz")
+        data = output_bytes(s3_client, bucket_name, packed)
+        reader = pa.CompressedInputStream(pa.BufferReader(data), "gzip")
+        assert reader.read() == output_bytes(s3_client, bucket_name, plain)
+
+    def test_partitioned_json_document_falls_back(self, s3_client):
+        # Tests json documents are obfuscated without fan-out
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        data = {"name": ["Anas", "Bob"], "email_address": ["a@b", "c@d"]}
+        s3_client.put_object(
+            Bucket=bucket_name, Key="test.json", Body=json.dumps(data))
+        response = lambda_handler({
+            "file_to_obfuscate": f"s3://{bucket_name}/test.json",
+            "pii_fields": ["name", "email_address"],
+            "partitioned": True,
+            "partition_size": 10,
+        }, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert "partitions" not in response
+        df_obfuscated = pd.read_json(BytesIO(response["body"]), lines=True)
+        assert all(df_obfuscated["name"] == "***")
+
+    def test_partitioned_worker_failure(self, s3_client):
+        # Tests a failed worker fails the file and leaves no parts behind
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name, Key="test.csv",
+            Body=make_dataframe().to_csv(index=False))
+
+        def invoker(event):
+            if event["fanout_part"]["index"] == 1:
+                return {"statusCode": 500, "body": "worker timed out"}
+            return partition_lambda_handler(event, None, s3_client=s3_client)
+
+        response = lambda_handler({
+            "file_to_obfuscate": f"s3://{bucket_name}/test.csv",
+            "pii_fields": ["name", "email_address"],
+            "partitioned": True,
+            "partition_size": 1000,
+        }, None, s3_client=s3_client, invoker=invoker)
+        assert response["statusCode"] == 400
+        keys = [obj["Key"] for obj in s3_client.list_objects_v2(
+            Bucket=bucket_name)["Contents"]]
+        assert keys == ["test.csv"]
+
+    def test_partitioned_categorical_matches_stream(self, s3_client):
+        # Tests workers honour categorical_output like the streaming path
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name, Key="test.csv",
+            Body=make_dataframe().to_csv(index=False))
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/test.csv",
+            "pii_fields": ["name", "email_address"],
+            "categorical_output": True,
+        }
+        streamed = lambda_handler(
+            {**input_event, "stream": True}, None, s3_client=s3_client)
+        response = lambda_handler(
+            {**input_event, "partitioned": True, "partition_size": 1000},
+            None, s3_client=s3_client)
+        assert response["partitions"] > 1
+        assert output_bytes(s3_client, bucket_name, response) == (
+            output_bytes(s3_client, bucket_name, streamed))
+
+    @pytest.mark.parametrize("file_key,option", [
+        ("test.json", {"json_format": "array"}),
+        ("test.csv", {"csv_backend": "arrow"}),
+    ])
+    def test_partitioned_rejects_unsupported_options(
+            self, s3_client, file_key, option):
+        # Tests options workers cannot honour are rejected
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        df = make_dataframe()
+        if file_key.endswith(".csv"):
+            body = df.to_csv(index=False)
+        else:
+            body = df.to_json(orient="records", lines=True)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=body)
+        response = lambda_handler({
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "partitioned": True,
+            "partition_size": 1000,
+            **option,
+        }, None, s3_client=s3_client)
+        assert response["statusCode"] == 400
+        assert "partitioned mode" in response["body"].lower()
+
+    def test_public_handler_rejects_worker_events(self, s3_client):
+        # Tests a fanout_part in a public event writes nothing
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name, Key="test.csv",
+            Body=make_dataframe().to_csv(index=False))
+        response = lambda_handler({
+            "file_to_obfuscate": f"s3://{bucket_name}/test.csv",
+            "pii_fields": ["name", "email_address"],
+            "fanout_part": {
+                "start": 0, "end": 100, "index": 0,
+                "part_key": "elsewhere/out.csv", "file_type": "csv",
+                "header": ["name", "email_address", "age"]},
+        }, None, s3_client=s3_client)
+        assert response["statusCode"] == 400
+        keys = [obj["Key"] for obj in s3_client.list_objects_v2(
+            Bucket=bucket_name)["Contents"]]
+        assert keys == ["test.csv"]
+
+    def test_default_invoker_uses_worker_function(self, monkeypatch):
+        # Tests workers are invoked in the configured worker function
+
+        monkeypatch.delenv("OBFUSCATION_WORKER_FUNCTION", raising=False)
+        with pytest.raises(ValueError):
+            default_invoker(object(), None)
+        monkeypatch.setenv("OBFUSCATION_WORKER_FUNCTION", "worker")
+        monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+        invoker = default_invoker(object(), None)
+        assert isinstance(invoker, LambdaInvoker)
+        assert invoker.function_name == "worker"
+
+
+# Tests for invoking workers through the Lambda API
+class TestLambdaInvoker:
+    class FakeLambdaClient:
+        def __init__(self, response):
+            self.response = response
+            self.calls = []
+
+        def invoke(self, **kwargs):
+            self.calls.append(kwargs)
+            return self.response
+
+    def test_lambda_invoker(self):
+        # Tests worker events are sent synchronously and parsed back
+
+        client = self.FakeLambdaClient({
+            "Payload": BytesIO(b'{"statusCode": 200, "size": 3}')})
+        response = LambdaInvoker("obfuscation_lambda", client)({"a": 1})
+        assert response == {"statusCode": 200, "size": 3}
+        assert client.calls == [{
+            "FunctionName": "obfuscation_lambda",
+            "InvocationType": "RequestResponse",
+            "Payload": b'{"a": 1}',
+        }]
+
+    def test_lambda_invoker_function_error(self):
+        # Tests an unhandled worker error is returned as a failure
+
+        client = self.FakeLambdaClient({
+            "FunctionError": "Unhandled",
+            "Payload": BytesIO(b'{"errorMessage": "Task timed out"}')})
+        response = LambdaInvoker("obfuscation_lambda", client)({})
+        assert response == {"statusCode": 500, "body": "Task timed out"}
@@ -0,0 +1,88 @@
+import pytest
+import json
+import tracemalloc
+from src.metrics import (
+    PipelineMetrics,
+    peak_rss_bytes,
+    METRICS_NAMESPACE,
+)
+
+
+# Tests for stage timing and memory instrumentation
+class TestPipelineMetrics:
+    def test_stage_records_measurements(self):
+        # Tests a stage records timing, counters and memory peaks
+
+        metrics = PipelineMetrics(enabled=True, trace_memory=True)
+        with metrics.stage("parse") as stage:
+            data = [str(i) for i in range(10_000)]
+            stage.rows = len(data)
+            stage.bytes_read = 1234
+        assert [stage.name for stage in metrics.stages] == ["parse"]
+        recorded = metrics.stages[0].to_dict()
+        assert recorded["rows"] == 10_000
+        assert recorded["bytes_read"] == 1234
+        assert recorded["seconds"] >= 0
+        assert recorded["process_peak_rss_bytes"] > 0
+        assert recorded["peak_traced_bytes"] > 0
+        assert "bytes_written" not in recorded
+        assert not tracemalloc.is_tracing()
+
+    def test_stage_recorded_when_block_raises(self):
+        # Tests a failing stage is still timed
+
+        metrics = PipelineMetrics(enabled=True)
+        with pytest.raises(ValueError):
+            with metrics.stage("download"):
+                raise ValueError("no such key")
+        assert metrics.stages[0].name == "download"
+        assert metrics.stages[0].seconds is not None
+
+    def test_disabled_metrics_record_nothing(self):
+        # Tests stages are not recorded unless metrics are enabled
+
+        metrics = PipelineMetrics()
+        with metrics.stage("download") as stage:
+            stage.bytes_read = 10
+        assert metrics.stages == []
+
+    def test_to_emf(self):
+        # Tests the EMF document declares every recorded metric
+
+        metrics = PipelineMetrics(enabled=True)
+        metrics.dimensions["FileType"] = "csv"
+        with metrics.stage("download") as stage:
+            stage.bytes_read = 10
+        with metrics.stage("upload") as stage:
+            stage.bytes_written = 20
+        document = metrics.to_emf()
+        directive = document["_aws"]["CloudWatchMetrics"][0]
+        assert directive["Namespace"] == METRICS_NAMESPACE
+        assert directive["Dimensions"] == [["FileType"]]
+        assert document["FileType"] == "csv"
+        assert document["download_bytes_read"] == 10
+        assert document["upload_bytes_written"] == 20
+        units = {m["Name"]: m["Unit"] for m in directive["Metrics"]}
+        assert units["download_bytes_read"] == "Bytes"
+        assert units["upload_seconds"] == "Seconds"
+        assert units["total_seconds"] == "Seconds"
+        for metric in directive["Metrics"]:
+            assert metric["Name"] in document
+        assert isinstance(document["_aws"]["Timestamp"], int)
+
+    def test_log_prints_one_json_line(self, capsys):
+        # Tests the EMF document is logged as a single JSON line
+
+        metrics = PipelineMetrics(enabled=True)
+        with metrics.stage("parse"):
+            pass
+        document = metrics.log()
+        output = capsys.readouterr().out
+        assert output.count("\n") == 1
+        assert json.loads(output)["parse_seconds"] == document[
+            "parse_seconds"]
+
+    def test_peak_rss_bytes(self):
+        # Tests the peak RSS is reported in bytes
+
+        assert peak_rss_bytes() > 1024 * 1024
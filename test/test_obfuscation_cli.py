@@ -0,0 +1,216 @@
+import boto3
+import pandas as pd
+import json
+import pytest
+import sys
+from moto import mock_aws
+
+sys.path.append("src/")
+from obfuscation_lambda import lambda_handler
+from obfuscation_cli import (
+    main,
+    run,
+    record_offsets,
+    list_local_files,
+    obfuscated_path,
+    parse_strategies,
+    MissingFieldsError,
+)
+
+
+# Creates a directory of csv, json and parquet files
+@pytest.fixture
+def dumps(tmp_path):
+    rows = 200
+    df = pd.DataFrame({
+        "name": [f"name_{i}" if i % 7 else None for i in range(rows)],
+        "email_address": [f"user_{i}@example.com" for i in range(rows)],
+        "note": [f'line\n"{i}", NA' if i % 5 == 0 else "NA"
+                 for i in range(rows)],
+        "age": range(rows),
+    })
+    (tmp_path / "in" / "sub").mkdir(parents=True)
+    df.to_csv(tmp_path / "in" / "students.csv", index=False)
+    df.to_json(
+        tmp_path / "in" / "sub" / "students.json",
+        orient="records", lines=True)
+    df.to_parquet(tmp_path / "in" / "sub" / "students.parquet", index=False)
+    (tmp_path / "in" / "notes.txt").write_text("notes")
+    return tmp_path, df
+
+
+# Tests for splitting files into record ranges
+class TestRecordOffsets:
+    def test_record_offsets_on_line_boundaries(self):
+        # Tests ranges start after a newline and cover the whole buffer
+
+        data = b"".join(f"row_{i}\n".encode() for i in range(100))
+        offsets = record_offsets(data, 50)
+        assert offsets[0] == 0
+        assert offsets[-1] == len(data)
+        assert len(offsets) > 3
+        for offset in offsets[1:-1]:
+            assert data[offset - 1:offset] == b"\n"
+
+    def test_record_offsets_skip_quoted_newlines(self):
+        # Tests csv ranges never split a quoted value
+
+        data = b'a,b\n1,"x\n\n\n\n\n\n\n\ny"\n2,z\n'
+        offsets = record_offsets(data, 5, quoted=True)
+        assert offsets == [0, data.index(b"2,z"), len(data)]
+
+    def test_record_offsets_small_buffer(self):
+        # Tests a buffer smaller than the split size is one range
+
+        assert record_offsets(b"a\n1\n", 100) == [0, 4]
+
+
+# Tests for the local command line runner
+class TestCLI:
+    def test_list_local_files(self, dumps):
+        # Tests supported files are listed and obfuscated files skipped
+
+        tmp_path, _ = dumps
+        (tmp_path / "in" / "old_obfuscated.csv").write_text("a\n")
+        files = list_local_files([str(tmp_path / "in")])
+        assert [path.rsplit("/", 1)[-1] for _, path in files] == [
+            "students.csv", "students.json", "students.parquet"]
+
+    def test_obfuscated_path(self):
+        # Tests output paths mirror the input tree
+
+        assert obfuscated_path("in", "in/sub/a.csv", "out") == (
+            "out/sub/a_obfuscated.csv")
+        assert obfuscated_path("in", "in/sub/a.csv") == (
+            "in/sub/a_obfuscated.csv")
+
+    def test_run_splits_files_across_processes(self, dumps):
+        # Tests split files give the same output as whole files
+
+        tmp_path, df = dumps
+        pii_fields = ["name", "email_address"]
+        summary = run(
+            [str(tmp_path / "in")], pii_fields,
+            output_dir=str(tmp_path / "split"), workers=2, split_size=500,
+            progress=None)
+        run([str(tmp_path / "in")], pii_fields,
+            output_dir=str(tmp_path / "whole"), workers=1, progress=None)
+        assert summary["files"] == 3
+        assert summary["rows"] == 3 * len(df)
+        for name in ["students_obfuscated.csv",
+                     "sub/students_obfuscated.json",
+                     "sub/students_obfuscated.parquet"]:
+            split = (tmp_path / "split" / name).read_bytes()
+            assert split == (tmp_path / "whole" / name).read_bytes()
+        assert not list((tmp_path / "split").glob("**/*.part*"))
+
+        df_obfuscated = pd.read_csv(
+            tmp_path / "split" / "students_obfuscated.csv",
+            dtype=str, keep_default_na=False)
+        assert set(df_obfuscated["name"]) == {"***", ""}
+        assert set(df_obfuscated["email_address"]) == {"***"}
+        # "NA" is read as null, like the lambda reads it
+        assert df_obfuscated["note"].tolist() == [
+            "" if note == "NA" else note for note in df["note"]]
+        assert df_obfuscated["age"].tolist() == [
+            str(age) for age in df["age"]]
+        records = [
+            json.loads(line) for line in (
+                tmp_path / "split" / "sub" / "students_obfuscated.json"
+            ).read_text().splitlines()]
+        assert len(records) == len(df)
+        assert {record["email_address"] for record in records} == {"***"}
+
+    def test_main_hash_strategy(self, dumps, capsys):
+        # Tests hash strategies and the throughput summary
+
+        tmp_path, df = dumps
+        summary = main([
+            str(tmp_path / "in" / "students.csv"),
+            "--pii-fields", "name", "email_address",
+            "--strategy", "email_address=hash",
+            "--hash-key", "secret",
+            "--workers", "2",
+            "--split-size", "1000",
+        ])
+        captured = capsys.readouterr()
+        assert "Obfuscated 1 files, 200 rows" in captured.out
+        assert "[1/" in captured.err
+        df_obfuscated = pd.read_csv(summary["outputs"][0])
+        assert df_obfuscated["email_address"].nunique() == len(df)
+        assert df_obfuscated["email_address"].str.len().eq(64).all()
+
+    @pytest.mark.parametrize("name,stream", [
+        ("students.csv", False), ("students.csv", True),
+        ("sub/students.json", False), ("sub/students.json", True),
+        ("sub/students.parquet", True)])
+    def test_run_matches_lambda(self, dumps, name, stream):
+        # Tests split CLI output is byte for byte the lambda's output.
+        # Parquet row groups are obfuscated with Arrow like the lambda's
+        # streaming path.
+
+        tmp_path, df = dumps
+        pii_fields = ["name", "email_address"]
+        summary = run(
+            [str(tmp_path / "in" / name)], pii_fields,
+            output_dir=str(tmp_path / "out"), workers=2, split_size=500,
+            progress=None)
+        with mock_aws():
+            s3_client = boto3.client("s3", region_name="us-east-1")
+            s3_client.create_bucket(Bucket="test-bucket")
+            s3_client.put_object(
+                Bucket="test-bucket", Key=name,
+                Body=(tmp_path / "in" / name).read_bytes())
+            response = lambda_handler({
+                "file_to_obfuscate": f"s3://test-bucket/{name}",
+                "pii_fields": pii_fields,
+                "stream": stream,
+            }, None, s3_client=s3_client)
+            expected = s3_client.get_object(
+                Bucket="test-bucket",
+                Key=response["file_key"].replace("s3://test-bucket/", ""),
+            )["Body"].read()
+        with open(summary["outputs"][0], "rb") as output:
+            assert output.read() == expected
+
+    def test_run_missing_pii_field_message(self, dumps):
+        # Tests the CLI reports missing fields with the lambda's message
+
+        tmp_path, df = dumps
+        path = str(tmp_path / "in" / "students.csv")
+        with pytest.raises(MissingFieldsError) as error:
+            run([path], ["name", "emial"], workers=1, progress=None)
+        assert str(error.value) == (
+            f"Error, pii fields not found in file: emial ({path})")
+
+    @pytest.mark.parametrize("name", [
+        "students.csv", "sub/students.json", "sub/students.parquet",
+        "document.json"])
+    def test_run_missing_pii_field(self, dumps, name):
+        # Tests a misspelt field fails the run instead of leaking values
+
+        tmp_path, df = dumps
+        df.to_json(tmp_path / "in" / "document.json", orient="records")
+        with pytest.raises(MissingFieldsError, match="emial"):
+            run([str(tmp_path / "in" / name)], ["name", "emial"],
+                output_dir=str(tmp_path / "out"), workers=1,
+                progress=None)
+        assert not list((tmp_path / "out").glob("**/*_obfuscated.*"))
+
+    def test_main_missing_pii_field(self, dumps, capsys):
+        # Tests the missing fields are reported as a usage error
+
+        tmp_path, df = dumps
+        with pytest.raises(SystemExit):
+            main([str(tmp_path / "in" / "students.csv"),
+                  "--pii-fields", "name", "emial"])
+        assert "pii fields not found" in capsys.readouterr().err
+
+    def test_parse_strategies(self):
+        # Tests field=strategy arguments are validated
+
+        assert parse_strategies(["email_address=hash"]) == {
+            "email_address": "hash"}
+        assert parse_strategies(None) == {}
+        assert parse_strategies(["email_address=encrypt"]).startswith(
+            "Unsupported obfuscation strategy")
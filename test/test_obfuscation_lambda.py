@@ -7,6 +7,10 @@ from moto import mock_aws
 import sys
 from io import StringIO, BytesIO
 import base64
+import gzip
+import hashlib
+import pyarrow as pa
+from urllib.parse import urlparse
 
 sys.path.append("src/")
 from obfuscation_lambda import lambda_handler
@@ -79,6 +83,305 @@ class TestCSV:
         assert all(df_obfuscated["age"] == [22, 21])
         assert all(df_obfuscated["cohort"] == [2023, 2024])
 
+    def test_lambda_handler_csv_stream(self, s3_client):
+        # Tests lambda handler obfuscates csv file in chunks when streaming
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+
+        csv_data = ("name,email_address,age,cohort\n"
+                    "Anas,anas@example.com,22,2023\n"
+                    "Bob,bob@example.com,21,2024\n")
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=csv_data)
+
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "stream": True,
+            "chunk_size": 1,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert "body" not in response
+        obfus_file_key = response["file_key"].replace(
+            f"s3://{bucket_name}/", ""
+            )
+        obj = s3_client.get_object(Bucket=bucket_name, Key=obfus_file_key)
+        df_obfuscated = pd.read_csv(BytesIO(obj["Body"].read()))
+        assert obfus_file_key.endswith("_obfuscated.csv")
+        assert all(df_obfuscated["name"] == "***")
+        assert all(df_obfuscated["email_address"] == "***")
+        assert all(df_obfuscated["age"] == [22, 21])
+        assert all(df_obfuscated["cohort"] == [2023, 2024])
+
+    @pytest.mark.parametrize("csv_data", [
+        ("name,email_address,age,cohort\n"
+         "Anas,anas@example.com,22,2023\n"
+         "Bob,bob@example.com,21,2024\n"),
+        ("student_id,name,course,cohort,graduation_date,email_address\n"
+         "1234,John_Smith,Software,2024-03-31,2027-03-31,john@example.com\n"
+         "1235,,Data,2024-03-31,2027-03-31,\n"
+         "1236,\"Smith, Jane\",\"DE, \"\"evening\"\"\",,,j@example.com\n"),
+        ("name,email_address,age,score\n"
+         "Anas,a@b,22,1.50\n"
+         "Bob,,,2.0\n"
+         "Cleo,c@d,007,\n"),
+        ("name,email_address,age,note\n"
+         "Anas,a@b,NA,None\n"
+         "Bob,b@c,<NA>,null\n"),
+    ])
+    def test_lambda_handler_csv_arrow_backend(self, s3_client, csv_data):
+        # Tests arrow csv backend returns the same bytes as the pandas one
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=csv_data)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"]
+        }
+        pandas_response = lambda_handler(
+            input_event, None, s3_client=s3_client)
+        arrow_response = lambda_handler(
+            {**input_event, "csv_backend": "arrow"},
+            None,
+            s3_client=s3_client)
+        assert arrow_response["statusCode"] == 200
+        assert isinstance(arrow_response["body"], bytes)
+        assert arrow_response["body"] == pandas_response["body"]
+
+    @pytest.mark.parametrize("csv_backend", ["pandas", "arrow"])
+    def test_lambda_handler_csv_hash_strategy(self, s3_client, csv_backend):
+        # Tests hashed fields get the same token for the same value
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        csv_data = ("name,email_address,age\n"
+                    "Anas,anas@example.com,22\n"
+                    "Bob,anas@example.com,21\n")
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=csv_data)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "strategies": {"email_address": "hash"},
+            "hash_key": "secret",
+            "csv_backend": csv_backend,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        df_obfuscated = pd.read_csv(BytesIO(response["body"]))
+        assert all(df_obfuscated["name"] == "***")
+        assert df_obfuscated["email_address"].nunique() == 1
+        assert len(df_obfuscated["email_address"][0]) == 64
+        assert response["cache_stats"]["misses"] == 1
+
+    @pytest.mark.parametrize("extra", [
+        {},
+        {"csv_backend": "arrow"},
+        {"strategies": {"email_address": "hash"}, "hash_key": "secret"},
+    ])
+    def test_lambda_handler_csv_categorical_output(self, s3_client, extra):
+        # Tests categorical output gives the same csv bytes
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        csv_data = ("name,email_address,age\n"
+                    "Anas,anas@example.com,22\n"
+                    ",anas@example.com,21\n"
+                    "Bob,,20\n")
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=csv_data)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            **extra,
+        }
+        expected = lambda_handler(input_event, None, s3_client=s3_client)
+        response = lambda_handler(
+            {**input_event, "categorical_output": True},
+            None,
+            s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert response["body"] == expected["body"]
+
+    def test_lambda_handler_csv_metrics(self, s3_client, capsys):
+        # Tests stage metrics are returned and logged without data values
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        csv_data = ("name,email_address,age\n"
+                    "Anas,anas@example.com,22\n"
+                    "Bob,bob@example.com,21\n")
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=csv_data)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "metrics": True,
+            "trace_memory": True,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        metrics = response["metrics"]
+        assert metrics["FileType"] == "csv"
+        for stage in ["download", "parse", "obfuscate", "serialize",
+                      "upload"]:
+            assert metrics[f"{stage}_seconds"] >= 0
+            assert metrics[f"{stage}_peak_traced_bytes"] >= 0
+        assert metrics["download_bytes_read"] == len(csv_data)
+        assert metrics["parse_rows"] == 2
+        assert metrics["upload_bytes_written"] == len(response["body"])
+        logged = json.loads(capsys.readouterr().out)
+        assert logged == metrics
+        for value in ["Anas", "Bob", "example.com"]:
+            assert value not in json.dumps(metrics)
+
+    def test_lambda_handler_metrics_not_returned_by_default(self, s3_client):
+        # Tests metrics are opt-in
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name, Key=file_key,
+            Body="name,email_address,age\nAnas,a@b,22\n")
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert "metrics" not in response
+
+    def test_lambda_handler_plans_in_memory(self, s3_client):
+        # Tests small files are planned in memory and the plan returned
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        csv_data = "name,email_address,age\nAnas,anas@example.com,22\n"
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=csv_data)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert "body" in response
+        assert response["execution_plan"]["mode"] == "in_memory"
+        assert response["execution_plan"]["content_length"] == len(csv_data)
+
+    @pytest.mark.parametrize("file_key,body,mode", [
+        ("test.csv", "name,email_address\nAnas,anas@example.com\n",
+         "streaming"),
+        ("test.json", '{"name":"Anas","email_address":"a@b.com"}\n',
+         "streaming"),
+        ("test.parquet", None, "spill"),
+    ])
+    def test_lambda_handler_plans_large_files(
+            self, s3_client, monkeypatch, file_key, body, mode):
+        # Tests files over the memory budget are streamed or spilled
+
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "1")
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        if body is None:
+            s3_client.upload_file("students.parquet", bucket_name, file_key)
+        else:
+            s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=body)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert "body" not in response
+        assert response["execution_plan"]["mode"] == mode
+        assert response["execution_plan"]["memory_bytes"] == 0
+
+    @pytest.mark.parametrize("csv_backend,mode", [
+        ("pandas", "streaming"), ("arrow", "spill")])
+    def test_lambda_handler_plan_keeps_output(
+            self, s3_client, monkeypatch, csv_backend, mode):
+        # Tests large files are written like small ones by each backend
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name, Key="test.csv",
+            Body="name,email_address,id,score\nAnas,a@b,007,1.50\n"
+                 "Bob,,7,\n")
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/test.csv",
+            "pii_fields": ["name", "email_address"],
+            "csv_backend": csv_backend,
+        }
+        small = lambda_handler(input_event, None, s3_client=s3_client)
+        assert small["execution_plan"]["mode"] == "in_memory"
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "1")
+        large = lambda_handler(input_event, None, s3_client=s3_client)
+        assert large["execution_plan"]["mode"] == mode
+        obj = s3_client.get_object(
+            Bucket=bucket_name,
+            Key=large["file_key"].replace(f"s3://{bucket_name}/", ""))
+        assert obj["Body"].read() == small["body"]
+
+    def test_lambda_handler_plans_large_json_document(
+            self, s3_client, monkeypatch):
+        # Tests JSON documents that cannot be streamed are spilled to /tmp
+
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "1")
+        bucket_name = "test-bucket"
+        file_key = "test.json"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name, Key=file_key,
+            Body='[{"name": "Anas", "email_address": "a@b.com"}]')
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert json.loads(response["body"])["name"] == "***"
+        assert response["execution_plan"]["mode"] == "streaming"
+
+    def test_lambda_handler_stream_false_skips_planner(
+            self, s3_client, monkeypatch):
+        # Tests an explicit stream key overrides the planner
+
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "1")
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name, Key=file_key,
+            Body="name,email_address\nAnas,a@b\n")
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "stream": False,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert "body" in response
+        assert "execution_plan" not in response
+
+    def test_lambda_handler_hash_strategy_no_key(self, s3_client):
+        # Tests the hash strategy is rejected without a key
+
+        input_event = {
+            "file_to_obfuscate": "s3://test-bucket/test.csv",
+            "pii_fields": ["name", "email_address"],
+            "strategies": {"email_address": "hash"},
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 400
+        assert "hash_key is required" in response["body"]
+
 
 # Tests for lambda faulty scenarios
 class TestFaultScenarios:
@@ -97,6 +400,71 @@ class TestFaultScenarios:
         assert response["statusCode"] == 400
         assert "no such file" in response["body"].lower()
 
+    def test_lambda_handler_no_file_metrics(self, s3_client):
+        # Tests the failed probe stage is reported with the error
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        input_event = {
+            "file_to_obfuscate": "s3://test-bucket/missing.csv",
+            "pii_fields": ["name", "email_address"],
+            "metrics": True,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 400
+        assert "probe_seconds" in response["metrics"]
+        assert "download_seconds" not in response["metrics"]
+
+    @pytest.mark.parametrize("file_key", ["test.csv", "test.parquet"])
+    def test_lambda_handler_missing_pii_field(self, s3_client, file_key):
+        # Tests a field the file does not have fails before the download
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        df = pd.DataFrame({"name": ["Anas"], "age": [22]})
+        if file_key.endswith(".csv"):
+            body = df.to_csv(index=False)
+        else:
+            body = df.to_parquet(index=False)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=body)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "metrics": True,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 400
+        assert response["body"] == (
+            "Error, pii fields not found in file: email_address")
+        assert "probe_seconds" in response["metrics"]
+        assert "download_seconds" not in response["metrics"]
+        assert "stream_seconds" not in response["metrics"]
+
+    @pytest.mark.parametrize("body", [
+        '{"name": {"0": "Anas"}, "email": {"0": "a@b"}}',
+        '[{"name": "Anas", "email": "a@b"}]',
+        '{"name": "Anas", "email": "a@b"}\n',
+    ])
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_lambda_handler_json_missing_pii_field(
+            self, s3_client, body, stream):
+        # Tests a misspelt field in a JSON file fails and writes nothing
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(Bucket=bucket_name, Key="test.json", Body=body)
+        response = lambda_handler({
+            "file_to_obfuscate": f"s3://{bucket_name}/test.json",
+            "pii_fields": ["name", "emial"],
+            "stream": stream,
+        }, None, s3_client=s3_client)
+        assert response == {
+            "statusCode": 400,
+            "body": "Error, pii fields not found in file: emial",
+        }
+        keys = [obj["Key"] for obj in s3_client.list_objects_v2(
+            Bucket=bucket_name)["Contents"]]
+        assert keys == ["test.json"]
+
     def test_lambda_handler_no_pii_fields(self, s3_client):
         # Tests lambda handler when no pii fields provided
 
@@ -154,6 +522,18 @@ class TestFaultScenarios:
         assert response["statusCode"] == 400
         assert "invalid s3 uri" in response["body"].lower()
 
+    def test_lambda_handler_invalid_csv_backend(self, s3_client):
+        # Tests lambda handler rejects an unknown csv_backend
+
+        input_event = {
+            "file_to_obfuscate": "s3://test-bucket/test.csv",
+            "pii_fields": ["name", "email_address"],
+            "csv_backend": "polars",
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 400
+        assert "unsupported csv backend" in response["body"].lower()
+
 
 # Tests lambda handler with parquet file
 class TestParquet:
@@ -184,6 +564,10 @@ class TestParquet:
         }
         response = lambda_handler(input_event, None, s3_client=s3_client)
         assert response["statusCode"] == 200
+        obfus_file_key = response["file_key"].replace(
+            f"s3://{bucket_name}/", "")
+        obj = s3_client.get_object(Bucket=bucket_name, Key=obfus_file_key)
+        assert obj["Body"].read() == base64.b64decode(response["body"])
 
         parq_bytestream = BytesIO(base64.b64decode(response["body"]))
         parq_data_bytes = parq_bytestream.getvalue()
@@ -234,6 +618,82 @@ class TestParquet:
         assert all(df_obfuscated["age"] == [22, 21])
         assert all(df_obfuscated["cohort"] == [2023, 2024])
 
+    def test_lambda_handler_parquet_stream(self, s3_client):
+        # Tests lambda handler obfuscates parquet row groups when streaming
+
+        bucket_name = "test-bucket"
+        file_key = "test.parquet"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.upload_file("students.parquet", bucket_name, file_key)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "stream": True,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert "body" not in response
+        obfus_file_key = response["file_key"].replace(
+            f"s3://{bucket_name}/", "")
+        obj = s3_client.get_object(Bucket=bucket_name, Key=obfus_file_key)
+        df_obfuscated = pd.read_parquet(BytesIO(obj["Body"].read()))
+        assert obfus_file_key.endswith("_obfuscated.parquet")
+        assert df_obfuscated["name"].tolist() == ["***"]
+        assert df_obfuscated["email_address"].tolist() == ["***"]
+        assert df_obfuscated["course"].tolist() == ["Software"]
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_lambda_handler_parquet_categorical_output(
+            self, s3_client, stream):
+        # Tests categorical parquet output reads back as category columns
+
+        bucket_name = "test-bucket"
+        file_key = "test.parquet"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.upload_file("students.parquet", bucket_name, file_key)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "categorical_output": True,
+            "stream": stream,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        obfus_file_key = response["file_key"].replace(
+            f"s3://{bucket_name}/", "")
+        obj = s3_client.get_object(Bucket=bucket_name, Key=obfus_file_key)
+        df_obfuscated = pd.read_parquet(BytesIO(obj["Body"].read()))
+        assert isinstance(df_obfuscated["name"].dtype, pd.CategoricalDtype)
+        assert df_obfuscated["name"].astype(object).tolist() == ["***"]
+        assert df_obfuscated["course"].tolist() == ["Software"]
+
+    @pytest.mark.parametrize("options", [
+        {}, {"async_io": True}, {"parquet_workers": 2}])
+    def test_lambda_handler_parquet_stream_metrics(self, s3_client, options):
+        # Tests streaming is reported as a single stage with the rows and
+        # bytes it wrote
+
+        bucket_name = "test-bucket"
+        file_key = "test.parquet"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.upload_file("students.parquet", bucket_name, file_key)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "stream": True,
+            "metrics": True,
+            **options,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert response["metrics"]["FileType"] == "parquet"
+        assert response["metrics"]["stream_seconds"] >= 0
+        assert response["metrics"]["stream_rows"] == len(
+            pd.read_parquet("students.parquet"))
+        assert response["metrics"]["stream_bytes_written"] == (
+            response["size"])
+        assert "download_seconds" not in response["metrics"]
+
 
 # Tests for lambda handler with json file
 class TestJson:
@@ -258,7 +718,7 @@ class TestJson:
         response = lambda_handler(input_event, None, s3_client=s3_client)
         assert response["statusCode"] == 200
         json_bytestream = response["body"]
-        df_obfuscated = pd.read_json(BytesIO(json_bytestream))
+        df_obfuscated = pd.read_json(BytesIO(json_bytestream), lines=True)
         assert isinstance(json_bytestream, bytes)
         assert all(df_obfuscated["name"] == "***")
         assert all(df_obfuscated["name"] == "***")
@@ -299,3 +759,558 @@ class TestJson:
         assert all(df_obfuscated["email_address"] == "***")
         assert all(df_obfuscated["age"] == [22, 21])
         assert all(df_obfuscated["cohort"] == [2023, 2024])
+
+    def test_lambda_handler_json_array_format(self, s3_client):
+        """ Tests lambda handler writes and returns the same JSON array
+            when json_format is array"""
+
+        bucket_name = "test-bucket"
+        file_key = "test.json"
+        s3_client.create_bucket(Bucket=bucket_name)
+        data = {
+            "name": ["Anas", "Bob"],
+            "email_address": ["anas@example.com", "bob@example.com"],
+            "age": [22, 21],
+            "cohort": [2023, 2024],
+                }
+        json_file = json.dumps(data)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=json_file)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "json_format": "array",
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        obfus_file_key = response["file_key"].replace(
+            f"s3://{bucket_name}/", ""
+            )
+        obj = s3_client.get_object(Bucket=bucket_name, Key=obfus_file_key)
+        assert obj["Body"].read() == response["body"]
+        assert json.loads(response["body"]) == [
+            {"name": "***", "email_address": "***", "age": 22, "cohort": 2023},
+            {"name": "***", "email_address": "***", "age": 21, "cohort": 2024},
+        ]
+
+    def test_lambda_handler_json_invalid_format(self, s3_client):
+        # Tests lambda handler rejects an unknown json_format
+
+        input_event = {
+            "file_to_obfuscate": "s3://test-bucket/test.json",
+            "pii_fields": ["name", "email_address"],
+            "json_format": "xml",
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 400
+        assert "unsupported json format" in response["body"].lower()
+
+    def test_lambda_handler_json_lines_stream(self, s3_client):
+        # Tests lambda handler streams JSON Lines files when streaming
+
+        bucket_name = "test-bucket"
+        file_key = "test.json"
+        s3_client.create_bucket(Bucket=bucket_name)
+        json_lines = (
+            '{"name":"Anas","email_address":"anas@example.com","age":22}\n'
+            '{"name":"Bob","email_address":"bob@example.com","age":21}\n')
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=json_lines)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "stream": True,
+            "chunk_size": 1,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert "body" not in response
+        obfus_file_key = response["file_key"].replace(
+            f"s3://{bucket_name}/", ""
+            )
+        obj = s3_client.get_object(Bucket=bucket_name, Key=obfus_file_key)
+        df_obfuscated = pd.read_json(BytesIO(obj["Body"].read()), lines=True)
+        assert all(df_obfuscated["name"] == "***")
+        assert all(df_obfuscated["email_address"] == "***")
+        assert all(df_obfuscated["age"] == [22, 21])
+
+    @pytest.mark.parametrize("async_io", [False, True])
+    def test_lambda_handler_json_array_stream(self, s3_client, async_io):
+        # Tests streamed JSON Lines keep the "array" json_format
+
+        bucket_name = "test-bucket"
+        file_key = "test.json"
+        s3_client.create_bucket(Bucket=bucket_name)
+        json_lines = "".join(
+            f'{{"name":"n{i}","email_address":"e{i}","age":{i}}}\n'
+            for i in range(5))
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=json_lines)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "json_format": "array",
+            "chunk_size": 2,
+        }
+        in_memory = lambda_handler(
+            {**input_event, "stream": False}, None, s3_client=s3_client)
+        response = lambda_handler(
+            {**input_event, "stream": True, "async_io": async_io}, None,
+            s3_client=s3_client)
+        assert response["statusCode"] == 200
+        obj = s3_client.get_object(
+            Bucket=bucket_name,
+            Key=response["file_key"].replace(f"s3://{bucket_name}/", ""))
+        streamed = obj["Body"].read()
+        assert json.loads(streamed) == json.loads(in_memory["body"])
+        assert [record["age"] for record in json.loads(streamed)] == [
+            0, 1, 2, 3, 4]
+
+    def test_lambda_handler_json_document_stream(self, s3_client):
+        # Tests json documents are read whole even when streaming
+
+        bucket_name = "test-bucket"
+        file_key = "test.json"
+        s3_client.create_bucket(Bucket=bucket_name)
+        data = {"name": ["Anas", "Bob"], "email_address": ["a@b", "c@d"],
+                "age": [22, 21]}
+        s3_client.put_object(
+            Bucket=bucket_name, Key=file_key, Body=json.dumps(data))
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "stream": True,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        df_obfuscated = pd.read_json(BytesIO(response["body"]), lines=True)
+        assert all(df_obfuscated["name"] == "***")
+
+
+# Tests for lambda handler with compressed files
+class TestCompression:
+    @staticmethod
+    def decompress(data, codec):
+        return pa.CompressedInputStream(pa.BufferReader(data), codec).read()
+
+    @pytest.mark.parametrize("codec, suffix", [("gzip", ".gz"),
+                                               ("zstd", ".zst")])
+    @pytest.mark.parametrize("stream", [False, True])
+    @pytest.mark.parametrize("file_type", ["csv", "json"])
+    def test_lambda_handler_compressed_roundtrip(
+            self, s3_client, codec, suffix, stream, file_type):
+        # Tests compressed csv and json files are written with their codec
+
+        bucket_name = "test-bucket"
+        file_key = f"test.{file_type}{suffix}"
+        s3_client.create_bucket(Bucket=bucket_name)
+        df = pd.DataFrame({
+            "name": ["Anas", "Bob"],
+            "email_address": ["anas@example.com", "bob@example.com"],
+            "age": [22, 21],
+        })
+        if file_type == "csv":
+            data = df.to_csv(index=False).encode("utf-8")
+        else:
+            data = df.to_json(orient="records", lines=True).encode("utf-8")
+        s3_client.put_object(
+            Bucket=bucket_name, Key=file_key,
+            Body=pa.Codec(codec).compress(data, asbytes=True))
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "stream": stream,
+            "chunk_size": 1,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert response["file_key"].endswith(
+            f"_obfuscated.{file_type}{suffix}")
+        obfus_file_key = response["file_key"].replace(
+            f"s3://{bucket_name}/", "")
+        obj = s3_client.get_object(Bucket=bucket_name, Key=obfus_file_key)
+        output = self.decompress(obj["Body"].read(), codec)
+        if file_type == "csv":
+            df_obfuscated = pd.read_csv(BytesIO(output))
+        else:
+            df_obfuscated = pd.read_json(BytesIO(output), lines=True)
+        assert df_obfuscated["name"].tolist() == ["***", "***"]
+        assert df_obfuscated["email_address"].tolist() == ["***", "***"]
+        assert df_obfuscated["age"].tolist() == [22, 21]
+        if not stream:
+            body = base64.b64decode(response["body"])
+            assert self.decompress(body, codec) == output
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_lambda_handler_compression_option(self, s3_client, stream):
+        # Tests the output codec can differ from the input one
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        csv_data = b"name,email_address\nAnas,anas@example.com\n"
+        s3_client.put_object(
+            Bucket=bucket_name, Key="plain.csv", Body=csv_data)
+        s3_client.put_object(
+            Bucket=bucket_name, Key="packed.csv.gz",
+            Body=pa.Codec("gzip").compress(csv_data, asbytes=True))
+        for file_key, compression, suffix in [
+                ("plain.csv", "zstd", ".csv.zst"),
+                ("packed.csv.gz", "none", ".csv")]:
+            input_event = {
+                "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+                "pii_fields": ["name", "email_address"],
+                "stream": stream,
+                "compression": compression,
+            }
+            response = lambda_handler(input_event, None, s3_client=s3_client)
+            assert response["statusCode"] == 200
+            assert response["file_key"].endswith(f"_obfuscated{suffix}")
+        obj = s3_client.get_object(
+            Bucket=bucket_name,
+            Key=response["file_key"].replace(f"s3://{bucket_name}/", ""))
+        assert obj["Body"].read() == b"name,email_address\n***,***\n"
+
+    def test_lambda_handler_invalid_compression(self, s3_client):
+        # Tests lambda handler rejects an unknown compression
+
+        input_event = {
+            "file_to_obfuscate": "s3://test-bucket/test.csv",
+            "pii_fields": ["name", "email_address"],
+            "compression": "bz2",
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 400
+        assert "unsupported compression" in response["body"].lower()
+
+    def test_lambda_handler_compressed_parquet(self, s3_client):
+        # Tests compressed parquet keys are rejected
+
+        input_event = {
+            "file_to_obfuscate": "s3://test-bucket/test.parquet.gz",
+            "pii_fields": ["name", "email_address"],
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 400
+        assert "unsupported file type" in response["body"].lower()
+
+
+# Tests for content-addressed output of unchanged files
+class TestIdempotency:
+    @staticmethod
+    def output_keys(s3_client, bucket_name):
+        objects = s3_client.list_objects_v2(
+            Bucket=bucket_name, Prefix="csv_files/")
+        return [obj["Key"] for obj in objects.get("Contents", [])]
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_lambda_handler_skips_unchanged_file(self, s3_client, stream):
+        # Tests a re-run of an unchanged file finds its output and skips
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name, Key=file_key,
+            Body="name,email_address,age\nAnas,anas@example.com,22\n")
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "stream": stream,
+            "idempotent": True,
+        }
+        first = lambda_handler(input_event, None, s3_client=s3_client)
+        assert first["statusCode"] == 200
+        assert "skipped" not in first
+        second = lambda_handler(input_event, None, s3_client=s3_client)
+        assert second == {
+            "statusCode": 200,
+            "file_key": first["file_key"],
+            "skipped": True,
+        }
+        assert self.output_keys(s3_client, bucket_name) == [
+            first["file_key"].replace(f"s3://{bucket_name}/", "")]
+
+        forced = lambda_handler(
+            {**input_event, "force": True}, None, s3_client=s3_client)
+        assert forced["file_key"] == first["file_key"]
+        assert "skipped" not in forced
+
+    def test_lambda_handler_changed_file_or_settings(self, s3_client):
+        # Tests a new source version or new settings get a new output
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name, Key=file_key,
+            Body="name,email_address\nAnas,anas@example.com\n")
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "idempotent": True,
+        }
+        first = lambda_handler(input_event, None, s3_client=s3_client)
+        hashed = lambda_handler(
+            {**input_event, "strategies": {"email_address": "hash"},
+             "hash_key": "secret"},
+            None, s3_client=s3_client)
+        s3_client.put_object(
+            Bucket=bucket_name, Key=file_key,
+            Body="name,email_address\nBob,bob@example.com\n")
+        changed = lambda_handler(input_event, None, s3_client=s3_client)
+        keys = {first["file_key"], hashed["file_key"], changed["file_key"]}
+        assert len(keys) == 3
+        assert not any(
+            response.get("skipped") for response in [first, hashed, changed])
+        assert len(self.output_keys(s3_client, bucket_name)) == 3
+
+    def test_lambda_handler_idempotent_no_file(self, s3_client):
+        # Tests a missing source is reported before any lookup
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        input_event = {
+            "file_to_obfuscate": "s3://test-bucket/missing.csv",
+            "pii_fields": ["name", "email_address"],
+            "idempotent": True,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 400
+        assert "no such file" in response["body"].lower()
+
+
+# Tests for copies of the output between serializer, uploader and response
+class TestZeroCopy:
+    @pytest.mark.parametrize("file_key", ["test.csv", "test.json"])
+    def test_lambda_handler_uploads_and_returns_same_bytes(
+            self, s3_client, monkeypatch, file_key):
+        # Tests the serialized bytes are uploaded and returned uncopied
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        df = pd.DataFrame({
+            "name": ["Anas", "Bob"],
+            "email_address": ["anas@example.com", "bob@example.com"],
+        })
+        if file_key.endswith(".csv"):
+            body = df.to_csv(index=False)
+        else:
+            body = df.to_json(orient="records", lines=True)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=body)
+        uploaded = []
+        put_object = s3_client.put_object
+
+        def recording_put_object(**kwargs):
+            uploaded.append(kwargs["Body"])
+            return put_object(**kwargs)
+
+        monkeypatch.setattr(s3_client, "put_object", recording_put_object)
+        response = lambda_handler({
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "stream": False,
+        }, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        # one buffer, from the serializer through the upload to the body
+        assert len(uploaded) == 1
+        assert response["body"] is uploaded[0]
+
+
+# Tests for large responses offloaded to presigned URLs
+class TestLargeResponse:
+    @pytest.mark.parametrize("file_key", ["test.csv", "test.parquet"])
+    def test_lambda_handler_presigned_url(self, s3_client, file_key):
+        # Tests bodies over the threshold are replaced by a presigned URL
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        df = pd.DataFrame({
+            "name": [f"name_{i}" for i in range(100)],
+            "email_address": [f"user_{i}@example.com" for i in range(100)],
+        })
+        if file_key.endswith(".csv"):
+            body = df.to_csv(index=False)
+        else:
+            body = df.to_parquet(index=False)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=body)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "max_inline_bytes": 100,
+            "presigned_url_expiry": 60,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert "body" not in response
+        obfus_file_key = response["file_key"].replace(
+            f"s3://{bucket_name}/", "")
+        output = s3_client.get_object(
+            Bucket=bucket_name, Key=obfus_file_key)["Body"].read()
+        assert response["size"] == len(output)
+        assert response["sha256"] == hashlib.sha256(output).hexdigest()
+        assert response["expires_in"] == 60
+        url = urlparse(response["presigned_url"])
+        assert url.path.endswith(obfus_file_key)
+        assert bucket_name in url.netloc + url.path
+        assert "Expires" in url.query
+
+    @pytest.mark.parametrize("async_io", [False, True])
+    @pytest.mark.parametrize(
+        "file_key", ["test.csv", "test.parquet", "test.json", "test.csv.gz"])
+    def test_lambda_handler_stream_presigned_url(
+            self, s3_client, file_key, async_io):
+        # Tests streamed outputs report the size and sha256 of the object
+        # and a presigned URL instead of a body
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        df = pd.DataFrame({
+            "name": [f"name_{i}" for i in range(100)],
+            "email_address": [f"user_{i}@example.com" for i in range(100)],
+        })
+        if file_key.endswith(".parquet"):
+            body = df.to_parquet(index=False)
+        elif file_key.endswith(".json"):
+            body = df.to_json(orient="records", lines=True)
+        else:
+            body = df.to_csv(index=False).encode()
+        if file_key.endswith(".gz"):
+            body = gzip.compress(body)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=body)
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "stream": True,
+            "async_io": async_io,
+            "chunk_size": 10,
+            "presigned_url_expiry": 60,
+            "metrics": True,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert "body" not in response
+        obfus_file_key = response["file_key"].replace(
+            f"s3://{bucket_name}/", "")
+        output = s3_client.get_object(
+            Bucket=bucket_name, Key=obfus_file_key)["Body"].read()
+        assert response["size"] == len(output)
+        assert response["sha256"] == hashlib.sha256(output).hexdigest()
+        assert response["expires_in"] == 60
+        url = urlparse(response["presigned_url"])
+        assert url.path.endswith(obfus_file_key)
+        assert "Expires" in url.query
+        assert response["metrics"]["stream_rows"] == 100
+        assert response["metrics"]["stream_bytes_written"] == len(output)
+
+    def test_lambda_handler_stream_multipart_sha256(self, s3_client):
+        # Tests the sha256 of a streamed output of several parts covers
+        # the whole object
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        rows = 120000
+        body = "name,email_address,note\n" + "".join(
+            f"name_{i},user_{i}@example.com,{'x' * 40}{i}\n"
+            for i in range(rows))
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=body)
+        response = lambda_handler({
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "stream": True,
+        }, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        obfus_file_key = response["file_key"].replace(
+            f"s3://{bucket_name}/", "")
+        output = s3_client.get_object(
+            Bucket=bucket_name, Key=obfus_file_key)["Body"].read()
+        assert response["size"] == len(output) > 5 * 1024 * 1024
+        assert response["sha256"] == hashlib.sha256(output).hexdigest()
+
+    def test_lambda_handler_small_body_inline(self, s3_client):
+        # Tests bodies at the threshold are still returned inline
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name, Key=file_key,
+            Body="name,email_address\nAnas,anas@example.com\n")
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/{file_key}",
+            "pii_fields": ["name", "email_address"],
+            "max_inline_bytes": len(b"name,email_address\n***,***\n"),
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["body"] == b"name,email_address\n***,***\n"
+        assert "presigned_url" not in response
+
+
+# Tests for lambda handler with batches of files
+class TestBatch:
+    def test_lambda_handler_batch_files(self, s3_client):
+        # Tests lambda handler obfuscates a list of files and reports each
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        csv_data = ("name,email_address,age,cohort\n"
+                    "Anas,anas@example.com,22,2023\n")
+        for n in range(3):
+            s3_client.put_object(
+                Bucket=bucket_name, Key=f"new_data/{n}.csv", Body=csv_data)
+        uris = [f"s3://{bucket_name}/new_data/{n}.csv" for n in range(3)]
+        input_event = {
+            "files_to_obfuscate": uris + [f"s3://{bucket_name}/missing.csv"],
+            "pii_fields": ["name", "email_address"],
+            "max_workers": 2,
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 207
+        assert response["succeeded"] == 3
+        assert response["failed"] == 1
+        manifest = response["files"]
+        assert [f["file_to_obfuscate"] for f in manifest][:3] == uris
+        for status in manifest[:3]:
+            obfus_file_key = status["file_key"].replace(
+                f"s3://{bucket_name}/", "")
+            obj = s3_client.get_object(Bucket=bucket_name, Key=obfus_file_key)
+            output = obj["Body"].read()
+            assert status["size"] == len(output)
+            assert status["sha256"] == hashlib.sha256(output).hexdigest()
+            df_obfuscated = pd.read_csv(BytesIO(output))
+            assert all(df_obfuscated["name"] == "***")
+        assert manifest[3]["statusCode"] == 400
+        assert "no such file" in manifest[3]["error"].lower()
+
+    def test_lambda_handler_batch_prefix(self, s3_client):
+        # Tests lambda handler obfuscates every supported file in a prefix
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        csv_data = "name,email_address\nAnas,anas@example.com\n"
+        json_data = json.dumps({"name": ["Anas"], "email_address": ["a@b"]})
+        s3_client.put_object(
+            Bucket=bucket_name, Key="new_data/a.csv", Body=csv_data)
+        s3_client.put_object(
+            Bucket=bucket_name, Key="new_data/b.json", Body=json_data)
+        s3_client.put_object(
+            Bucket=bucket_name, Key="new_data/notes.txt", Body="notes")
+        input_event = {
+            "prefix_to_obfuscate": f"s3://{bucket_name}/new_data/",
+            "pii_fields": ["name", "email_address"],
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        assert response["succeeded"] == 2
+        assert sorted(f["file_to_obfuscate"] for f in response["files"]) == [
+            f"s3://{bucket_name}/new_data/a.csv",
+            f"s3://{bucket_name}/new_data/b.json",
+        ]
+
+    def test_lambda_handler_batch_empty_prefix(self, s3_client):
+        # Tests lambda handler when a prefix holds no files to obfuscate
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        input_event = {
+            "prefix_to_obfuscate": "s3://test-bucket/empty/",
+            "pii_fields": ["name", "email_address"],
+        }
+        response = lambda_handler(input_event, None, s3_client=s3_client)
+        assert response["statusCode"] == 400
+        assert "no files found" in response["body"].lower()
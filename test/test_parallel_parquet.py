@@ -0,0 +1,214 @@
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import sys
+from io import BytesIO
+from moto import mock_aws
+
+sys.path.append("src/")
+import parallel_parquet
+from parallel_parquet import (
+    obfuscate_parquet_row_groups_parallel,
+    obfuscate_parquet_s3_object_parallel,
+)
+from obfuscation_lambda import lambda_handler, stream_obfuscate_file
+from utils import obfuscate_parquet_row_groups
+
+
+# Creates Boto3 s3 mock client
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        yield s3
+
+
+def make_parquet(rows=200, row_group_size=25):
+    df = pd.DataFrame({
+        "name": [f"name_{i}" if i % 7 else None for i in range(rows)],
+        "email_address": [f"user_{i % 11}@example.com" for i in range(rows)],
+        "age": range(rows),
+    })
+    return df.to_parquet(index=False, row_group_size=row_group_size)
+
+
+def serial_output(data, *args):
+    sink = pa.BufferOutputStream()
+    obfuscate_parquet_row_groups(
+        pq.ParquetFile(pa.BufferReader(data)), ["name", "email_address"],
+        sink, *args)
+    return sink.getvalue().to_pybytes()
+
+
+# Tests for spreading row groups across a process pool
+class TestObfuscateParquetRowGroupsParallel:
+    @pytest.mark.parametrize("strategies,hash_key,categorical", [
+        (None, None, False),
+        ({"email_address": "hash"}, "secret", False),
+        (None, None, True),
+    ])
+    def test_parallel_matches_serial(self, strategies, hash_key,
+                                     categorical):
+        # Tests the parallel output is the same file as the serial one
+
+        data = make_parquet()
+        sink = pa.BufferOutputStream()
+        rows = obfuscate_parquet_row_groups_parallel(
+            data, ["name", "email_address"], sink, strategies, hash_key,
+            categorical=categorical, workers=2)
+        assert rows == 200
+        output = sink.getvalue().to_pybytes()
+        assert output == serial_output(
+            data, strategies, hash_key, None, categorical)
+        assert pq.ParquetFile(pa.BufferReader(output)).num_row_groups == 8
+
+    def test_parallel_falls_back_without_processes(self, monkeypatch):
+        # Tests row groups are processed serially if no pool can start
+
+        def no_pool(*args, **kwargs):
+            raise OSError("no shared memory")
+
+        monkeypatch.setattr(
+            parallel_parquet, "ProcessPoolExecutor", no_pool)
+        data = make_parquet()
+        sink = pa.BufferOutputStream()
+        rows = obfuscate_parquet_row_groups_parallel(
+            data, ["name", "email_address"], sink, workers=4)
+        assert rows == 200
+        assert sink.getvalue().to_pybytes() == serial_output(data)
+
+    def test_parallel_worker_error_frees_blocks(self):
+        # Tests a failing row group fails the file and frees shared memory
+
+        data = make_parquet()
+        before = set(parallel_parquet.os.listdir(
+            parallel_parquet.SHARED_MEMORY_DIR))
+        with pytest.raises(Exception):
+            obfuscate_parquet_row_groups_parallel(
+                data, ["name", "email_address"], pa.BufferOutputStream(),
+                {"email_address": "hash"}, None, workers=2)
+        after = set(parallel_parquet.os.listdir(
+            parallel_parquet.SHARED_MEMORY_DIR))
+        assert after <= before
+
+
+# Tests for the parallel parquet path of the lambda handler
+class TestParallelParquetHandler:
+    def test_s3_object_parallel(self, s3_client):
+        # Tests the streamed parallel output is the serial streamed file
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name, Key="test.parquet", Body=make_parquet())
+        args = ("test-bucket", "test.parquet", ["name", "email_address"],
+                s3_client)
+        serial_key = stream_obfuscate_file(*args)
+        parallel_key = obfuscate_parquet_s3_object_parallel(
+            *args, workers=2)
+        assert parallel_key.endswith("test_obfuscated.parquet")
+        serial = s3_client.get_object(Bucket=bucket_name, Key=serial_key)
+        parallel = s3_client.get_object(Bucket=bucket_name, Key=parallel_key)
+        assert parallel["Body"].read() == serial["Body"].read()
+
+    def test_s3_object_parallel_maps_spill_file(self, s3_client, monkeypatch):
+        # Tests workers map the downloaded file instead of a shared memory
+        # copy of it
+
+        segments = []
+        create_segment = parallel_parquet._create_segment
+
+        def recording_create_segment(size):
+            segments.append(size)
+            return create_segment(size)
+
+        monkeypatch.setattr(
+            parallel_parquet, "_create_segment", recording_create_segment)
+        s3_client.create_bucket(Bucket="test-bucket")
+        s3_client.put_object(
+            Bucket="test-bucket", Key="test.parquet", Body=make_parquet())
+        stats = {}
+        parallel_key = obfuscate_parquet_s3_object_parallel(
+            "test-bucket", "test.parquet", ["name", "email_address"],
+            s3_client, workers=2, stats=stats)
+        assert parallel_key.endswith("test_obfuscated.parquet")
+        assert stats["rows"] == 200
+        assert segments == []
+        obfuscate_parquet_row_groups_parallel(
+            make_parquet(), ["name", "email_address"],
+            pa.BufferOutputStream(), workers=2)
+        assert segments == [len(make_parquet())]
+
+    def test_s3_object_parallel_no_file(self, s3_client):
+        # Tests a missing source is reported as a read error
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        result = obfuscate_parquet_s3_object_parallel(
+            "test-bucket", "missing.parquet", ["name", "email_address"],
+            s3_client, workers=2)
+        assert result.startswith("Error reading parquet from S3")
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_lambda_handler_parquet_workers(self, s3_client, stream):
+        # Tests the handler spreads row groups across processes
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name, Key="test.parquet", Body=make_parquet())
+        response = lambda_handler({
+            "file_to_obfuscate": f"s3://{bucket_name}/test.parquet",
+            "pii_fields": ["name", "email_address"],
+            "parquet_workers": 2,
+            "stream": stream,
+            "metrics": True,
+        }, None, s3_client=s3_client)
+        assert response["statusCode"] == 200
+        obj = s3_client.get_object(
+            Bucket=bucket_name,
+            Key=response["file_key"].replace(f"s3://{bucket_name}/", ""))
+        df_obfuscated = pd.read_parquet(BytesIO(obj["Body"].read()))
+        assert (df_obfuscated["name"].dropna() == "***").all()
+        assert (df_obfuscated["email_address"] == "***").all()
+        assert df_obfuscated["age"].tolist() == list(range(200))
+        if not stream:
+            assert "body" in response
+
+    def test_lambda_handler_parquet_workers_cache_stats(self, s3_client):
+        # Tests the parent's cache counters are not reported for workers
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name, Key="test.parquet", Body=make_parquet())
+        input_event = {
+            "file_to_obfuscate": f"s3://{bucket_name}/test.parquet",
+            "pii_fields": ["name", "email_address"],
+            "strategies": {"email_address": "hash"},
+            "hash_key": "secret",
+        }
+        serial = lambda_handler(input_event, None, s3_client=s3_client)
+        assert serial["cache_stats"]["misses"] == 11
+        parallel = lambda_handler(
+            {**input_event, "parquet_workers": 2}, None,
+            s3_client=s3_client)
+        assert parallel["statusCode"] == 200
+        assert "cache_stats" not in parallel
+
+    def test_pool_does_not_fork(self, monkeypatch):
+        # Tests workers are not forked from a possibly threaded parent
+
+        contexts = []
+
+        def record_pool(*args, mp_context=None, **kwargs):
+            contexts.append(mp_context.get_start_method())
+            raise OSError("no processes")
+
+        monkeypatch.setattr(
+            parallel_parquet, "ProcessPoolExecutor", record_pool)
+        obfuscate_parquet_row_groups_parallel(
+            make_parquet(), ["name", "email_address"],
+            pa.BufferOutputStream(), workers=2)
+        assert contexts in (["forkserver"], ["spawn"])
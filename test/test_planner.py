@@ -0,0 +1,98 @@
+import pytest
+import boto3
+import sys
+from moto import mock_aws
+
+sys.path.append("src/")
+from planner import (
+    plan_execution,
+    plan_s3_object,
+    available_memory_bytes,
+    current_rss_bytes,
+    EXPANSION_FACTORS,
+    COMPRESSION_RATIOS,
+)
+
+
+# Creates Boto3 s3 mock client
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        yield s3
+
+
+# Tests for the memory budget planner
+class TestPlanner:
+    @pytest.mark.parametrize("file_type,mode", [
+        ("csv", "streaming"),
+        ("json", "streaming"),
+        ("parquet", "spill"),
+    ])
+    def test_plan_execution(self, file_type, mode):
+        # Tests files that do not fit in memory are streamed or spilled
+
+        size = 100 * 1024 * 1024
+        fits = plan_execution(
+            file_type, size, size * EXPANSION_FACTORS[file_type])
+        assert fits["mode"] == "in_memory"
+        too_large = plan_execution(
+            file_type, size, size * EXPANSION_FACTORS[file_type] - 1)
+        assert too_large == {
+            "mode": mode,
+            "content_length": size,
+            "estimated_bytes": size * EXPANSION_FACTORS[file_type],
+            "memory_bytes": size * EXPANSION_FACTORS[file_type] - 1,
+        }
+
+    def test_plan_execution_compressed(self):
+        # Tests compressed files are planned from their decompressed size
+
+        size = 100 * 1024 * 1024
+        memory_bytes = size * EXPANSION_FACTORS["csv"]
+        assert plan_execution("csv", size, memory_bytes)["mode"] == (
+            "in_memory")
+        plan = plan_execution("csv", size, memory_bytes, "gzip")
+        assert plan["mode"] == "streaming"
+        assert plan["estimated_bytes"] == (
+            memory_bytes * COMPRESSION_RATIOS["gzip"])
+
+    def test_plan_execution_not_streamable(self):
+        # Tests files that cannot be streamed are spilled instead
+
+        size = 100 * 1024 * 1024
+        plan = plan_execution("csv", size, 0, streamable=False)
+        assert plan["mode"] == "spill"
+        assert plan_execution(
+            "csv", size, size * EXPANSION_FACTORS["csv"],
+            streamable=False)["mode"] == "in_memory"
+
+    def test_available_memory_bytes(self, monkeypatch):
+        # Tests the budget follows the Lambda memory size
+
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "10240")
+        budget = available_memory_bytes()
+        assert 0 < budget <= int(10240 * 1024 * 1024 * 0.8)
+        assert budget == pytest.approx(
+            int(10240 * 1024 * 1024 * 0.8) - current_rss_bytes(),
+            abs=64 * 1024 * 1024)
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "1")
+        assert available_memory_bytes() == 0
+
+    def test_plan_s3_object(self, s3_client, monkeypatch):
+        # Tests the plan is made from the object's ContentLength
+
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "10240")
+        s3_client.create_bucket(Bucket="test-bucket")
+        s3_client.put_object(
+            Bucket="test-bucket", Key="test.csv", Body=b"a,b\n1,2\n")
+        plan = plan_s3_object("test-bucket", "test.csv", s3_client, "csv")
+        assert plan["mode"] == "in_memory"
+        assert plan["content_length"] == 8
+
+    def test_plan_s3_object_no_file(self, s3_client):
+        # Tests a missing object raises
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        with pytest.raises(Exception):
+            plan_s3_object("test-bucket", "missing.csv", s3_client, "csv")
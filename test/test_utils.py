@@ -4,6 +4,7 @@ from src.utils import (
     parse_input_json,
     read_csv_from_s3,
     obfuscate_pii,
+    mask_column,
     write_csv_obfuscated_file_to_s3,
     read_parquet_from_s3,
     write_parquet_obfuscated_file_to_s3,
@@ -12,7 +13,43 @@ from src.utils import (
     csv_bytestream_for_boto3_put,
     parquet_bytestream_for_boto3_put,
     json_bytestream_for_boto3_put,
+    read_csv_chunks_from_s3,
+    write_csv_chunks_obfuscated_file_to_s3,
+    S3MultipartWriter,
+    MIN_PART_SIZE,
+    serialize_dataframe,
+    put_obfuscated_bytes_to_s3,
+    get_s3_client,
+    obfuscate_parquet_s3_object,
+    download_s3_object,
+    is_json_lines,
+    obfuscate_json_lines_s3_object,
+    hash_column,
+    hash_arrow_column,
+    hash_value,
+    obfuscate_json_lines,
+    ValueCache,
+    obfuscate_arrow_table,
+    split_compression,
+    get_file_type,
+    build_obfuscated_file_key,
+    is_obfuscated_key,
+    compressing_writer,
+    read_json_bytes,
+    read_csv_bytes,
+    canonical_string,
+    json_records_writer,
+    output_fingerprint,
+    s3_object_exists,
+    ObfuscationPlan,
+    compile_plan,
+    probe_s3_columns,
 )
+import hashlib
+import hmac
+import tracemalloc
+import pyarrow as pa
+from botocore.response import StreamingBody
 import moto
 import boto3
 from moto import mock_aws
@@ -20,6 +57,7 @@ import io
 from io import StringIO
 import csv
 import json
+import mmap
 from io import BytesIO
 
 s3_client = boto3.client("s3", region_name="us-east-1")
@@ -33,6 +71,26 @@ def s3_client():
         yield s3
 
 
+# Tests for the shared s3 client provider
+class TestGetS3Client:
+    def test_get_s3_client_is_reused(self):
+        # Tests the same client is returned for the same settings
+
+        first = get_s3_client()
+        assert get_s3_client() is first
+
+    def test_get_s3_client_settings(self, monkeypatch):
+        # Tests pool, retry and keep-alive settings are applied
+
+        monkeypatch.setenv("S3_MAX_POOL_CONNECTIONS", "7")
+        client = get_s3_client(max_attempts=5, tcp_keepalive=False)
+        config = client.meta.config
+        assert config.max_pool_connections == 7
+        assert config.retries == {"total_max_attempts": 5, "mode": "standard"}
+        assert config.tcp_keepalive is False
+        assert client is not get_s3_client()
+
+
 # Tests parse input methods
 class TestParseInputJson:
     def test_parse_input_json(self):
@@ -78,6 +136,478 @@ class TestParseInputJson:
         assert pii_fields == []
 
 
+# Tests for single serialization of obfuscated files
+class TestSerializeOnce:
+    def test_serialize_dataframe_json_formats(self):
+        # Tests json is serialized as JSON Lines or as a JSON array
+
+        df = pd.DataFrame({"name": ["***", "***"], "age": [22, 21]})
+        lines = serialize_dataframe(df, "json")
+        array = serialize_dataframe(df, "json", json_format="array")
+        assert lines == (b'{"name":"***","age":22}\n'
+                         b'{"name":"***","age":21}\n')
+        assert array == b'[{"name":"***","age":22},{"name":"***","age":21}]'
+        assert serialize_dataframe(df, "json", json_format="xml") == (
+            "Unsupported JSON format: xml")
+
+    def test_put_obfuscated_bytes_to_s3(self, s3_client):
+        # Tests serialized bytes are written to the obfuscated file key
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        df = pd.DataFrame({"name": ["***"], "age": [22]})
+        body = serialize_dataframe(df, "csv")
+        file_key = put_obfuscated_bytes_to_s3(
+            bucket_name, "new_data/test.csv", body, s3_client)
+        assert file_key.startswith("csv_files/")
+        assert file_key.endswith("_new_data/test_obfuscated.csv")
+        response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+        assert response["Body"].read() == b"name,age\n***,22\n"
+
+
+# Tests for gzip and zstd compressed files
+class TestCompression:
+    def test_compressed_file_keys(self):
+        # Tests codecs are detected from key suffixes and kept on output
+
+        assert split_compression("new_data/a.csv.gz") == (
+            "new_data/a.csv", "gzip")
+        assert split_compression("new_data/a.json.zst") == (
+            "new_data/a.json", "zstd")
+        assert split_compression("new_data/a.csv") == ("new_data/a.csv", None)
+        assert get_file_type("new_data/a.csv.gz") == "csv"
+        assert build_obfuscated_file_key("a.csv.gz").endswith(
+            "_a_obfuscated.csv.gz")
+        assert build_obfuscated_file_key("a.csv.gz", "none").endswith(
+            "_a_obfuscated.csv")
+        assert build_obfuscated_file_key("a.json", "zstd").endswith(
+            "_a_obfuscated.json.zst")
+        assert build_obfuscated_file_key("a.parquet", "gzip").endswith(
+            "_a_obfuscated.parquet")
+        assert is_obfuscated_key("csv_files/1_a_obfuscated.csv.zst")
+        assert not is_obfuscated_key("a.csv.zst")
+
+    def test_parse_input_json_compressed(self):
+        # Tests compressed csv and json keys are accepted, parquet is not
+
+        for file_key in ["students.csv.gz", "students.json.zst"]:
+            _, parsed_key, _ = parse_input_json({
+                "file_to_obfuscate": f"s3://ans-gdpr-bucket/{file_key}",
+                "pii_fields": ["name", "email_address"],
+            })
+            assert parsed_key == file_key
+        _, parsed_key, _ = parse_input_json({
+            "file_to_obfuscate": "s3://ans-gdpr-bucket/students.parquet.gz",
+            "pii_fields": ["name", "email_address"],
+        })
+        assert parsed_key == "Unsupported file type"
+
+    def test_read_compressed_csv_chunks(self, s3_client):
+        # Tests gzip csv files are decompressed chunk by chunk
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        csv_data = b"".join(b"name_%d,%d\n" % (n, n) for n in range(100))
+        s3_client.put_object(
+            Bucket=bucket_name, Key="test.csv.gz",
+            Body=pa.Codec("gzip").compress(b"name,age\n" + csv_data,
+                                           asbytes=True))
+        chunks = read_csv_chunks_from_s3(
+            bucket_name, "test.csv.gz", s3_client, chunk_size=30)
+        sizes = [len(chunk) for chunk in chunks]
+        assert sizes == [30, 30, 30, 10]
+
+    def test_read_compressed_json_document(self):
+        # Tests a zstd json document is detected and parsed whole
+
+        data = json.dumps({"name": ["Anas", "Bob"], "age": [22, 21]})
+        df = read_json_bytes(
+            pa.Codec("zstd").compress(data.encode(), asbytes=True), "zstd")
+        assert df["name"].tolist() == ["Anas", "Bob"]
+
+    def test_compressing_writer_aborts_on_error(self, s3_client):
+        # Tests a failed run writes nothing and leaves no upload behind
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        with pytest.raises(RuntimeError):
+            output = S3MultipartWriter(bucket_name, "failed.csv.gz", s3_client)
+            with output, compressing_writer(output, "gzip") as sink:
+                sink.write(b"name\n***\n")
+                raise RuntimeError("serialization failed")
+        assert output.closed
+        objects = s3_client.list_objects_v2(Bucket=bucket_name)
+        assert objects["KeyCount"] == 0
+
+
+# Tests for content-addressed output keys
+class TestOutputFingerprint:
+    def test_output_fingerprint(self):
+        # Tests the fingerprint follows the source and the settings
+
+        head = {"ETag": '"abc"', "VersionId": "1"}
+        fields = ["name", "email_address"]
+        fingerprint = output_fingerprint(head, fields)
+        assert fingerprint == output_fingerprint(head, fields[::-1])
+        assert fingerprint == output_fingerprint(
+            head, fields, {"name": "mask"})
+        assert fingerprint != output_fingerprint(
+            {**head, "ETag": '"def"'}, fields)
+        assert fingerprint != output_fingerprint(
+            {**head, "VersionId": "2"}, fields)
+        assert fingerprint != output_fingerprint(head, ["name", "age"])
+        assert fingerprint != output_fingerprint(
+            head, fields, options={"json_format": "array"})
+        hashed = output_fingerprint(
+            head, fields, {"name": "hash"}, hash_key="secret")
+        assert hashed != output_fingerprint(
+            head, fields, {"name": "hash"}, hash_key="other")
+        key = build_obfuscated_file_key("new_data/a.csv", None, fingerprint)
+        assert key == (f"csv_files/{fingerprint[:32]}_new_data/"
+                       "a_obfuscated.csv")
+
+    def test_s3_object_exists(self, s3_client):
+        # Tests objects are looked up with head_object
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        s3_client.put_object(Bucket="test-bucket", Key="a.csv", Body=b"a\n")
+        assert s3_object_exists("test-bucket", "a.csv", s3_client)
+        assert not s3_object_exists("test-bucket", "b.csv", s3_client)
+        with pytest.raises(Exception):
+            s3_object_exists("missing-bucket", "a.csv", s3_client)
+
+
+# Tests for compiled obfuscation plans and the schema probe
+class TestObfuscationPlan:
+    def test_plan_resolves_fields(self):
+        # Tests fields are resolved to positions and missing ones listed
+
+        plan = ObfuscationPlan(
+            ["age", "name", "email_address"],
+            ["name", "phone", "email_address"], {"email_address": "hash"})
+        assert plan.fields == (
+            ("name", 1, "mask"), ("email_address", 2, "hash"))
+        assert plan.missing == ("phone",)
+        assert plan.matches(("age", "name", "email_address"))
+        assert not plan.matches(["name", "age", "email_address"])
+
+    def test_compile_plan_is_reused(self):
+        # Tests one plan is compiled per schema and settings
+
+        plan = compile_plan(pd.Index(["name", "age"]), ["name", "age"])
+        assert compile_plan(["name", "age"], ("name", "age")) is plan
+        assert compile_plan(
+            ["name", "age"], ["name", "age"], {"age": "hash"}) is not plan
+
+    def test_plan_applies_to_frames_and_tables(self):
+        # Tests pandas and Arrow obfuscation agree
+
+        df = pd.DataFrame({
+            "name": ["Anas", None],
+            "email_address": ["a@example.com", "b@example.com"],
+            "age": [22, 21],
+        })
+        plan = ObfuscationPlan(
+            df.columns, ["email_address", "name"], {"email_address": "hash"})
+        table = plan.apply_arrow(pa.Table.from_pandas(df), "key")
+        obfuscated = plan.apply(df.copy(), "key")
+        assert obfuscated["name"][0] == "***"
+        assert obfuscated["name"].isna()[1]
+        assert obfuscated["email_address"].tolist() == [
+            hash_value("a@example.com", "key"),
+            hash_value("b@example.com", "key")]
+        assert table.column("name").to_pylist() == ["***", None]
+        assert table.column("email_address").to_pylist() == (
+            obfuscated["email_address"].tolist())
+
+    def test_obfuscate_pii_missing_field(self):
+        # Tests fields after a missing one are still obfuscated
+
+        df = pd.DataFrame({"name": ["Anas"], "email_address": ["a@b"]})
+        obfuscated = obfuscate_pii(df, ["name", "phone", "email_address"])
+        assert obfuscated["name"].tolist() == ["***"]
+        assert obfuscated["email_address"].tolist() == ["***"]
+
+    @pytest.mark.parametrize("file_key", ["a.csv", "a.csv.gz", "a.json",
+                                          "a.json.zst", "a.parquet"])
+    def test_probe_s3_columns(self, s3_client, file_key):
+        # Tests columns are read from the header, first record or footer
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        df = pd.DataFrame({
+            "name": ["Anas", "Bob"],
+            "email address": ["a@b", "c@d"],
+            "age": [22, 21],
+        })
+        file_type, _, suffix = file_key[2:].partition(".")
+        if file_type == "csv":
+            body = df.to_csv(index=False).encode("utf-8")
+        elif file_type == "json":
+            body = df.to_json(orient="records", lines=True).encode("utf-8")
+        else:
+            body = df.to_parquet(index=False)
+        if suffix:
+            codec = {"gz": "gzip", "zst": "zstd"}[suffix]
+            body = pa.Codec(codec).compress(body, asbytes=True)
+        s3_client.put_object(Bucket="test-bucket", Key=file_key, Body=body)
+        assert probe_s3_columns("test-bucket", file_key, s3_client) == [
+            "name", "email address", "age"]
+
+    def test_probe_s3_columns_large_footer(self, s3_client, monkeypatch):
+        # Tests a footer larger than the first ranged GET is fetched whole
+
+        monkeypatch.setattr("src.utils.PARQUET_FOOTER_PROBE", 16)
+        s3_client.create_bucket(Bucket="test-bucket")
+        df = pd.DataFrame({f"column_{i}": [i] for i in range(50)})
+        s3_client.put_object(
+            Bucket="test-bucket", Key="a.parquet",
+            Body=df.to_parquet(index=False))
+        assert probe_s3_columns(
+            "test-bucket", "a.parquet", s3_client) == list(df.columns)
+
+    def test_probe_s3_columns_json_document(self, s3_client):
+        # Tests JSON documents and long first lines are not probed
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        s3_client.put_object(
+            Bucket="test-bucket", Key="a.json",
+            Body=json.dumps({"name": ["Anas", "Bob"]}))
+        assert probe_s3_columns("test-bucket", "a.json", s3_client) is None
+        with pytest.raises(Exception):
+            probe_s3_columns("test-bucket", "missing.csv", s3_client)
+
+
+# Tests for the ranged parallel downloader
+class TestDownloadS3Object:
+    def test_download_s3_object_in_ranges(self, s3_client):
+        # Tests an object is reassembled from parallel ranged GETs
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        content = b"".join(b"%d,name_%d\n" % (n, n) for n in range(1000))
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=content)
+        data = download_s3_object(
+            bucket_name, file_key, s3_client, part_size=1000,
+            max_concurrency=4)
+        assert isinstance(data, memoryview)
+        assert data == content
+
+    def test_download_s3_object_spill_to_disk(self, s3_client):
+        # Tests an object is downloaded into a memory-mapped /tmp file
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        content = b"name,email_address\n" * 500
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=content)
+        data = download_s3_object(
+            bucket_name, file_key, s3_client, part_size=4096,
+            spill_to_disk=True)
+        assert isinstance(data.obj, mmap.mmap)
+        assert data == content
+
+    def test_download_s3_object_empty(self, s3_client):
+        # Tests an empty object downloads as an empty buffer
+
+        bucket_name = "test-bucket"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(Bucket=bucket_name, Key="empty.csv", Body=b"")
+        data = download_s3_object(bucket_name, "empty.csv", s3_client)
+        assert len(data) == 0
+
+    def test_download_s3_object_no_file(self, s3_client):
+        # Tests missing objects raise the S3 error
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        with pytest.raises(Exception):
+            download_s3_object("test-bucket", "missing.csv", s3_client)
+
+
+# Tests for copies of file bytes between S3, the parsers and the writers
+class TestZeroCopy:
+    class CountingStream(io.BytesIO):
+        # raw stream of a StreamingBody that counts bytes copied out of it
+        # by read, as opposed to readinto
+        def __init__(self, data):
+            super().__init__(data)
+            self.copied = 0
+
+        def read(self, size=-1):
+            data = super().read(size)
+            self.copied += len(data)
+            return data
+
+    class FakeS3:
+        # just enough of an s3 client to serve ranged GETs and record puts
+        def __init__(self, data=b""):
+            self.data = data
+            self.streams = []
+            self.bodies = []
+
+        def get_object(self, Bucket, Key, Range, IfMatch=None):
+            start, end = map(int, Range[len("bytes="):].split("-"))
+            end = min(end, len(self.data) - 1)
+            stream = TestZeroCopy.CountingStream(self.data[start:end + 1])
+            self.streams.append(stream)
+            return {
+                "Body": StreamingBody(stream, end + 1 - start),
+                "ContentRange": f"bytes {start}-{end}/{len(self.data)}",
+                "ETag": '"etag"',
+            }
+
+        def put_object(self, Bucket, Key, Body):
+            self.bodies.append(Body)
+
+    def test_download_reads_into_buffer(self):
+        # Tests S3 bodies are read straight into the download buffer
+
+        data = bytes(range(256)) * 100
+        s3 = self.FakeS3(data)
+        view = download_s3_object(
+            "test-bucket", "a.csv", s3, part_size=4096, max_concurrency=2)
+        assert view == data
+        assert len(s3.streams) == 7
+        # no body was copied through an intermediate bytes object
+        assert sum(stream.copied for stream in s3.streams) == 0
+
+    def test_serialize_dataframe_holds_one_copy(self):
+        # Tests CSV output is built in one buffer, not as a str and bytes
+
+        # long values and several chunks of rows, so the output outweighs
+        # the strings pandas formats one chunk at a time
+        rows = 120_000
+        df = pd.DataFrame({
+            "name": [f"{i:0200d}" for i in range(rows)],
+            "age": range(rows),
+        })
+        tracemalloc.start()
+        try:
+            body = serialize_dataframe(df, "csv")
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert body == df.to_csv(index=False).encode("utf-8")
+        # copies of the output alive at the peak; to_csv().encode() holds
+        # the str and the bytes at once
+        assert peak // len(body) == 1
+
+    @pytest.mark.parametrize("compression", [None, "zstd"])
+    def test_read_json_bytes_parses_buffer_in_place(self, compression):
+        # Tests a JSON document is parsed without a decoded copy of the
+        # file, and a compressed one with a single decompressed copy
+
+        pytest.importorskip("orjson")
+        # whitespace outweighs the parsed values, so the peak is made of
+        # copies of the file
+        document = (b'[{"name": "Anas", "age": 22}'
+                    + b" " * (16 * 1024 * 1024) + b"]")
+        data = document
+        if compression is not None:
+            data = pa.Codec(compression).compress(document, asbytes=True)
+        data = memoryview(bytearray(data))
+        tracemalloc.start()
+        try:
+            df = read_json_bytes(data, compression)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert df.to_dict("records") == [{"name": "Anas", "age": 22}]
+        # pd.read_json holds the bytes read from the buffer and the str
+        # decoded from them, two copies of the file. The decompressed
+        # copy of a compressed file is held by Arrow, outside tracemalloc.
+        assert peak // len(document) == 0
+
+    def test_put_obfuscated_bytes_without_copy(self):
+        # Tests serialized bytes and buffers are handed to boto3 as is
+
+        s3 = self.FakeS3()
+        body = serialize_dataframe(pd.DataFrame({"name": ["***"]}), "csv")
+        put_obfuscated_bytes_to_s3("test-bucket", "a.csv", body, s3)
+        assert s3.bodies[0] is body
+        buffer = pa.py_buffer(bytearray(b"name\n***\n"))
+        put_obfuscated_bytes_to_s3(
+            "test-bucket", "a.csv", memoryview(buffer), s3)
+        reader = s3.bodies[1]
+        assert reader.read_buffer().address == buffer.address
+
+    def test_multipart_writer_hands_parts_over(self):
+        # Tests full parts are uploaded from the writer's own buffer
+
+        class RecordingS3:
+            def __init__(self):
+                self.parts = []
+
+            def create_multipart_upload(self, **kwargs):
+                return {"UploadId": "1"}
+
+            def upload_part(self, Body, PartNumber, **kwargs):
+                self.parts.append(Body)
+                return {"ETag": str(PartNumber)}
+
+            def complete_multipart_upload(self, **kwargs):
+                pass
+
+        s3 = RecordingS3()
+        chunk = b"x" * (MIN_PART_SIZE // 4 + 1)
+        with S3MultipartWriter(
+                "test-bucket", "a.csv", s3, MIN_PART_SIZE) as writer:
+            for _ in range(9):
+                writer.write(chunk)
+        assert [len(part) for part in s3.parts] == [
+            MIN_PART_SIZE, MIN_PART_SIZE, 9 * len(chunk) - 2 * MIN_PART_SIZE]
+        assert all(isinstance(part, bytearray) for part in s3.parts)
+
+
+# Tests for the multipart S3 output sink
+class TestS3MultipartWriter:
+    def test_multipart_writer_uploads_parts(self, s3_client):
+        # Tests output larger than a part is sent as a multipart upload
+
+        bucket_name = "test-bucket"
+        file_key = "big.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        block = b"***,***,22,2023\n" * 4096
+        blocks = (2 * MIN_PART_SIZE) // len(block) + 1
+        with S3MultipartWriter(
+                bucket_name,
+                file_key,
+                s3_client,
+                part_size=MIN_PART_SIZE) as sink:
+            for _ in range(blocks):
+                sink.write(block)
+        assert sink._part_number == 3
+        response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+        assert response["Body"].read() == block * blocks
+
+    def test_multipart_writer_small_output_single_put(self, s3_client):
+        # Tests output smaller than a part is sent with one put_object
+
+        bucket_name = "test-bucket"
+        file_key = "small.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        with S3MultipartWriter(bucket_name, file_key, s3_client) as sink:
+            sink.write(b"name\n***\n")
+        assert sink._upload_id is None
+        response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+        assert response["Body"].read() == b"name\n***\n"
+
+    def test_multipart_writer_aborts_on_error(self, s3_client):
+        # Tests a failed run aborts the upload and leaves no object
+
+        bucket_name = "test-bucket"
+        file_key = "failed.csv"
+        s3_client.create_bucket(Bucket=bucket_name)
+        with pytest.raises(RuntimeError):
+            with S3MultipartWriter(bucket_name, file_key, s3_client) as sink:
+                sink.write(b"x" * (MIN_PART_SIZE + 1))
+                raise RuntimeError("serialization failed")
+        uploads = s3_client.list_multipart_uploads(Bucket=bucket_name)
+        assert uploads.get("Uploads", []) == []
+        objects = s3_client.list_objects_v2(Bucket=bucket_name)
+        assert objects["KeyCount"] == 0
+
+
 # Tests for CSV file processes
 class TestCSVOperations:
     @mock_aws
@@ -254,6 +784,65 @@ class TestCSVOperations:
         assert all(df_csv["age"] == [22, 21])
         assert all(df_csv["cohort"] == [2023, 2024])
 
+    @mock_aws
+    def test_read_csv_chunks_from_s3(self, s3_client):
+        # Tests csv file is read from s3 bucket in chunks
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        csv_content = ("name,email_address,age\n"
+                       "Anas,anas@example.com,22\n"
+                       "Bob,bob@example.com,21\n"
+                       "Sam,sam@example.com,20\n")
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=file_key,
+            Body=csv_content)
+        chunks = list(read_csv_chunks_from_s3(
+            bucket_name, file_key, s3_client, chunk_size=2))
+        assert [len(chunk) for chunk in chunks] == [2, 1]
+        assert list(chunks[1].columns) == ["name", "email_address", "age"]
+        assert chunks[1]["name"].tolist() == ["Sam"]
+
+    def test_read_csv_chunks_from_s3_no_file(self, s3_client):
+        # Tests chunked csv read when no file exist
+
+        chunks = read_csv_chunks_from_s3(
+            "nonexistent-bucket", "nonexistent-file.csv", s3_client)
+        assert chunks.startswith("Error reading CSV from S3:")
+
+    @mock_aws
+    def test_write_csv_chunks_obfuscated_file_to_s3(self, s3_client):
+        # Tests chunks are obfuscated and written as one csv file
+
+        bucket_name = "test-bucket"
+        file_key = "test.csv"
+        csv_content = ("name,email_address,age\n"
+                       "Anas,anas@example.com,22\n"
+                       "Bob,,21\n"
+                       "Sam,sam@example.com,20\n")
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=file_key,
+            Body=csv_content)
+        chunks = read_csv_chunks_from_s3(
+            bucket_name, file_key, s3_client, chunk_size=2)
+        csv_file_key = write_csv_chunks_obfuscated_file_to_s3(
+            bucket_name,
+            file_key,
+            chunks,
+            ["name", "email_address"],
+            s3_client)
+        assert csv_file_key.endswith("_obfuscated.csv")
+        response = s3_client.get_object(Bucket=bucket_name, Key=csv_file_key)
+        content = response["Body"].read().decode("utf-8")
+        assert content == ("name,email_address,age\n"
+                           "***,***,22\n"
+                           "***,,21\n"
+                           "***,***,20\n")
+
 
 # Tests for data obfuscation
 class TestObfuscatePII:
@@ -296,6 +885,241 @@ class TestObfuscatePII:
         obfuscated_df = obfuscate_pii(df, pii_fields)
         assert obfuscated_df == "no data frame provided"
 
+    def test_mask_column_matches_apply(self):
+        # Tests vectorised masking gives the same output as per-row apply
+
+        data = {
+            "name": ["Anas", None, "Bob"],
+            "student_id": [1, 2, 3],
+            "score": [1.5, None, 3.0],
+            "empty": [None, None, None],
+            "graduation_date": pd.to_datetime(
+                ["2024-05-15", None, "2025-06-20"]),
+            "course": pd.Categorical(["Software", None, "DE"]),
+        }
+        df = pd.DataFrame(data)
+        for field in df.columns:
+            expected = df[field].apply(
+                lambda x: "***" if pd.notnull(x) else x)
+            masked = mask_column(df[field])
+            pd.testing.assert_series_equal(masked, expected)
+
+    def test_mask_column_categorical(self):
+        # Tests categorical masking keeps nulls and uses less memory
+
+        series = pd.Series(
+            [f"user_{i}@example.com" for i in range(1000)] + [None],
+            name="email_address")
+        masked = mask_column(series)
+        categorical = mask_column(series, categorical=True)
+        assert isinstance(categorical.dtype, pd.CategoricalDtype)
+        assert list(categorical.cat.categories) == ["***"]
+        assert categorical.name == "email_address"
+        pd.testing.assert_series_equal(
+            categorical.astype(object), masked.astype(object))
+        assert (categorical.memory_usage(deep=True)
+                < masked.memory_usage(deep=True) / 5)
+
+    def test_obfuscate_arrow_table_categorical(self):
+        # Tests dictionary-encoded arrow output matches the string output
+
+        table = pa.table({
+            "name": ["Anas", None, "Bob"],
+            "email_address": ["a@example.com", "b@example.com", None],
+            "age": [22, 21, 20],
+        })
+        strategies = {"email_address": "hash"}
+        expected = obfuscate_arrow_table(
+            table, ["name", "email_address"], strategies, "secret")
+        actual = obfuscate_arrow_table(
+            table, ["name", "email_address"], strategies, "secret",
+            categorical=True)
+        assert pa.types.is_dictionary(actual.column("name").type)
+        assert pa.types.is_dictionary(actual.column("email_address").type)
+        assert actual.cast(expected.schema).equals(expected)
+
+
+# Tests for keyed-hash pseudonymization
+class TestHashPII:
+    def test_hash_column(self):
+        # Tests values are replaced by HMAC-SHA256 tokens and nulls kept
+
+        series = pd.Series(["anas@example.com", None, "anas@example.com",
+                            "bob@example.com"], name="email_address")
+        hashed = hash_column(series, "secret")
+        expected = hmac.new(
+            b"secret", b"anas@example.com", hashlib.sha256).hexdigest()
+        assert hashed[0] == expected
+        assert hashed[2] == expected
+        assert pd.isna(hashed[1])
+        assert hashed[3] != expected
+        assert hash_column(series, "other")[0] != expected
+
+    def test_hash_arrow_column_matches_pandas(self):
+        # Tests Arrow hashing gives the same tokens as pandas hashing
+
+        values = ["anas@example.com", None,
+                  "bob@example.com", "anas@example.com"]
+        hashed = hash_arrow_column(pa.chunked_array([values[:2], values[2:]]),
+                                   b"secret")
+        expected = hash_column(pd.Series(values), b"secret")
+        assert hashed.to_pylist() == [
+            None if pd.isna(v) else v for v in expected.tolist()]
+
+    def test_obfuscate_pii_strategies(self):
+        # Tests each field is obfuscated with its own strategy
+
+        df = pd.DataFrame({
+            "name": ["Anas", "Bob"],
+            "email_address": ["anas@example.com", "bob@example.com"],
+            "age": [22, 21],
+        })
+        obfuscated_df = obfuscate_pii(
+            df, ["name", "email_address"], {"email_address": "hash"}, "key")
+        assert obfuscated_df["name"].tolist() == ["***", "***"]
+        assert obfuscated_df["email_address"].tolist() == [
+            hash_value("anas@example.com", "key"),
+            hash_value("bob@example.com", "key")]
+        assert obfuscated_df["age"].tolist() == [22, 21]
+
+    @pytest.mark.parametrize("json_format,batches,expected", [
+        ("lines", [b'{"a":1}\n{"a":2}\n', b'{"a":3}\n'],
+         b'{"a":1}\n{"a":2}\n{"a":3}\n'),
+        ("array", [b'{"a":1}\n{"a":2}\n', b'{"a":3}\n'],
+         b'[{"a":1},{"a":2},{"a":3}]'),
+        ("array", [], b"[]"),
+    ])
+    def test_json_records_writer(self, json_format, batches, expected):
+        # Tests batches of records are written in the requested shape
+
+        sink = BytesIO()
+        with json_records_writer(sink, json_format) as writer:
+            for batch in batches:
+                writer.write(batch)
+        assert sink.getvalue() == expected
+        if json_format == "array":
+            # records, not batches, are counted
+            assert writer.records == (3 if batches else 0)
+
+    def test_obfuscate_json_lines_hash(self):
+        # Tests JSON Lines records are hashed with the same tokens
+
+        lines = [b'{"name":"Anas","email_address":"a@example.com"}',
+                 b'{"name":"Bob","email_address":"a@example.com"}']
+        output = obfuscate_json_lines(
+            lines, ["name", "email_address"], {"email_address": "hash"}, "k")
+        records = [json.loads(line) for line in output.splitlines()]
+        token = hash_value("a@example.com", "k")
+        assert records == [
+            {"name": "***", "email_address": token},
+            {"name": "***", "email_address": token},
+        ]
+
+    @pytest.mark.parametrize("values,arrow_type,json_values,canonical", [
+        ([2, None, 3], pa.int64(), "2,null,3", ["2", "3"]),
+        ([2.0, None, 1.5], pa.float64(), "2.0,null,1.5", ["2", "1.5"]),
+        ([True, None, False], pa.bool_(), "true,null,false",
+         ["true", "false"]),
+        (["007", None, "7"], pa.string(), '"007",null,"7"', ["007", "7"]),
+    ])
+    def test_hash_paths_agree(self, values, arrow_type, json_values,
+                              canonical):
+        # Tests pandas, Arrow and JSON Lines hash a value to one token
+
+        expected = [hash_value(canonical[0], "k"), None,
+                    hash_value(canonical[1], "k")]
+        typed = pa.array(values, arrow_type)
+        assert hash_arrow_column(typed, "k").to_pylist() == expected
+        for series in (typed.to_pandas(), pd.Series(values, dtype=object)):
+            hashed = hash_column(series.rename("id"), "k").tolist()
+            assert [None if pd.isna(v) else v for v in hashed] == expected
+        records = [f'{{"id":{value}}}' for value in json_values.split(",")]
+        output = obfuscate_json_lines(
+            [record.encode() for record in records], ["id"], {"id": "hash"},
+            "k")
+        assert [json.loads(line)["id"]
+                for line in output.splitlines()] == expected
+        document = read_json_bytes(
+            memoryview(bytearray(f"[{','.join(records)}]".encode())))
+        hashed = hash_column(document["id"], "k").tolist()
+        assert [None if pd.isna(v) else v for v in hashed] == expected
+
+    def test_hash_csv_reads_source_strings(self):
+        # Tests in-memory CSV keeps zero padding like the streaming reader
+
+        df = read_csv_bytes(b"id,score\n007,1.50\n7,2\n")
+        assert df["id"].tolist() == ["007", "7"]
+        assert df["score"].tolist() == ["1.50", "2"]
+        assert hash_column(df["id"], "k")[0] == hash_value("007", "k")
+
+    def test_canonical_string(self):
+        # Tests numbers and booleans are written one way
+
+        assert canonical_string(2) == canonical_string(2.0) == "2"
+        assert canonical_string(True) == "true"
+        assert canonical_string(1.5) == "1.5"
+        assert canonical_string("007") == "007"
+
+
+# Tests for the per-invocation value cache
+class TestValueCache:
+    def test_value_cache_counts_and_evicts(self):
+        # Tests hits, misses and least recently used eviction
+
+        calls = []
+
+        def transform(values):
+            calls.append(list(values))
+            return [v.upper() for v in values]
+
+        cache = ValueCache(max_size=2)
+        assert cache.transform("name", ["a", "b"], transform) == ["A", "B"]
+        assert cache.transform("name", ["a", "c"], transform) == ["A", "C"]
+        assert calls == [["a", "b"], ["c"]]
+        # "b" was least recently used when "c" was added
+        assert cache.transform("name", ["b"], transform) == ["B"]
+        assert cache.stats() == {
+            "hits": 1,
+            "misses": 4,
+            "evictions": 2,
+            "size": 2,
+            "max_size": 2,
+        }
+
+    def test_value_cache_keyed_by_field(self):
+        # Tests the same value in two fields is cached separately
+
+        cache = ValueCache()
+        cache.transform("name", ["a"], lambda values: ["x"])
+        assert cache.transform("city", ["a"], lambda values: ["y"]) == ["y"]
+
+    def test_value_cache_keeps_equal_values_apart(self):
+        # Tests True and 1.0 compare equal but are cached separately
+
+        cache = ValueCache()
+        assert cache.transform("id", [True], lambda v: ["t"]) == ["t"]
+        assert cache.transform("id", [1.0], lambda v: ["1"]) == ["1"]
+        assert cache.misses == 2
+        series = pd.Series([True, 1.0, 1, "1"], dtype=object, name="id")
+        assert hash_column(series, "k", ValueCache()).tolist() == \
+            hash_column(series, "k").tolist()
+        lines = [b'{"id":true}', b'{"id":1.0}', b'{"id":1}']
+        assert obfuscate_json_lines(
+            lines, ["id"], {"id": "hash"}, "k", ValueCache()) == \
+            obfuscate_json_lines(lines, ["id"], {"id": "hash"}, "k")
+
+    def test_hash_column_with_cache(self):
+        # Tests repeated values across chunks are hashed once
+
+        cache = ValueCache()
+        first = pd.Series(["a@example.com", "b@example.com"], name="email")
+        second = pd.Series(["b@example.com", "a@example.com"], name="email")
+        hashed_first = hash_column(first, "key", cache)
+        hashed_second = hash_column(second, "key", cache)
+        assert hashed_second.tolist() == hashed_first.tolist()[::-1]
+        assert cache.hits == 2
+        assert cache.misses == 2
+
 
 # Tests for parquet obfuscation methods
 class TestParquetOperations:
@@ -371,6 +1195,76 @@ class TestParquetOperations:
         assert all(df_parq["age"] == [22, 21])
         assert all(df_parq["cohort"] == [2023, 2024])
 
+    @mock_aws
+    def test_obfuscate_parquet_s3_object(self, s3_client):
+        """ Tests parquet file is obfuscated row group by row group
+            with the same result as the pandas path"""
+
+        bucket_name = "test-bucket"
+        file_key = "test.parquet"
+        s3_client.create_bucket(Bucket=bucket_name)
+        data = {
+            "name": ["Anas", None, "Bob"],
+            "email_address": ["anas@example.com", "x@example.com", None],
+            "age": [22, 23, 21],
+            "cohort": [2023, 2023, 2024],
+        }
+        df = pd.DataFrame(data)
+        parq_buffer = BytesIO()
+        df.to_parquet(parq_buffer, index=False, row_group_size=2)
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=file_key,
+            Body=parq_buffer.getvalue())
+        parquet_file_key = obfuscate_parquet_s3_object(
+            bucket_name,
+            file_key,
+            ["name", "email_address", "age"],
+            s3_client)
+        assert parquet_file_key.endswith("_obfuscated.parquet")
+        response = s3_client.get_object(
+            Bucket=bucket_name,
+            Key=parquet_file_key)
+        df_obfuscated = pd.read_parquet(BytesIO(response["Body"].read()))
+        assert df_obfuscated["name"].isna().tolist() == [False, True, False]
+        assert df_obfuscated["age"].tolist() == ["***", "***", "***"]
+        assert df_obfuscated["cohort"].tolist() == [2023, 2023, 2024]
+        expected_buffer = BytesIO()
+        obfuscate_pii(df, ["name", "email_address", "age"]).to_parquet(
+            expected_buffer, index=False)
+        expected = pd.read_parquet(expected_buffer)
+        pd.testing.assert_frame_equal(df_obfuscated, expected)
+
+    def test_obfuscate_parquet_s3_object_categorical(self, s3_client):
+        # Tests categorical parquet output reads back as category columns
+
+        bucket_name = "test-bucket"
+        file_key = "test.parquet"
+        s3_client.create_bucket(Bucket=bucket_name)
+        df = pd.DataFrame({
+            "name": ["Anas", None, "Bob"],
+            "age": [22, 21, 20],
+        })
+        s3_client.put_object(
+            Bucket=bucket_name, Key=file_key, Body=df.to_parquet(index=False))
+        obfus_file_key = obfuscate_parquet_s3_object(
+            bucket_name, file_key, ["name"], s3_client, categorical=True)
+        obj = s3_client.get_object(Bucket=bucket_name, Key=obfus_file_key)
+        df_obfuscated = pd.read_parquet(BytesIO(obj["Body"].read()))
+        assert isinstance(df_obfuscated["name"].dtype, pd.CategoricalDtype)
+        assert df_obfuscated["name"].astype(object).tolist()[::2] == [
+            "***", "***"]
+        assert df_obfuscated["name"].isna().tolist() == [False, True, False]
+        assert df_obfuscated["age"].tolist() == [22, 21, 20]
+
+    def test_obfuscate_parquet_s3_object_no_file(self, s3_client):
+        # Tests arrow parquet path when no file exist
+
+        s3_client.create_bucket(Bucket="test-bucket")
+        result = obfuscate_parquet_s3_object(
+            "test-bucket", "nonexistent.parquet", ["name"], s3_client)
+        assert result.startswith("Error reading parquet from S3:")
+
 
 # Tests for json file obfuscation methods
 class TestJSONOperations:
@@ -452,3 +1346,84 @@ class TestJSONOperations:
                         "bob@example.com"])
         assert all(df_parq["age"] == [22, 21])
         assert all(df_parq["cohort"] == [2023, 2024])
+
+    def test_is_json_lines(self):
+        # Tests JSON Lines records are told apart from json documents
+
+        assert is_json_lines(b'{"name": "Anas", "tags": ["a"]}')
+        assert not is_json_lines(b'{"name": ["Anas", "Bob"]}')
+        assert not is_json_lines(b'[{"name": "Anas"}]')
+        assert not is_json_lines(b'{"name": "Anas",')
+
+    @pytest.mark.parametrize("buffer", [
+        bytes, bytearray, memoryview,
+        lambda data: memoryview(b"[1]\n" + data)[4:]])
+    @pytest.mark.parametrize("data", [
+        b'\n{"name":"Anas","age":22}\r\n{"name":"Bob","age":21}\n',
+        b'[{"name":"Anas","age":22},{"name":"Bob","age":21}]',
+        b'{"name":{"0":"Anas","1":"Bob"},"age":{"0":22,"1":21}}'])
+    def test_read_json_bytes_any_buffer(self, buffer, data):
+        # Tests JSON Lines and documents are read from any buffer
+
+        df = read_json_bytes(buffer(data))
+        assert df["name"].tolist() == ["Anas", "Bob"]
+        assert df["age"].tolist() == [22, 21]
+
+    @mock_aws
+    def test_read_json_lines_from_s3(self, s3_client):
+        # Tests read json from s3 when the file is JSON Lines
+
+        bucket_name = "test-bucket"
+        file_key = "test.json"
+        json_lines = ('{"name":"Anas","email_address":"anas@example.com"}\n'
+                      '{"name":"Bob","email_address":"bob@example.com"}\n')
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=json_lines)
+        df = read_json_from_s3(bucket_name, file_key, s3_client)
+        assert df["name"].tolist() == ["Anas", "Bob"]
+
+    @mock_aws
+    def test_obfuscate_json_lines_s3_object(self, s3_client):
+        # Tests JSON Lines file is obfuscated in batches of records
+
+        bucket_name = "test-bucket"
+        file_key = "events.json"
+        json_lines = (
+            '{"name":"Anas","email_address":"anas@example.com","age":22}\n'
+            '{"name":"Bob","email_address":null,"age":21}\n'
+            '\n'
+            '{"name":"Sam","age":20}\n')
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=json_lines)
+        json_file_key = obfuscate_json_lines_s3_object(
+            bucket_name,
+            file_key,
+            ["name", "email_address"],
+            s3_client,
+            batch_size=2)
+        assert json_file_key.endswith("_obfuscated.json")
+        response = s3_client.get_object(Bucket=bucket_name, Key=json_file_key)
+        records = [json.loads(line) for line in
+                   response["Body"].read().decode("utf-8").splitlines()]
+        assert records == [
+            {"name": "***", "email_address": "***", "age": 22},
+            {"name": "***", "email_address": None, "age": 21},
+            {"name": "***", "age": 20},
+        ]
+
+    @mock_aws
+    def test_obfuscate_json_lines_s3_object_document(self, s3_client):
+        # Tests json documents are left to the in-memory path
+
+        bucket_name = "test-bucket"
+        file_key = "test.json"
+        s3_client.create_bucket(Bucket=bucket_name)
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=file_key,
+            Body=json.dumps({"name": ["Anas", "Bob"]}))
+        result = obfuscate_json_lines_s3_object(
+            bucket_name, file_key, ["name"], s3_client)
+        assert result == "Not JSON Lines"
+        objects = s3_client.list_objects_v2(Bucket=bucket_name)
+        assert objects["KeyCount"] == 1